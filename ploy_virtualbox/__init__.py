@@ -1,7 +1,8 @@
-from __future__ import unicode_literals
+from __future__ import print_function, unicode_literals
 from lazy import lazy
-from ploy.common import BaseMaster, yesno
-from ploy.config import BooleanMassager, PathMassager
+from multiprocessing.pool import ThreadPool
+from ploy.common import BaseMaster, sorted_choices, yesno
+from ploy.config import BooleanMassager, IntegerMassager, PathMassager
 from ploy.config import expand_path
 from ploy.plain import Instance as PlainInstance
 from ploy.proxy import ProxyInstance
@@ -9,15 +10,17 @@ try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
+import argparse
+import atexit
 import hashlib
+import json
 import logging
 import os
-import re
 import subprocess
 import shlex
 import sys
+import threading
 import time
-import urllib
 
 log = logging.getLogger('ploy_virtualbox')
 
@@ -26,14 +29,92 @@ class VirtualBoxError(Exception):
     pass
 
 
+def run_concurrently(func, items, workers):
+    """Call ``func`` for each of ``items`` with at most ``workers`` threads.
+
+    Returns a list of ``(result, exception)`` tuples in the order of
+    ``items``. Unlike ``ThreadPool.map`` this also catches the
+    ``SystemExit`` raised by ``sys.exit`` calls in the workers, so one
+    failing item doesn't abort the others.
+    """
+    def call(item):
+        try:
+            return (func(item), None)
+        except BaseException as e:
+            return (None, e)
+
+    items = list(items)
+    workers = min(workers or 1, len(items))
+    if workers <= 1:
+        return [call(x) for x in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class InstanceLogBuffer(logging.Filter):
+    """Holds back log records emitted by threads bound to an instance.
+
+    The records can then be replayed grouped by instance, so the output of
+    concurrently running operations doesn't get interleaved. Filters of a
+    logger don't apply to the records of its children, so the buffer is
+    added to all ``loggers``.
+    """
+
+    loggers = (
+        'ploy_virtualbox',
+        'ploy_virtualbox.download',
+        'ploy_virtualbox.plan',
+        'ploy_virtualbox.vbox')
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.records = {}
+        self._local = threading.local()
+
+    def attach(self):
+        for name in self.loggers:
+            logging.getLogger(name).addFilter(self)
+
+    def detach(self):
+        for name in self.loggers:
+            logging.getLogger(name).removeFilter(self)
+
+    def bind(self, instance_id):
+        self.records.setdefault(instance_id, [])
+        self._local.instance_id = instance_id
+
+    def unbind(self):
+        self._local.instance_id = None
+
+    def filter(self, record):
+        instance_id = getattr(self._local, 'instance_id', None)
+        if instance_id is None:
+            return True
+        self.records[instance_id].append(record)
+        return False
+
+    def replay(self, instance_ids):
+        for instance_id in instance_ids:
+            for record in self.records.pop(instance_id, []):
+                logging.getLogger(record.name).handle(record)
+
+
 class Instance(PlainInstance):
     sectiongroupname = 'vb-instance'
+    medium_checksum_keys = (
+        'medium_checksum', 'medium_sha1', 'medium_sha256', 'medium_blake2b')
 
     @lazy
     def _vmbasefolder(self):
         folder = self.config.get('basefolder')
         if folder is None:
             folder = self.master.master_config.get('basefolder')
+        if folder is None:
+            folder = self.vb_master.master_config.get('basefolder')
         if folder is None:
             folder = self.vb.list_systemproperties().get('Default machine folder')
         if folder is None:
@@ -44,29 +125,24 @@ class Instance(PlainInstance):
     def _vmfolder(self):
         return os.path.join(self._vmbasefolder, self.id)
 
+    @property
+    def vb_master(self):
+        """The master of the host this VM runs on.
+
+        This is the master of the instance, except for pools, where it's
+        the member the VM was placed on.
+        """
+        return self.master.placement(self)
+
     @property
     def vb(self):
-        return self.master.vb
+        return self.vb_master.vb
 
-    def _vminfo(self, group=None, namekey=None):
-        info = self.vb.showvminfo(self.id)
+    def _vminfo(self, group=None, namekey=None, refresh=False):
+        info = self.vb.showvminfo(self.id, refresh=refresh)
         if group is None:
             return info
-        result = {}
-        matcher = re.compile(r'%s(\D*)(\d+)' % group)
-        for key, value in info.items():
-            m = matcher.match(key)
-            if m:
-                name, index = m.groups()
-                d = result.setdefault(index, {})
-                d[name] = value
-                if name == 'name':
-                    result[value] = d
-        if namekey:
-            for key in list(result):
-                if key != result[key][namekey]:
-                    del result[key]
-        return result
+        return info.group(group, namekey=namekey)
 
     @property
     def _vmacpi(self):
@@ -77,6 +153,13 @@ class Instance(PlainInstance):
             acpi = self._vminfo().get('acpi', '').lower() == 'on'
         return acpi
 
+    @property
+    def _vmbatch(self):
+        batch = self.master.master_config.get('batch-commands')
+        if batch is None:
+            batch = getattr(self.vb_master, 'instance', None) is not None
+        return batch
+
     @property
     def _vmheadless(self):
         acpi = self.config.get('headless')
@@ -84,6 +167,13 @@ class Instance(PlainInstance):
             acpi = self.master.master_config.get('headless', False)
         return acpi
 
+    @property
+    def _vmstoptimeout(self):
+        timeout = self.config.get('stop-timeout')
+        if timeout is None:
+            timeout = self.master.master_config.get('stop-timeout', 60)
+        return timeout
+
     def _status(self, vms=None):
         if vms is None:
             vms = self.vb.list('vms')
@@ -91,7 +181,7 @@ class Instance(PlainInstance):
             return 'unavailable'
         for retry in (True, False):
             try:
-                status = self._vminfo()['VMState']
+                status = self._vminfo(refresh=True).state
                 break
             except subprocess.CalledProcessError as e:
                 if retry:
@@ -99,6 +189,9 @@ class Instance(PlainInstance):
                 else:
                     log.error("Couldn't get status of '%s':\n%s" % (self.config_id, e))
                     sys.exit(1)
+        return self._status_from_state(status)
+
+    def _status_from_state(self, status):
         if status in ('running', 'stopping'):
             return 'running'
         elif status == 'poweroff':
@@ -115,9 +208,7 @@ class Instance(PlainInstance):
 
     def _get_forwarding_info(self):
         result = {}
-        for key, value in self._vminfo().items():
-            if not key.startswith('Forwarding'):
-                continue
+        for value in self._vminfo().forwardings:
             if 'ssh' not in value:
                 continue
             names = ('name', 'proto', 'hostip', 'hostport', 'guestip', 'guestport')
@@ -137,17 +228,47 @@ class Instance(PlainInstance):
         return self._get_forwarding_info().get('hostport', 22)
 
     def init_ssh_key(self, user=None):
-        mi = getattr(self.master, 'instance', None)
+        mi = getattr(self.vb_master, 'instance', None)
         if mi is not None and 'proxyhost' not in self.config:
-            self.config['proxyhost'] = self.master.id
+            self.config['proxyhost'] = self.vb_master.id
         if mi is not None and 'proxycommand' not in self.config:
             self.config['proxycommand'] = self.proxycommand_with_instance(mi)
         return PlainInstance.init_ssh_key(self, user=user)
 
-    def status(self):
-        vms = self.vb.list('vms')
+    def _bulk_status(self, vms):
+        """Return the status and a list of ``(nictype, ip)`` tuples from the
+        ``list --long vms`` result ``vms``.
+
+        The guest properties are only enumerated for running VMs with
+        interfaces which can have a reachable IP.
+        """
+        vm = vms.get(self.id)
+        if vm is None:
+            return ('unavailable', [])
+        status = self._status_from_state(vm['state'])
+        nics = [
+            (int(ifnum), nictype) for ifnum, nictype in vm['nics'].items()
+            if nictype not in ('none', 'nat')]
+        if status != 'running' or not nics:
+            return (status, [])
+        gp = self.vb.guestproperty('enumerate', self.id)
+        ips = []
+        for ifnum, nictype in sorted(nics):
+            ip = gp.get('/VirtualBox/GuestInfo/Net/%s/V4/IP' % (ifnum - 1), {}).get('value')
+            if ip:
+                ips.append((nictype, ip))
+        return (status, ips)
+
+    def status(self, vms=None):
+        """Log the status and IPs of the instance.
+
+        ``vms`` is a ``list --long vms`` listing shared by fleet operations,
+        without it the current state is listed.
+        """
+        if vms is None:
+            vms = self.vb.list_vms_long(refresh=True)
         try:
-            status = self._status(vms)
+            (status, ips) = self._bulk_status(vms)
         except VirtualBoxError as e:
             log.error(e)
             return
@@ -157,15 +278,8 @@ class Instance(PlainInstance):
         if status != 'running':
             log.info("Instance state: %s", status)
             return
-        gp = self.vb.guestproperty('enumerate', self.id)
-        for ifnum, ifinfo in self._vminfo(group='nic').items():
-            ifindex = int(ifnum) - 1
-            if ifinfo[''] in ('none', 'nat'):
-                continue
-            ip = gp.get('/VirtualBox/GuestInfo/Net/%s/V4/IP' % ifindex, {}).get('value')
-            if not ip:
-                continue
-            log.info("IP for %s interface: %s" % (ifinfo[''], ip))
+        for nictype, ip in ips:
+            log.info("IP for %s interface: %s" % (nictype, ip))
         log.info("Instance running.")
 
     def stop(self):
@@ -181,22 +295,77 @@ class Instance(PlainInstance):
         if self._vmacpi:
             log.info('Trying to stop instance with ACPI:')
             self.vb.controlvm(self.id, 'acpipowerbutton')
-            count = 60
-            while count > 0:
-                status = self._status()
-                sys.stdout.write('%3d\r' % count)
-                sys.stdout.flush()
-                time.sleep(1)
-                count -= 1
-                if status == 'stopped':
-                    print
-                    log.info("Instance stopped")
-                    return
-        print
+            state = self.vb.wait_for_state(
+                self.id, ('poweroff',), timeout=self._vmstoptimeout)
+            if state is not None:
+                log.info("Instance stopped")
+                return
         log.info("Stopping instance by sending 'poweroff'.")
         self.vb.controlvm(self.id, 'poweroff')
         log.info("Instance stopped")
 
+    def suspend(self):
+        status = self._status()
+        if status == 'unavailable':
+            log.info("Instance '%s' unavailable", self.id)
+            return
+        if status != 'running':
+            log.info("Instance state: %s", status)
+            log.info("Instance not suspended")
+            return
+        log.info("Saving state of instance '%s'", self.id)
+        try:
+            self.vb.controlvm(self.id, 'savestate')
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to save state of VM '%s':\n%s" % (self.id, e))
+            sys.exit(1)
+        log.info("Instance suspended")
+
+    @property
+    def snapshots(self):
+        """The names of the snapshots of the VM."""
+        return self._vminfo().snapshots
+
+    def snapshot(self, action, name=None, live=False):
+        """Take, restore, delete or list snapshots of the VM.
+
+        For ``list`` the names of the snapshots are returned. A snapshot
+        taken with ``live`` from a running VM contains the memory, so
+        restoring it resumes the VM instead of booting it.
+        """
+        status = self._status()
+        if status == 'unavailable':
+            log.error("Instance '%s' unavailable", self.id)
+            sys.exit(1)
+        if action == 'list':
+            current = self._vminfo().get('CurrentSnapshotName')
+            snapshots = self.snapshots
+            for snapshot in snapshots:
+                log.info("%s%s", snapshot, " (current)" if snapshot == current else "")
+            return snapshots
+        if name is None:
+            log.error("A snapshot name is required to %s a snapshot." % action)
+            sys.exit(1)
+        args = [self.id, action, name]
+        if action == 'take':
+            if live:
+                args.append('--live')
+            log.info("Taking snapshot '%s' of instance '%s'", name, self.id)
+        elif action == 'restore':
+            if status == 'running':
+                log.error("Instance '%s' has to be stopped to restore a snapshot." % self.id)
+                sys.exit(1)
+            log.info("Restoring snapshot '%s' of instance '%s'", name, self.id)
+        elif action == 'delete':
+            log.info("Deleting snapshot '%s' of instance '%s'", name, self.id)
+        else:
+            raise ValueError("Unknown snapshot action '%s'." % action)
+        try:
+            self.vb.snapshot(*args)
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to %s snapshot '%s' of VM '%s':\n%s" % (action, name, self.id, e))
+            sys.exit(1)
+
     def terminate(self):
         status = self._status()
         if self.config.get('no-terminate', False):
@@ -210,72 +379,242 @@ class Instance(PlainInstance):
             self.vb.controlvm(self.id, 'poweroff')
         if status not in ('stopped', 'saved', 'aborted'):
             log.info('Waiting for instance to stop')
-            while status != 'stopped':
-                status = self._status()
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                time.sleep(1)
-            print
-        for index, args_dict in enumerate(self._get_storages(self.config)):
-            if 'medium' in args_dict:
-                medium = args_dict['medium']
-                if isinstance(medium, Disk):
-                    if not medium.delete:
-                        storagectls = self._vminfo(group='storagecontroller', namekey='name')
-                        if 'storagectl' not in args_dict:
-                            if len(storagectls) == 1:
-                                args_dict['storagectl'] = list(storagectls.keys())[0]
-                            else:
-                                log.error("You have to select the controller for storage '%s' on VM '%s'." % (index, self.id))
-                                sys.exit(1)
-                        if 'port' not in args_dict:
-                            args_dict['port'] = str(index)
-                        args_dict['medium'] = 'none'
-                        try:
-                            self.vb.storageattach(self.id, **args_dict)
-                        except subprocess.CalledProcessError as e:
-                            log.error("Failed to deattach storage #%s from VM '%s':\n%s" % (index + 1, self.id, e))
-                            sys.exit(1)
+            state = self.vb.wait_for_state(
+                self.id, ('poweroff',), timeout=self._vmstoptimeout)
+            if state is None:
+                log.error("Instance '%s' didn't stop within %s seconds." % (self.id, self._vmstoptimeout))
+                sys.exit(1)
+        self._detach_kept_disks()
         log.info("Terminating instance '%s'", self.id)
         self.vb.unregistervm(self.id, '--delete')
+        self.master.forget_placement(self)
         log.info("Instance terminated")
 
-    def _get_modifyvm_args(self, config, create):
+    def _detach_kept_disks(self):
+        """Detach the disks which are configured not to be deleted, so
+        ``unregistervm --delete`` leaves them alone."""
+        # the controllers are looked up once, as each detach invalidates
+        # the cached VM info
+        storagectls = None
+        pending = []
+        with self.vb.batch(self._vmbatch) as batch:
+            for index, args_dict in enumerate(self._get_storages(self.config)):
+                medium = args_dict.get('medium')
+                if not isinstance(medium, Disk) or medium.delete:
+                    continue
+                if storagectls is None:
+                    storagectls = self._vminfo(group='storagecontroller', namekey='name')
+                if 'storagectl' not in args_dict:
+                    if len(storagectls) == 1:
+                        args_dict['storagectl'] = list(storagectls.keys())[0]
+                    else:
+                        log.error("You have to select the controller for storage '%s' on VM '%s'." % (index, self.id))
+                        sys.exit(1)
+                if 'port' not in args_dict:
+                    args_dict['port'] = str(index)
+                args_dict['medium'] = 'none'
+                pending.append((batch.storageattach(self.id, **args_dict), index))
+        for result, index in pending:
+            try:
+                result.get()
+            except subprocess.CalledProcessError as e:
+                log.error("Failed to deattach storage #%s from VM '%s':\n%s" % (index + 1, self.id, e))
+                sys.exit(1)
+
+    def _get_natpf_args(self, key, value, forwardings):
+        name = value.split(',', 1)[0]
+        current = forwardings.get(name)
+        if current == value:
+            return []
+        args = []
+        if current is not None:
+            args.extend(("--%s" % key, 'delete', name))
+        args.extend(("--%s" % key, value))
+        return args
+
+    def _get_modifyvm_args(self, config, info):
+        """Return the ``modifyvm`` arguments for the ``vm-`` options which
+        differ from the settings in ``info``.
+
+        NAT port forwardings are compared by rule name, a changed rule is
+        deleted and added again. ``showvminfo`` reports the OS type by its
+        description and uart addresses in another notation, so those are
+        normalized first.
+        """
+        from ploy_virtualbox.vbox import parse_uart
+
+        forwardings = dict(
+            (x.split(',', 1)[0], x) for x in info.forwardings)
         args = []
         for config_key, value in sorted(config.items()):
             if not config_key.startswith('vm-'):
                 continue
             key = config_key[3:]
-            if not create and key.startswith(('natpf', 'hostonlyadapter')):
+            if key.startswith('natpf'):
+                args.extend(self._get_natpf_args(key, value, forwardings))
                 continue
-            if key.startswith('hostonlyadapter'):
-                hostonlyif = self.master.hostonlyifs[value]
-                hostonlyif.ensure(self)
             if key.startswith('uartmode'):
                 if value == 'disconnected':
-                    pass
+                    values = []
                 elif value.startswith(('server ', 'client ', 'file ')):
                     value = value.split(None, 1)
-                    args.extend(("--%s" % key, value[0], expand_path(value[1], config.get_path(config_key))))
+                    values = [value[0], expand_path(value[1], config.get_path(config_key))]
                 else:
-                    args.extend(("--%s" % key, expand_path(value, config.get_path(config_key))))
+                    values = [expand_path(value, config.get_path(config_key))]
             elif key.startswith('uart') and value != 'off':
-                value = value.split()
-                args.append("--%s" % key)
-                args.extend(value)
+                values = value.split()
             else:
-                args.extend(("--%s" % key, value))
+                values = [value]
+            current = info.get(key, '')
+            if not values or ','.join(values).lower() == current.lower():
+                continue
+            if key == 'ostype' and self.vb.ostypes.get(value, '').lower() == current.lower():
+                continue
+            if key.startswith('uart') and not key.startswith('uartmode'):
+                uart = parse_uart(','.join(values))
+                if uart is not None and uart == parse_uart(current):
+                    continue
+            args.append("--%s" % key)
+            args.extend(values)
         return args
 
+    def _plan(self, config, storages, info):
+        """Return the host only interfaces and the actions needed to make
+        the VM described by ``info`` match ``config``.
+
+        Only settings which differ are modified, existing controllers are
+        kept and media which are already attached at their port are
+        skipped.
+        """
+        from ploy_virtualbox.plan import Action
+
+        actions = []
+        args = self._get_modifyvm_args(config, info)
+        hostonlyifs = [
+            args[index + 1] for index, arg in enumerate(args)
+            if arg.startswith('--hostonlyadapter')]
+        if args:
+            actions.append(Action(
+                ('modifyvm', self.id) + tuple(args),
+                error="Failed to modify VM '%s'" % self.id))
+        storagectls = list(info.group('storagecontroller', namekey='name'))
+        for key, value in config.items():
+            if not key.startswith('storagectl-'):
+                continue
+            name = key[11:]
+            if name in storagectls:
+                continue
+            actions.append(Action(
+                ('storagectl', self.id, '--name', name) + tuple(shlex.split(value)),
+                error="Failed to create storage controller '%s' for VM '%s'" % (name, self.id)))
+            storagectls.append(name)
+        if storages and not storagectls:
+            actions.append(Action(
+                ('storagectl', self.id, '--name', 'sata', '--add', 'sata'),
+                error="Failed to create default storage controller for VM '%s'" % self.id,
+                message="Adding default 'sata' controller."))
+            storagectls.append('sata')
+        for index, args_dict in enumerate(storages):
+            if 'storagectl' not in args_dict:
+                if len(storagectls) == 1:
+                    args_dict['storagectl'] = storagectls[0]
+                else:
+                    log.error("You have to select the controller for storage '%s' on VM '%s'." % (index, self.id))
+                    sys.exit(1)
+            if 'port' not in args_dict:
+                args_dict['port'] = str(index)
+            attachment = "%s-%s-%s" % (
+                args_dict['storagectl'], args_dict['port'], args_dict.get('device', '0'))
+            attached = info.get(attachment, 'none')
+            if args_dict.get('medium') == attached:
+                continue
+            if args_dict['type'] == 'hdd' and self._is_child_of(attached, args_dict.get('medium'), info):
+                continue
+            actions.append(Action(
+                ('storageattach', self.id), args_dict,
+                error="Failed to attach storage #%s to VM '%s'" % (index + 1, self.id)))
+        return (hostonlyifs, actions)
+
+    def _is_child_of(self, attached, medium, info):
+        """Return whether the ``attached`` medium is a differencing disk
+        of ``medium``.
+
+        That's the case for templates and for VMs with snapshots, attaching
+        ``medium`` again would drop the differencing disk. A ``medium``
+        which doesn't exist yet, like a template which isn't baked, has no
+        children.
+        """
+        folder = info.get('SnapFldr')
+        if not folder or not attached.startswith(folder) or medium in (None, 'none'):
+            return False
+        try:
+            parent = self.vb.showmediuminfo('disk', medium).get('UUID')
+            seen = set()
+            while attached not in seen:
+                seen.add(attached)
+                attached = self.vb.showmediuminfo('disk', attached).get('Parent UUID')
+                if attached == parent:
+                    return True
+                if attached in (None, 'base'):
+                    break
+        except subprocess.CalledProcessError:
+            pass
+        return False
+
+    def _get_startvm_kw(self, config):
+        kw = {}
+        if config.get('headless', self._vmheadless):
+            kw['type'] = 'headless'
+        return kw
+
     def _start(self, config):
         try:
-            kw = {}
-            if config.get('headless', self._vmheadless):
-                kw['type'] = 'headless'
-            self.vb.startvm(self.id, **kw)
+            self.vb.startvm(self.id, **self._get_startvm_kw(config))
         except subprocess.CalledProcessError as e:
             log.error("Failed to start VM '%s':\n%s" % (self.id, e))
             sys.exit(1)
+        self._wait_for_guest(config)
+
+    def _wait_for_guest(self, config):
+        wait_for = config.get('wait-for')
+        if wait_for is None:
+            return
+        if wait_for == 'ip':
+            pattern = '/VirtualBox/GuestInfo/Net/*/V4/IP'
+        else:
+            pattern = wait_for
+        timeout = config.get('wait-timeout')
+        if timeout is None:
+            timeout = self.master.master_config.get('wait-timeout', 300)
+        log.info("Waiting for guest property '%s'", pattern)
+        result = self.vb.wait_for_guestproperty(self.id, pattern, timeout=timeout)
+        if result is None:
+            log.error("Instance '%s' didn't set guest property '%s' within %s seconds." % (self.id, pattern, timeout))
+            sys.exit(1)
+        log.info("Guest property '%s' is '%s'", *result)
+
+    def _get_medium_checksum(self, args_dict):
+        from ploy_virtualbox.download import parse_checksum
+
+        checksums = []
+        for key in self.medium_checksum_keys:
+            if key in args_dict:
+                checksums.append((key, args_dict.pop(key)))
+        if not checksums:
+            return None
+        if len(checksums) > 1:
+            log.error("Only one of %s allowed for a medium in [%s]." % (
+                ', '.join("--%s" % x[0] for x in checksums), self.config_id))
+            sys.exit(1)
+        ((key, value),) = checksums
+        algorithm = None
+        if key != 'medium_checksum':
+            algorithm = key[7:]
+        try:
+            return parse_checksum(value, algorithm)
+        except ValueError as e:
+            log.error("Invalid --%s in [%s]: %s" % (key, self.config_id, e))
+            sys.exit(1)
 
     def _get_storages(self, config):
         storages = list(filter(None, config.get('storage', '').splitlines()))
@@ -289,7 +628,7 @@ class Instance(PlainInstance):
                 medium = args_dict['medium']
                 medium_url = urlparse(medium)
                 if medium_url.netloc:
-                    medium = (medium_url, args_dict.pop('medium_sha1', None))
+                    medium = (medium_url, self._get_medium_checksum(args_dict))
                 elif '.' in medium:
                     medium = expand_path(medium, config.get_path('storage'))
                 elif medium.startswith('vb-disk:'):
@@ -298,132 +637,211 @@ class Instance(PlainInstance):
                     except KeyError:
                         log.error("Couldn't find [vb-disk:%s] section referenced by [%s]." % (medium[8:], self.config_id))
                         sys.exit(1)
+                elif medium.startswith('vb-template:'):
+                    try:
+                        medium = self.master.templates[medium[12:]]
+                    except KeyError:
+                        log.error("Couldn't find [vb-template:%s] section referenced by [%s]." % (medium[12:], self.config_id))
+                        sys.exit(1)
                 args_dict['medium'] = medium
             if 'type' not in args_dict:
                 args_dict['type'] = 'hdd'
             result.append(args_dict)
         return result
 
+    def _get_createvm_args(self, config):
+        return (
+            '--name', self.id, '--basefolder', self._vmbasefolder,
+            '--ostype', config.get('vm-ostype', 'Other'), '--register')
+
+    def _get_clonevm_args(self, config):
+        base = config['clone-from']
+        snapshot = config.get('clone-snapshot')
+        if snapshot is None:
+            try:
+                info = self.vb.showvminfo(base)
+            except subprocess.CalledProcessError as e:
+                log.error("Failed to get info of base VM '%s' for '%s':\n%s" % (base, self.id, e))
+                sys.exit(1)
+            snapshot = info.get('CurrentSnapshotName')
+            if snapshot is None:
+                log.error(
+                    "The base VM '%s' for '%s' has no snapshot to create a linked clone from. "
+                    "Take one with 'VBoxManage snapshot %s take NAME' or set 'clone-snapshot'." % (
+                        base, self.id, base))
+                sys.exit(1)
+        return (
+            base, '--snapshot', snapshot, '--options', 'link',
+            '--name', self.id, '--basefolder', self._vmbasefolder,
+            '--register')
+
+    def _clone(self, config):
+        args = self._get_clonevm_args(config)
+        (base, snapshot) = (args[0], args[2])
+        log.info("Creating instance '%s' as linked clone of '%s' snapshot '%s'", self.id, base, snapshot)
+        try:
+            # cloning locks the base VM, so concurrent clones would fail
+            with self.vb_master.clone_lock:
+                self.vb.clonevm(*args)
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to clone VM '%s' from '%s':\n%s" % (self.id, base, e))
+            sys.exit(1)
+
     def start(self, overrides=None):
         config = self.get_config(overrides)
         status = self._status()
-        create = False
         if status == 'unavailable':
-            create = True
-            log.info("Creating instance '%s'", self.id)
-            try:
-                self.vb.createvm(
-                    '--name', self.id, '--basefolder', self._vmbasefolder,
-                    '--ostype', config.get('vm-ostype', 'Other'), '--register')
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to create VM '%s':\n%s" % (self.id, e))
-                sys.exit(1)
+            if 'clone-from' in config:
+                self._clone(config)
+            else:
+                log.info("Creating instance '%s'", self.id)
+                try:
+                    self.vb.createvm(*self._get_createvm_args(config))
+                except subprocess.CalledProcessError as e:
+                    log.error("Failed to create VM '%s':\n%s" % (self.id, e))
+                    sys.exit(1)
+            self.master.remember_placement(self)
             status = self._status()
         if status not in ('stopped', 'saved', 'aborted'):
             log.info("Instance state: %s", status)
             log.info("Instance already started")
             return True
+        snapshot = config.get('restore-snapshot')
+        if snapshot is not None:
+            if snapshot in self.snapshots:
+                self.snapshot('restore', snapshot)
+                status = self._status()
+            else:
+                log.info("Snapshot '%s' not found, starting normally.", snapshot)
         if status == 'saved':
             self._start(config)
             return
-        # modify vm
-        args = self._get_modifyvm_args(config, create)
-        if args:
-            try:
-                self.vb.modifyvm(self.id, *args)
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to modify VM '%s':\n%s\n%s" % (self.id, e, e.output))
-                sys.exit(1)
-        # storagectl
-        storagectls = self._vminfo(group='storagecontroller', namekey='name')
-        for key, value in config.items():
-            if not key.startswith('storagectl-'):
-                continue
-            name = key[11:]
-            args = shlex.split(value)
-            if name in storagectls:
-                continue
-            try:
-                self.vb.storagectl(self.id, '--name', name, *args)
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to create storage controller '%s' for VM '%s':\n%s" % (name, self.id, e))
-                sys.exit(1)
-        storagectls = self._vminfo(group='storagecontroller', namekey='name')
-        # storageattach
+        from ploy_virtualbox.plan import apply
+
         storages = self._get_storages(config)
-        if storages and not storagectls:
-            log.info("Adding default 'sata' controller.")
-            try:
-                self.vb.storagectl(self.id, '--name', 'sata', '--add', 'sata')
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to create default storage controller for VM '%s':\n%s" % (self.id, e))
-                sys.exit(1)
-            storagectls = self._vminfo(group='storagecontroller', namekey='name')
-        for index, args_dict in enumerate(storages):
-            if 'medium' in args_dict:
-                medium = args_dict['medium']
-                if isinstance(medium, tuple):
-                    medium = self.download_remote(*medium)
-                elif isinstance(medium, Disk):
-                    medium = medium.filename(self)
-                args_dict['medium'] = medium
-            if 'storagectl' not in args_dict:
-                if len(storagectls) == 1:
-                    args_dict['storagectl'] = list(storagectls.keys())[0]
-                else:
-                    log.error("You have to select the controller for storage '%s' on VM '%s'." % (index, self.id))
-                    sys.exit(1)
-            if 'port' not in args_dict:
-                args_dict['port'] = str(index)
-            try:
-                self.vb.storageattach(self.id, **args_dict)
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to attach storage #%s to VM '%s':\n%s" % (index + 1, self.id, e))
-                sys.exit(1)
+        self._resolve_media(storages)
+        (hostonlyifs, actions) = self._plan(config, storages, self._vminfo())
+        if hostonlyifs:
+            self.vb_master.networks.ensure(hostonlyifs)
+        apply(self.vb, actions, batch=self._vmbatch)
         log.info("Starting instance '%s'" % self.config_id)
         self._start(config)
         log.info("Instance started")
 
-    def download_remote(self, url, sha_checksum=None):
+    def plan(self, overrides=None):
+        """Return the actions ``start`` would run, without changing anything.
 
-        def check(path, sha):
-            d = hashlib.sha1()
-            with open(path, 'rb') as f:
-                while 1:
-                    buf = f.read(1024 * 1024)
-                    if not len(buf):
-                        break
-                    d.update(buf)
-            return d.hexdigest() == sha
+        Remote media aren't downloaded and disks aren't created, the
+        actions refer to them by URL and filename instead.
+        """
+        from ploy_virtualbox.plan import Action
+        from ploy_virtualbox.vbox import VMInfo
 
-        download_dir = os.path.expanduser(self.master.main_config.get('global', dict()).get(
-            'download_dir', '~/.ploy/downloads'))
-
-        if not os.path.exists(download_dir):
-            os.makedirs(download_dir, mode=0o750)
-
-        path, filename = os.path.split(url.path)
-        local_path = os.path.join(download_dir, filename)
-
-        if sha_checksum is None:
+        config = self.get_config(overrides)
+        status = self._status()
+        actions = []
+        if status == 'unavailable':
+            if 'clone-from' in config:
+                actions.append(Action(('clonevm',) + self._get_clonevm_args(config)))
+                info = self.vb.showvminfo(config['clone-from'])
+            else:
+                actions.append(Action(('createvm',) + self._get_createvm_args(config)))
+                info = VMInfo()
+        elif status not in ('stopped', 'saved', 'aborted'):
+            log.info("Instance '%s' is already started.", self.config_id)
+            return actions
+        else:
+            info = self._vminfo()
+            snapshot = config.get('restore-snapshot')
+            if snapshot is not None and snapshot in self.snapshots:
+                actions.append(Action(('snapshot', self.id, 'restore', snapshot)))
+                status = 'stopped'
+        if status != 'saved':
+            storages = self._get_storages(config)
+            created = set()
+            for args_dict in storages:
+                medium = args_dict.get('medium')
+                if isinstance(medium, tuple):
+                    args_dict['medium'] = medium[0].geturl()
+                elif isinstance(medium, Disk):
+                    filename = args_dict['medium'] = medium.path(self)
+                    if not os.path.exists(filename) and filename not in created:
+                        actions.append(Action(('createhd',), medium.createhd_kw(filename)))
+                        created.add(filename)
+                elif isinstance(medium, Template):
+                    filename = args_dict['medium'] = medium.path(self)
+                    if not medium.baked(filename) and filename not in created:
+                        base = medium.medium
+                        if isinstance(base, tuple):
+                            base = base[0].geturl()
+                        actions.append(Action(
+                            ('clonemedium', 'disk', base, filename),
+                            dict(format=medium.format)))
+                        actions.append(Action(
+                            ('modifymedium', 'disk', filename),
+                            dict(type=medium.type)))
+                        created.add(filename)
+            (hostonlyifs, vm_actions) = self._plan(config, storages, info)
+            networks = self.vb_master.networks
+            hostonlyifs = sorted(set(hostonlyifs) - networks.ensured)
+            if hostonlyifs:
+                actions.extend(networks.plan(hostonlyifs))
+            actions.extend(vm_actions)
+        actions.append(Action(('startvm', self.id), self._get_startvm_kw(config)))
+        return actions
+
+    def _resolve_media(self, storages):
+        """Replace the remote media, disks and templates in ``storages`` by
+        filenames.
+
+        Downloads, disk creation and template baking run concurrently, so a
+        start has to wait for the slowest medium only. Questions are asked
+        beforehand, as the prompt can't be shared by several threads.
+        """
+        media = []
+        for args_dict in storages:
+            medium = args_dict.get('medium')
+            if isinstance(medium, (tuple, Disk, Template)) and medium not in media:
+                media.append(medium)
+        for medium in media:
+            if isinstance(medium, tuple):
+                self._confirm_checksum(medium[1])
+
+        def resolve(medium):
+            if isinstance(medium, tuple):
+                return self._download(*medium)
+            return medium.filename(self)
+
+        filenames = []
+        for filename, exception in run_concurrently(resolve, media, len(media)):
+            if exception is not None:
+                raise exception
+            filenames.append(filename)
+        resolved = list(zip(media, filenames))
+        for args_dict in storages:
+            for medium, filename in resolved:
+                if args_dict.get('medium') == medium:
+                    args_dict['medium'] = filename
+                    break
+
+    def _confirm_checksum(self, checksum):
+        if checksum is None and not self.master.unverified_media_confirmed:
             if not yesno('No checksum provided! Are you sure you want to boot from an unverified image?'):
                 sys.exit(1)
+            self.master.unverified_media_confirmed = True
 
-        if os.path.exists(local_path):
-            if sha_checksum is None or check(local_path, sha_checksum):
-                return local_path
-            else:
-                log.error('Checksum mismatch for %s!' % local_path)
-                sys.exit(1)
+    def download_remote(self, url, checksum=None):
+        self._confirm_checksum(checksum)
+        return self._download(url, checksum)
 
-        log.info("Downloading remote disk image from %s to %s" % (url.geturl(), local_path))
-        urllib.urlretrieve(url.geturl(), local_path)
-        log.info('Downloaded successfully to %s' % local_path)
-        if sha_checksum is not None and not check(local_path, sha_checksum):
-            log.error('Checksum mismatch!')
-            sys.exit(1)
+    def _download(self, url, checksum):
+        from ploy_virtualbox.download import DownloadError
 
-        return local_path
+        try:
+            return self.master.download_cache.get(url.geturl(), checksum)
+        except DownloadError as e:
+            log.error(e)
+            sys.exit(1)
 
 
 class DHCPServer(object):
@@ -431,23 +849,23 @@ class DHCPServer(object):
         self.name = name
         self.config = config
 
-    def ensure(self, instance):
-        dhcpservers = instance.vb.list('dhcpservers')
-        name = "HostInterfaceNetworking-%s" % self.name
+    @property
+    def netname(self):
+        return "HostInterfaceNetworking-%s" % self.name
+
+    @property
+    def options(self):
         kw = {}
         for key in ('ip', 'netmask', 'lowerip', 'upperip'):
             if key not in self.config:
                 log.error("The '%s' option is required for dhcpserver '%s'." % (key, self.name))
                 sys.exit(1)
             kw[key] = self.config[key]
-        if name not in dhcpservers:
-            try:
-                instance.vb.dhcpserver('add', '--enable', netname=name, **kw)
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to add dhcpserver '%s':\n%s" % (self.name, e))
-                sys.exit(1)
-            log.info("Added dhcpserver '%s'." % self.name)
-        dhcpserver = instance.vb.list('dhcpservers')[name]
+        return kw
+
+    def matches(self, dhcpserver):
+        """Log the settings of the existing ``dhcpserver`` which differ
+        from the config and return whether all of them match."""
         matches = True
         if 'ip' in self.config:
             if dhcpserver['IP'] != self.config['ip']:
@@ -469,42 +887,106 @@ class DHCPServer(object):
                 log.error("The host only interface '%s' has a upper IP '%s' that doesn't match the config '%s'." % (
                     self.name, dhcpserver['upperIPAddress'], self.config['upper-ip']))
                 matches = False
-        if not matches:
-            if not yesno("Should the dhcpserver '%s' be modified to match the config?" % self.name):
-                sys.exit(1)
-            try:
-                instance.vb.dhcpserver('modify', '--enable', netname=name, **kw)
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to modify dhcpserver '%s':\n%s" % (self.name, e))
-                sys.exit(1)
+        return matches
 
 
 class Disk(object):
+    # formats ``convert`` looks for existing files in
+    formats = ('VDI', 'VMDK', 'VHD')
+
     def __init__(self, name, config):
         self.name = name
         self.config = config
 
-    def filename(self, instance):
+    def path(self, instance, format=None):
+        if format is None:
+            format = self.format
         filename = self.config.get('filename')
         if filename is None:
             filename = self.name
-        ext = ".%s" % self.format.lower()
+        ext = ".%s" % format.lower()
         if not filename.endswith(ext):
             filename = filename + ext
-        filename = expand_path(filename, instance._vmfolder)
+        return expand_path(filename, instance._vmfolder)
+
+    def createhd_kw(self, filename):
+        kw = dict(filename=filename, format=self.format)
+        if self.size:
+            kw['size'] = self.size
+        if self.variant:
+            kw['variant'] = self.variant
+        return kw
+
+    def filename(self, instance):
+        filename = self.path(instance)
         if not os.path.exists(filename):
-            kw = {}
-            if self.size:
-                kw['size'] = self.size
-            if self.variant:
-                kw['variant'] = self.variant
             try:
-                instance.vb.createhd(filename=filename, format=self.format, **kw)
+                instance.vb.createhd(**self.createhd_kw(filename))
             except subprocess.CalledProcessError as e:
                 log.error("Failed to create disk '%s' at '%s':\n%s" % (self.name, filename, e))
                 sys.exit(1)
         return filename
 
+    def info(self, instance):
+        """Return the ``showmediuminfo`` of the disk of ``instance``, with
+        the virtual ``capacity`` and the ``size`` on disk in bytes."""
+        from ploy_virtualbox.vbox import parse_medium_size
+
+        filename = self.path(instance)
+        try:
+            info = instance.vb.showmediuminfo('disk', filename)
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to get info of disk '%s' at '%s':\n%s" % (self.name, filename, e))
+            sys.exit(1)
+        # older versions of VirtualBox use other names
+        info['capacity'] = parse_medium_size(
+            info.get('Capacity', info.get('Logical size')))
+        info['size'] = parse_medium_size(
+            info.get('Size on disk', info.get('Current size on disk')))
+        return info
+
+    def compact(self, instance):
+        filename = self.path(instance)
+        try:
+            instance.vb.modifymedium('disk', filename, '--compact')
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to compact disk '%s' at '%s':\n%s" % (self.name, filename, e))
+            sys.exit(1)
+
+    def resize(self, instance, size):
+        filename = self.path(instance)
+        try:
+            instance.vb.modifymedium('disk', filename, resize=size)
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to resize disk '%s' at '%s':\n%s" % (self.name, filename, e))
+            sys.exit(1)
+
+    def convert(self, instance):
+        """Copy an existing file of the disk in another format to the
+        configured ``format``.
+
+        Returns the converted file, which is kept. Starting the instance
+        attaches the new file instead.
+        """
+        filename = self.path(instance)
+        if os.path.exists(filename):
+            return None
+        sources = [
+            self.path(instance, format=x) for x in self.formats
+            if x != self.format.upper()]
+        sources = [x for x in sources if os.path.exists(x)]
+        if not sources:
+            return None
+        kw = dict(format=self.format)
+        if self.variant:
+            kw['variant'] = self.variant
+        try:
+            instance.vb.clonemedium('disk', sources[0], filename, **kw)
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to convert disk '%s' to '%s':\n%s" % (self.name, filename, e))
+            sys.exit(1)
+        return sources[0]
+
     @property
     def delete(self):
         return self.config.get('delete', True)
@@ -525,55 +1007,261 @@ class Disk(object):
         return self.config.get('variant')
 
 
+class Template(object):
+    """A base image baked into a ``multiattach`` or ``immutable`` medium.
+
+    The baked medium is stored under a hash of the base image, the
+    provisioning commands, the format and the type, so a change to any of
+    them bakes a new one. VMs attach it as parent of a differencing disk.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.lock = threading.RLock()
+        self._filenames = {}
+
+    @property
+    def format(self):
+        return self.config.get('format', 'VDI')
+
+    @property
+    def type(self):
+        mtype = self.config.get('type', 'multiattach')
+        if mtype not in ('multiattach', 'immutable'):
+            log.error("The type of vb-template '%s' has to be 'multiattach' or 'immutable'." % self.name)
+            sys.exit(1)
+        return mtype
+
+    @property
+    def provision(self):
+        return list(filter(None, self.config.get('provision', '').splitlines()))
+
+    @property
+    def medium(self):
+        """The base image as local path or as ``(url, checksum)`` tuple."""
+        from ploy_virtualbox.download import parse_checksum
+
+        if 'medium' not in self.config:
+            log.error("You have to provide a medium for vb-template '%s'." % self.name)
+            sys.exit(1)
+        medium = self.config['medium']
+        url = urlparse(medium)
+        if not url.netloc:
+            return expand_path(medium, self.config.get_path('medium'))
+        for key in Instance.medium_checksum_keys:
+            if key in self.config:
+                algorithm = None
+                if key != 'medium_checksum':
+                    algorithm = key[7:]
+                try:
+                    return (url, parse_checksum(self.config[key], algorithm))
+                except ValueError as e:
+                    log.error("Invalid %s in [vb-template:%s]: %s" % (key, self.name, e))
+                    sys.exit(1)
+        log.error("A checksum is required for the remote medium of vb-template '%s'." % self.name)
+        sys.exit(1)
+
+    def _check_local(self, instance):
+        # hashing, the baked marker and provisioning run on this machine,
+        # so VirtualBox has to run here as well
+        master = instance.master
+        if isinstance(master, PoolMaster) or getattr(master, 'instance', None) is not None:
+            log.error(
+                "The vb-template '%s' used by '%s' is only supported for local masters, not for '%s'." % (
+                    self.name, instance.config_id, master.id))
+            sys.exit(1)
+
+    def path(self, instance):
+        """Return the filename of the baked medium, without baking it."""
+        from ploy_virtualbox.download import DigestMemo
+
+        self._check_local(instance)
+        medium = self.medium
+        if isinstance(medium, tuple):
+            digest = "%s:%s" % medium[1]
+        else:
+            # the base image may be in a directory we can't write to
+            name = hashlib.sha1(os.path.abspath(medium).encode('utf-8')).hexdigest()
+            memo_path = os.path.join(instance.master.cache_dir, 'digests', name)
+            digest = "sha256:%s" % DigestMemo(medium, memo_path).digest('sha256')
+        inputs = dict(
+            medium=digest, provision=self.provision,
+            format=self.format, type=self.type)
+        key = hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+        directory = self.config.get('directory')
+        if directory is None:
+            directory = os.path.join(instance.master.cache_dir, 'templates')
+        return os.path.join(directory, "%s-%s.%s" % (
+            self.name, key[:16], self.format.lower()))
+
+    def baked(self, filename):
+        return os.path.exists("%s.json" % filename)
+
+    def filename(self, instance):
+        # concurrent starts of instances using the template bake it once
+        # per master
+        with self.lock:
+            master = instance.vb_master
+            if master not in self._filenames:
+                filename = self.path(instance)
+                if not self.baked(filename):
+                    self._bake(instance, filename)
+                self._set_type(instance, filename)
+                self._filenames[master] = filename
+            return self._filenames[master]
+
+    def _bake(self, instance, filename):
+        vb = instance.vb
+        if os.path.exists(filename):
+            log.info("Removing incomplete template '%s' at '%s'.", self.name, filename)
+            try:
+                vb.closemedium('disk', filename, '--delete')
+            except subprocess.CalledProcessError:
+                os.remove(filename)
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        medium = self.medium
+        if isinstance(medium, tuple):
+            medium = instance._download(*medium)
+        log.info("Baking template '%s' to '%s'.", self.name, filename)
+        try:
+            vb.clonemedium('disk', medium, filename, format=self.format)
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to copy the medium of vb-template '%s':\n%s" % (self.name, e))
+            sys.exit(1)
+        env = dict(os.environ, PLOY_TEMPLATE_MEDIUM=filename)
+        for command in self.provision:
+            log.info("Provisioning template '%s': %s", self.name, command)
+            if subprocess.call(command, shell=True, env=env) != 0:
+                log.error("Provisioning of vb-template '%s' failed: %s" % (self.name, command))
+                sys.exit(1)
+        with open("%s.json" % filename, 'w') as f:
+            json.dump(dict(
+                name=self.name, medium=self.config['medium'],
+                provision=self.provision, type=self.type,
+                baked=time.time()), f, indent=1, sort_keys=True)
+
+    def _set_type(self, instance, filename):
+        info = instance.vb.showmediuminfo('disk', filename)
+        if info.get('Type', '').startswith(self.type):
+            return
+        try:
+            instance.vb.modifymedium('disk', filename, type=self.type)
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to make vb-template '%s' %s:\n%s" % (self.name, self.type, e))
+            sys.exit(1)
+
+
 class HostOnlyIF(object):
     def __init__(self, name, config):
         self.name = name
         self.config = config
 
-    def ensure(self, instance):
-        hostonlyifs = instance.vb.list('hostonlyifs')
-        created = False
-        if self.name not in hostonlyifs:
-            newnames = set("vboxnet%s" % x for x in range(len(hostonlyifs) + 1))
-            newnames = newnames - set(hostonlyifs)
-            nextname = min(newnames)
-            if nextname != self.name:
+
+class Networks(object):
+    """Reconciles the ``vb-hostonlyif`` and ``vb-dhcpserver`` sections with
+    the host of a master.
+
+    The host only interfaces and dhcp servers are listed once per run. The
+    calls needed for all requested interfaces are planned together and then
+    applied, interfaces which were already handled are skipped afterwards.
+    """
+
+    def __init__(self, master):
+        self.master = master
+        self.ensured = set()
+
+    @lazy
+    def hostonlyifs(self):
+        return self.master.vb.list_hostonlyifs()
+
+    @lazy
+    def dhcpservers(self):
+        return self.master.vb.list_dhcpservers()
+
+    def _plan_hostonlyifs(self, names):
+        from ploy_virtualbox.plan import Action
+
+        existing = set(self.hostonlyifs).union(self.ensured)
+        missing = set(names) - existing
+        plan = []
+        # VirtualBox picks the name of new interfaces itself, so we can only
+        # create them if they are the next ones in line
+        while missing:
+            newnames = set("vboxnet%s" % x for x in range(len(existing) + 1))
+            nextname = min(newnames - existing)
+            if nextname not in missing:
                 log.error(
                     "The host only interface '%s' doesn't exist. "
                     "The next one to be created would be '%s'. "
                     "Since this doesn't match, we abort. "
                     "Please fix the config or handle the creation manually." % (
-                        self.name, nextname))
+                        min(missing), nextname))
                 sys.exit(1)
-            try:
-                instance.vb.hostonlyif('create')
-                created = True
-            except subprocess.CalledProcessError as e:
-                log.error("Failed to create host only interface '%s':\n%s" % (self.name, e))
+            missing.remove(nextname)
+            existing.add(nextname)
+            plan.append(Action(
+                ('hostonlyif', 'create'),
+                error="Failed to create host only interface '%s'" % nextname,
+                message="Created host only interface '%s'." % nextname,
+                check_err=False))
+            hostonlyif = self.master.hostonlyifs[nextname]
+            if 'ip' in hostonlyif.config:
+                plan.append(Action(
+                    ('hostonlyif', 'ipconfig', nextname), dict(ip=hostonlyif.config['ip']),
+                    error="Failed to configure host only interface '%s'" % nextname,
+                    check_err=False))
+        for name in names:
+            hostonlyif = self.master.hostonlyifs[name]
+            if name not in self.hostonlyifs or 'ip' not in hostonlyif.config:
+                continue
+            info = self.hostonlyifs[name]
+            if info['IPAddress'] != hostonlyif.config['ip']:
+                log.error("The host only interface '%s' has an IP '%s' that doesn't match the config '%s'." % (
+                    name, info['IPAddress'], hostonlyif.config['ip']))
                 sys.exit(1)
-            log.info("Created host only interface '%s'." % self.name)
-        hostonlyif = instance.vb.list('hostonlyifs')[self.name]
-        if created:
-            kw = {}
-            if 'ip' in self.config:
-                kw['ip'] = self.config['ip']
-            if kw:
-                try:
-                    instance.vb.hostonlyif('ipconfig', self.name, **kw)
-                except subprocess.CalledProcessError as e:
-                    log.error("Failed to configure host only interface '%s':\n%s" % (self.name, e))
-                    sys.exit(1)
-        else:
-            if 'ip' in self.config:
-                if hostonlyif['IPAddress'] != self.config['ip']:
-                    log.error("The host only interface '%s' has an IP '%s' that doesn't match the config '%s'." % (
-                        self.name, hostonlyif['IPAddress'], self.config['ip']))
-                    sys.exit(1)
-        try:
-            dhcpserver = instance.master.dhcpservers[self.name]
-        except KeyError:
-            return
-        dhcpserver.ensure(instance)
+        return plan
+
+    def _plan_dhcpservers(self, names):
+        from ploy_virtualbox.plan import Action
+
+        names = [x for x in names if x in self.master.dhcpservers.config]
+        plan = []
+        for name in names:
+            dhcpserver = self.master.dhcpservers[name]
+            kw = dict(dhcpserver.options, netname=dhcpserver.netname)
+            if dhcpserver.netname not in self.dhcpservers:
+                plan.append(Action(
+                    ('dhcpserver', 'add', '--enable'), kw,
+                    error="Failed to add dhcpserver '%s'" % name,
+                    message="Added dhcpserver '%s'." % name))
+            elif not dhcpserver.matches(self.dhcpservers[dhcpserver.netname]):
+                plan.append(Action(
+                    ('dhcpserver', 'modify', '--enable'), kw,
+                    error="Failed to modify dhcpserver '%s'" % name,
+                    question="Should the dhcpserver '%s' be modified to match the config?" % name))
+        return plan
+
+    def plan(self, names):
+        """Return the actions needed to make the host only interfaces
+        ``names`` and their dhcp servers match the config."""
+        return self._plan_hostonlyifs(names) + self._plan_dhcpservers(names)
+
+    def ensure(self, names):
+        from ploy_virtualbox.plan import apply
+
+        # VirtualBox can't create host only interfaces or dhcp servers
+        # concurrently, so with fleet operations we have to make sure only
+        # one instance at a time handles them
+        with self.master.network_lock:
+            names = sorted(set(names) - self.ensured)
+            if not names:
+                return
+            apply(self.master.vb, self.plan(names))
+            self.ensured.update(names)
 
 
 class InfoBase(object):
@@ -603,19 +1291,211 @@ class HostOnlyIFs(InfoBase):
     klass = HostOnlyIF
 
 
+class Templates(InfoBase):
+    sectiongroupname = 'vb-template'
+    klass = Template
+
+
 class Master(BaseMaster):
     sectiongroupname = 'vb-instance'
     section_info = {
         None: Instance,
         'vb-instance': Instance}
 
+    fleet_operations = ('start', 'status', 'stop', 'suspend', 'terminate')
+
     def __init__(self, *args, **kwargs):
         BaseMaster.__init__(self, *args, **kwargs)
+        self.network_lock = threading.RLock()
+        self.clone_lock = threading.RLock()
+        self.unverified_media_confirmed = False
         if 'instance' in self.master_config:
             self.instance = ProxyInstance(self, self.id, self.master_config, self.master_config['instance'])
             self.instance.sectiongroupname = 'vb-master'
             self.instances[self.id] = self.instance
 
+    @property
+    def vb_members(self):
+        """The masters whose hosts run the VMs of this master."""
+        return [self]
+
+    def placement(self, instance):
+        return self
+
+    def remember_placement(self, instance):
+        pass
+
+    def forget_placement(self, instance):
+        pass
+
+    @property
+    def vb_instances(self):
+        return dict(
+            (k, v) for k, v in self.instances.items()
+            if isinstance(v, Instance))
+
+    def fleet(self, operation, instance_ids=None, workers=None, overrides=None):
+        """Run ``operation`` on several instances concurrently.
+
+        The log output of each instance is held back and written in the
+        order of ``instance_ids`` once all operations are finished. Returns
+        a list of ``(instance_id, exception, duration)`` tuples in the same
+        order, ``exception`` is ``None`` for successful operations.
+        """
+        if operation not in self.fleet_operations:
+            raise ValueError("Unknown fleet operation '%s'." % operation)
+        instances = self.vb_instances
+        if instance_ids is None:
+            instance_ids = sorted(instances)
+        if workers is None:
+            workers = self.master_config.get('fleet-workers', 8)
+        listings = {}
+        for member in self.vb_members:
+            if operation in ('start', 'terminate'):
+                member.prefetch_commands()
+            elif operation == 'status':
+                # one listing for the state of all VMs
+                listings[member] = member.vb.list_vms_long(refresh=True)
+        if operation == 'start':
+            overrides = dict(overrides or {})
+            overrides.setdefault('instances', self.ctrl.instances)
+            self._prepare_start([instances[x] for x in instance_ids], overrides)
+        if operation == 'terminate':
+            self._power_off(
+                [instances[x] for x in instance_ids
+                 if not instances[x].config.get('no-terminate', False)],
+                workers)
+
+        buffer = InstanceLogBuffer()
+        durations = {}
+
+        def run(instance_id):
+            instance = instances[instance_id]
+            buffer.bind(instance_id)
+            started = time.time()
+            try:
+                if operation == 'start':
+                    instance.hooks.before_start(instance)
+                    instance.start(dict(overrides))
+                    instance.hooks.after_start(instance)
+                elif operation == 'status':
+                    instance.status(listings.get(instance.vb_master))
+                else:
+                    getattr(instance, operation)()
+            finally:
+                durations[instance_id] = time.time() - started
+                buffer.unbind()
+
+        buffer.attach()
+        try:
+            results = run_concurrently(run, instance_ids, workers)
+        finally:
+            buffer.detach()
+        buffer.replay(instance_ids)
+        return [
+            (instance_id, e, durations[instance_id])
+            for instance_id, (result, e) in zip(instance_ids, results)]
+
+    def prefetch_commands(self):
+        """Fetch the command table of ``VBoxManage`` in this thread.
+
+        Call it before dispatching to worker threads, which would otherwise
+        each fetch it while it isn't cached yet.
+        """
+        self.vb.commands
+
+    def _prepare_start(self, instances, overrides):
+        """Ask the questions of starting ``instances`` up front.
+
+        The prompt can't be shared by the worker threads, so unverified
+        media are confirmed and the host only interfaces with their dhcp
+        servers are set up before the instances are started. Configuration
+        errors are left to the start of each instance.
+        """
+        unverified = False
+        hostonlyifs = {}
+        for instance in instances:
+            try:
+                config = instance.get_config(overrides)
+                storages = instance._get_storages(config)
+            except SystemExit:
+                continue
+            for args_dict in storages:
+                medium = args_dict.get('medium')
+                if isinstance(medium, tuple) and medium[1] is None:
+                    unverified = True
+            names = hostonlyifs.setdefault(instance.vb_master, set())
+            names.update(
+                v for k, v in config.items()
+                if k.startswith('vm-hostonlyadapter'))
+        if unverified:
+            instances[0]._confirm_checksum(None)
+        for member, names in hostonlyifs.items():
+            if names:
+                member.networks.ensure(names)
+
+    def _power_off(self, instances, workers):
+        """Power off the running VMs of ``instances`` concurrently and wait
+        for all of them with one ``list --long vms`` per host and round."""
+        def running(instances):
+            listings = {}
+            result = []
+            for instance in instances:
+                member = instance.vb_master
+                if member not in listings:
+                    listings[member] = member.vb.list_vms_long(refresh=True)
+                vm = listings[member].get(instance.id)
+                if vm is not None and vm['state'] not in ('poweroff', 'saved', 'aborted'):
+                    result.append(instance)
+            return result
+
+        instances = running(instances)
+        if not instances:
+            return
+        log.info("Powering off %d instances.", len(instances))
+        run_concurrently(
+            lambda x: x.vb.controlvm(x.id, 'poweroff'), instances, workers)
+        # failures are reported by the terminate of each instance
+        timeout = max(x._vmstoptimeout for x in instances)
+        deadline = time.time() + timeout
+        vb = instances[0].vb
+        interval = vb.wait_interval
+        while True:
+            instances = running(instances)
+            if not instances or time.time() >= deadline:
+                break
+            time.sleep(min(interval, max(deadline - time.time(), 0)))
+            interval = min(interval * 2, vb.wait_max_interval)
+
+    def bulk_status(self, instance_ids=None):
+        """Return a dict mapping instance ids to ``(status, ips)`` tuples.
+
+        The state of all VMs comes from one ``list --long vms`` call, the
+        guest properties are only enumerated for running instances with host
+        only or bridged interfaces. ``ips`` is a list of ``(nictype, ip)``
+        tuples. Unknown VM states raise ``VirtualBoxError``.
+        """
+        instances = self.vb_instances
+        if instance_ids is None:
+            instance_ids = sorted(instances)
+        listings = {}
+        result = {}
+        for instance_id in instance_ids:
+            instance = instances[instance_id]
+            member = instance.vb_master
+            if member not in listings:
+                listings[member] = member.vb.list_vms_long(refresh=True)
+            result[instance_id] = instance._bulk_status(listings[member])
+        return result
+
+    @property
+    def global_config(self):
+        return self.main_config.get('global', {}).get('global', {})
+
+    @lazy
+    def download_cache(self):
+        return get_download_cache(self.global_config)
+
     @lazy
     def dhcpservers(self):
         return DHCPServers(self)
@@ -628,11 +1508,446 @@ class Master(BaseMaster):
     def hostonlyifs(self):
         return HostOnlyIFs(self)
 
+    @lazy
+    def networks(self):
+        return Networks(self)
+
+    @lazy
+    def templates(self):
+        return Templates(self)
+
+    @property
+    def cache_dir(self):
+        return os.path.expanduser(self.global_config.get(
+            'cache_dir', '~/.ploy/cache'))
+
+    @lazy
+    def async_vb(self):
+        """An ``AsyncVBoxManage`` for use with asyncio, Python 3.7+ only."""
+        from ploy_virtualbox.aiovbox import AsyncVBoxManage
+        return AsyncVBoxManage.from_master(self)
+
     @lazy
     def vb(self):
-        from ploy_virtualbox.vbox import VBoxManage
+        from ploy_virtualbox.vbox import CallLog, CallTimings, VBoxManage
         instance = getattr(self, 'instance', None)
-        return VBoxManage(instance=instance)
+        vb = VBoxManage(
+            instance=instance, cache_dir=self.cache_dir,
+            keepalive=self.master_config.get('ssh-keepalive', 30),
+            idle_timeout=self.master_config.get('ssh-idle-timeout'))
+        call_log = self.master_config.get('call-log')
+        if call_log is not None:
+            vb.call_hooks.append(CallLog(call_log))
+        if self.master_config.get('call-timings', False):
+            timings = CallTimings()
+            vb.call_hooks.append(timings)
+            atexit.register(timings.report)
+        return vb
+
+
+class PoolMaster(Master):
+    """Spreads its instances over the hosts of several ``vb-master``.
+
+    New VMs are placed on the member with the most free memory, then the
+    most free CPUs, after subtracting the running VMs and the VMs placed
+    during this run. The placements are stored in a JSON file, so later
+    commands go to the right host.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Master.__init__(self, *args, **kwargs)
+        self.placement_lock = threading.RLock()
+        self._placements = None
+        self._pending = {}
+        self._hostinfo = {}
+
+    @lazy
+    def vb_members(self):
+        members = []
+        for member_id in self.master_config.get('masters', '').split():
+            member = self.ctrl.masters.get(member_id)
+            if not isinstance(member, Master) or isinstance(member, PoolMaster):
+                log.error("The master '%s' of pool '%s' isn't a vb-master." % (member_id, self.id))
+                sys.exit(1)
+            members.append(member)
+        if not members:
+            log.error("The pool '%s' has no masters configured." % self.id)
+            sys.exit(1)
+        return members
+
+    @property
+    def vb(self):
+        raise VirtualBoxError(
+            "The pool '%s' has no VBoxManage of its own, use the one of the "
+            "member an instance is placed on." % self.id)
+
+    @property
+    def state_path(self):
+        path = self.master_config.get('state-file')
+        if path is None:
+            path = os.path.join(
+                self.main_config.path, 'vb-pool-%s.json' % self.id)
+        return path
+
+    @property
+    def placements(self):
+        """Mapping of instance ids to the ids of the members they run on."""
+        if self._placements is None:
+            self._placements = {}
+            if os.path.exists(self.state_path):
+                with open(self.state_path) as f:
+                    self._placements = json.load(f)
+        return self._placements
+
+    def _write_placements(self):
+        tmp_path = "%s.%s" % (self.state_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.placements, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.state_path)
+
+    def _member_capacity(self, member):
+        # the hardware of a host doesn't change during a run
+        if member.id not in self._hostinfo:
+            self._hostinfo[member.id] = member.vb.list_hostinfo()
+        hostinfo = self._hostinfo[member.id]
+        memory = int(hostinfo.get('Memory size', '0').split()[0])
+        cpus = int(hostinfo.get('Processor count', '1'))
+        for vm in member.vb.list_vms_long().values():
+            if vm['state'] in ('running', 'paused', 'starting'):
+                memory -= vm['memory']
+                cpus -= vm['cpus']
+        for pending_member, pending_memory, pending_cpus in self._pending.values():
+            if pending_member is member:
+                memory -= pending_memory
+                cpus -= pending_cpus
+        return (memory, cpus)
+
+    def _place(self, instance):
+        members = self.vb_members
+        # a VM created before it was tracked by the pool
+        for member in members:
+            if instance.id in member.vb.list_vms_long():
+                return member
+        memory = int(instance.config.get('vm-memory', 128))
+        cpus = int(instance.config.get('vm-cpus', 1))
+        candidates = []
+        for member in members:
+            (free_memory, free_cpus) = self._member_capacity(member)
+            candidates.append((free_memory, free_cpus, member.id, member))
+        (free_memory, free_cpus, member_id, member) = sorted(
+            candidates, key=lambda x: (-x[0], -x[1], x[2]))[0]
+        if free_memory < memory:
+            log.warning(
+                "No master in pool '%s' has %s MB of free memory for '%s', using '%s' with %s MB." % (
+                    self.id, memory, instance.id, member_id, free_memory))
+        self._pending[instance.id] = (member, memory, cpus)
+        log.info("Placing instance '%s' on '%s'.", instance.id, member_id)
+        return member
+
+    def placement(self, instance):
+        with self.placement_lock:
+            member_id = self.placements.get(instance.id)
+            if member_id is not None:
+                for member in self.vb_members:
+                    if member.id == member_id:
+                        return member
+            if instance.id in self._pending:
+                return self._pending[instance.id][0]
+            member = self._place(instance)
+            if instance.id not in self._pending:
+                self.placements[instance.id] = member.id
+                self._write_placements()
+            return member
+
+    def remember_placement(self, instance):
+        with self.placement_lock:
+            if instance.id not in self._pending:
+                return
+            (member, memory, cpus) = self._pending.pop(instance.id)
+            self.placements[instance.id] = member.id
+            self._write_placements()
+
+    def forget_placement(self, instance):
+        with self.placement_lock:
+            self._pending.pop(instance.id, None)
+            if self.placements.pop(instance.id, None) is not None:
+                self._write_placements()
+
+
+def get_download_cache(global_config):
+    from ploy_virtualbox.download import DownloadCache, parse_size
+    download_dir = os.path.expanduser(global_config.get(
+        'download_dir', '~/.ploy/downloads'))
+    max_size = global_config.get('download_cache_size')
+    if max_size is not None:
+        max_size = parse_size(max_size)
+    return DownloadCache(download_dir, max_size=max_size)
+
+
+class DownloadsCmd(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        """List or prune the cache of downloaded media"""
+        from ploy_virtualbox.download import format_size, parse_size
+        parser = argparse.ArgumentParser(
+            prog="%s vb-downloads" % self.ctrl.progname,
+            description=help)
+        parser.add_argument("action", nargs=1,
+                            metavar="action",
+                            help="Either 'list' or 'prune'.",
+                            type=str,
+                            choices=('list', 'prune'))
+        parser.add_argument("--max-size", dest="max_size", metavar="SIZE",
+                            help="Prune down to this size, like 500M or 20G. Defaults to the download_cache_size option, or to removing everything.")
+        args = parser.parse_args(argv)
+        cache = get_download_cache(
+            self.ctrl.config.get('global', {}).get('global', {}))
+        if args.action[0] == 'list':
+            entries = cache.entries()
+            for entry in entries:
+                last_used = 'never'
+                if entry['last_used']:
+                    last_used = time.strftime(
+                        '%Y-%m-%d %H:%M', time.localtime(entry['last_used']))
+                print("%s  %10s  %s" % (last_used, format_size(entry['size']), entry['digest']))
+                for url in sorted(entry['urls']):
+                    print("    %s" % url)
+            print("Total: %s" % format_size(sum(x['size'] for x in entries)))
+            return
+        max_size = cache.max_size
+        if args.max_size is not None:
+            max_size = parse_size(args.max_size)
+        removed = cache.prune(max_size or 0)
+        log.info(
+            "Removed %d files with %s from download cache.",
+            len(removed), format_size(sum(x['size'] for x in removed)))
+
+
+class FleetCmd(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        """Run start, stop, status, suspend or terminate on several VirtualBox instances concurrently"""
+        instances = dict(
+            (k, v) for k, v in self.ctrl.instances.items()
+            if isinstance(v, Instance))
+        parser = argparse.ArgumentParser(
+            prog="%s vb-fleet" % self.ctrl.progname,
+            description=help)
+        parser.add_argument("operation", nargs=1,
+                            metavar="operation",
+                            help="The operation to run.",
+                            type=str,
+                            choices=Master.fleet_operations)
+        parser.add_argument("-j", "--workers", type=int,
+                            dest="workers", metavar="N",
+                            help="Number of instances to handle at the same time.")
+        parser.add_argument("instances", nargs="*",
+                            metavar="instance",
+                            help="Name of the instance from the config, all VirtualBox instances if not set.",
+                            type=str)
+        args = parser.parse_args(argv)
+        operation = args.operation[0]
+        names = args.instances
+        for name in names:
+            if name not in instances:
+                parser.error("invalid instance: '%s' (choose from %s)" % (
+                    name, ", ".join(sorted_choices(instances))))
+        if not names:
+            names = sorted(set(x.uid for x in instances.values()))
+        if operation == 'terminate':
+            if not yesno("Are you sure you want to terminate %d instances?" % len(names)):
+                return
+        by_master = {}
+        for name in names:
+            instance = instances[name]
+            by_master.setdefault(instance.master, []).append(instance.id)
+        failed = []
+        for master in sorted(by_master, key=lambda x: x.id):
+            summary = master.fleet(
+                operation, by_master[master], workers=args.workers)
+            for instance_id, e, duration in summary:
+                if e is None:
+                    log.info("%s of '%s-%s' succeeded (%.1fs).", operation, master.id, instance_id, duration)
+                    continue
+                if isinstance(e, SystemExit):
+                    log.error("%s of '%s-%s' failed (%.1fs).", operation, master.id, instance_id, duration)
+                else:
+                    log.error("%s of '%s-%s' failed (%.1fs): %s", operation, master.id, instance_id, duration, e)
+                failed.append(instance_id)
+        log.info("%s finished for %d instances, %d failed.", operation, len(names), len(failed))
+        if failed:
+            sys.exit(1)
+
+
+class DiskCmd(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def targets(self, instances, names, disks):
+        targets = []
+        for name in names:
+            instance = instances[name]
+            for args_dict in instance._get_storages(instance.config):
+                disk = args_dict.get('medium')
+                if not isinstance(disk, Disk):
+                    continue
+                if disks and disk.name not in disks:
+                    continue
+                if (instance, disk) not in targets:
+                    targets.append((instance, disk))
+        return targets
+
+    def __call__(self, argv, help):
+        """Show info about, compact, resize or convert the disks of VirtualBox instances"""
+        from ploy_virtualbox.download import format_size
+
+        instances = dict(
+            (k, v) for k, v in self.ctrl.instances.items()
+            if isinstance(v, Instance))
+        parser = argparse.ArgumentParser(
+            prog="%s vb-disk" % self.ctrl.progname,
+            description=help)
+        parser.add_argument("action", nargs=1,
+                            metavar="action",
+                            help="One of 'info', 'compact', 'resize' or 'convert'.",
+                            type=str,
+                            choices=('info', 'compact', 'resize', 'convert'))
+        parser.add_argument("-j", "--workers", type=int, default=4,
+                            dest="workers", metavar="N",
+                            help="Number of disks to handle at the same time.")
+        parser.add_argument("--disk", action="append", default=[],
+                            dest="disks", metavar="NAME",
+                            help="Only handle the disk of this vb-disk section, can be used several times.")
+        parser.add_argument("--size", type=int,
+                            dest="size", metavar="MB",
+                            help="The new size in megabytes for 'resize'.")
+        parser.add_argument("instances", nargs="*",
+                            metavar="instance",
+                            help="Name of the instance from the config, all VirtualBox instances if not set.",
+                            type=str)
+        args = parser.parse_args(argv)
+        action = args.action[0]
+        if action == 'resize' and args.size is None:
+            parser.error("the 'resize' action requires --size")
+        names = args.instances
+        for name in names:
+            if name not in instances:
+                parser.error("invalid instance: '%s' (choose from %s)" % (
+                    name, ", ".join(sorted_choices(instances))))
+        if not names:
+            names = sorted(set(x.uid for x in instances.values()))
+        targets = self.targets(instances, names, args.disks)
+        if action != 'convert':
+            for instance, disk in targets:
+                if not os.path.exists(disk.path(instance)):
+                    log.info("Disk '%s' of '%s' doesn't exist.", disk.name, instance.config_id)
+            targets = [x for x in targets if os.path.exists(x[1].path(x[0]))]
+        for member in set(x[0].vb_master for x in targets):
+            member.prefetch_commands()
+
+        def run(target):
+            (instance, disk) = target
+            if action == 'info':
+                return disk.info(instance)
+            elif action == 'compact':
+                before = disk.info(instance)['size']
+                disk.compact(instance)
+                return (before, disk.info(instance)['size'])
+            elif action == 'resize':
+                disk.resize(instance, args.size)
+            elif action == 'convert':
+                return disk.convert(instance)
+
+        results = run_concurrently(run, targets, args.workers)
+        failed = 0
+        reclaimed = 0
+        for (instance, disk), (result, e) in zip(targets, results):
+            if e is not None:
+                if not isinstance(e, SystemExit):
+                    log.error("%s of disk '%s' of '%s' failed: %s", action, disk.name, instance.config_id, e)
+                failed += 1
+            elif action == 'info':
+                print("%-20s %-10s %-5s %10s %10s  %s" % (
+                    instance.config_id, disk.name, result.get('Storage format', disk.format),
+                    format_size(result['capacity'] or 0), format_size(result['size'] or 0),
+                    disk.path(instance)))
+            elif action == 'compact':
+                (before, after) = result
+                reclaimed += (before or 0) - (after or 0)
+                log.info(
+                    "Compacted disk '%s' of '%s' from %s to %s.", disk.name, instance.config_id,
+                    format_size(before or 0), format_size(after or 0))
+            elif action == 'resize':
+                log.info("Resized disk '%s' of '%s' to %s MB.", disk.name, instance.config_id, args.size)
+            elif action == 'convert' and result is not None:
+                log.info(
+                    "Converted disk '%s' of '%s' from '%s' to '%s', the old file is kept.",
+                    disk.name, instance.config_id, result, disk.path(instance))
+        if action == 'compact':
+            log.info("Reclaimed %s.", format_size(reclaimed))
+        if failed:
+            log.error("%s failed for %d of %d disks.", action, failed, len(targets))
+            sys.exit(1)
+
+
+class PlanCmd(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        """Show the VBoxManage calls starting a VirtualBox instance would run"""
+        instances = dict(
+            (k, v) for k, v in self.ctrl.instances.items()
+            if isinstance(v, Instance))
+        parser = argparse.ArgumentParser(
+            prog="%s vb-plan" % self.ctrl.progname,
+            description=help)
+        parser.add_argument("instance", nargs=1,
+                            metavar="instance",
+                            help="Name of the instance from the config.",
+                            type=str,
+                            choices=sorted_choices(instances))
+        args = parser.parse_args(argv)
+        instance = instances[args.instance[0]]
+        for action in instance.plan():
+            print(action)
+
+
+class SnapshotCmd(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        """Take, restore, delete or list snapshots of VirtualBox instances"""
+        instances = dict(
+            (k, v) for k, v in self.ctrl.instances.items()
+            if isinstance(v, Instance))
+        parser = argparse.ArgumentParser(
+            prog="%s vb-snapshot" % self.ctrl.progname,
+            description=help)
+        parser.add_argument("action", nargs=1,
+                            metavar="action",
+                            help="One of 'take', 'restore', 'delete' or 'list'.",
+                            type=str,
+                            choices=('take', 'restore', 'delete', 'list'))
+        parser.add_argument("instance", nargs=1,
+                            metavar="instance",
+                            help="Name of the instance from the config.",
+                            type=str,
+                            choices=sorted_choices(instances))
+        parser.add_argument("name", nargs="?",
+                            metavar="name",
+                            help="Name of the snapshot.",
+                            type=str)
+        parser.add_argument("--live", action="store_true",
+                            help="Take the snapshot while the instance is running, including its memory.")
+        args = parser.parse_args(argv)
+        instance = instances[args.instance[0]]
+        instance.snapshot(args.action[0], args.name, live=args.live)
 
 
 def get_instance_massagers(sectiongroupname='instance'):
@@ -640,7 +1955,9 @@ def get_instance_massagers(sectiongroupname='instance'):
         PathMassager(sectiongroupname, 'basefolder'),
         BooleanMassager(sectiongroupname, 'headless'),
         BooleanMassager(sectiongroupname, 'use-acpi-powerbutton'),
-        BooleanMassager(sectiongroupname, 'no-terminate')]
+        BooleanMassager(sectiongroupname, 'no-terminate'),
+        IntegerMassager(sectiongroupname, 'stop-timeout'),
+        IntegerMassager(sectiongroupname, 'wait-timeout')]
 
 
 def get_massagers():
@@ -650,12 +1967,34 @@ def get_massagers():
     massagers.extend([
         BooleanMassager(sectiongroupname, 'delete')])
 
+    sectiongroupname = 'vb-template'
+    massagers.extend([
+        PathMassager(sectiongroupname, 'directory')])
+
     sectiongroupname = 'vb-master'
     massagers.extend([
         BooleanMassager(sectiongroupname, 'headless'),
         BooleanMassager(sectiongroupname, 'use-acpi-powerbutton'),
+        BooleanMassager(sectiongroupname, 'batch-commands'),
+        IntegerMassager(sectiongroupname, 'fleet-workers'),
+        IntegerMassager(sectiongroupname, 'async-concurrency'),
+        IntegerMassager(sectiongroupname, 'stop-timeout'),
+        IntegerMassager(sectiongroupname, 'wait-timeout'),
+        IntegerMassager(sectiongroupname, 'ssh-keepalive'),
+        IntegerMassager(sectiongroupname, 'ssh-idle-timeout'),
+        BooleanMassager(sectiongroupname, 'call-timings'),
+        PathMassager(sectiongroupname, 'call-log'),
         PathMassager(sectiongroupname, 'basefolder')])
 
+    sectiongroupname = 'vb-pool'
+    massagers.extend([
+        BooleanMassager(sectiongroupname, 'headless'),
+        BooleanMassager(sectiongroupname, 'use-acpi-powerbutton'),
+        IntegerMassager(sectiongroupname, 'fleet-workers'),
+        IntegerMassager(sectiongroupname, 'stop-timeout'),
+        IntegerMassager(sectiongroupname, 'wait-timeout'),
+        PathMassager(sectiongroupname, 'state-file')])
+
     sectiongroupname = 'vb-instance'
     massagers.extend(get_instance_massagers(sectiongroupname))
 
@@ -671,13 +2010,25 @@ def get_macro_cleaners(main_config):
     return {"vb-instance": clean_instance}
 
 
+def get_commands(ctrl):
+    return [
+        ('vb-disk', DiskCmd(ctrl)),
+        ('vb-downloads', DownloadsCmd(ctrl)),
+        ('vb-fleet', FleetCmd(ctrl)),
+        ('vb-plan', PlanCmd(ctrl)),
+        ('vb-snapshot', SnapshotCmd(ctrl))]
+
+
 def get_masters(ctrl):
     masters = ctrl.config.get('vb-master', {'virtualbox': {}})
     for master, master_config in masters.items():
         yield Master(ctrl, master, master_config)
+    for pool, pool_config in ctrl.config.get('vb-pool', {}).items():
+        yield PoolMaster(ctrl, pool, pool_config)
 
 
 plugin = dict(
+    get_commands=get_commands,
     get_massagers=get_massagers,
     get_macro_cleaners=get_macro_cleaners,
     get_masters=get_masters)
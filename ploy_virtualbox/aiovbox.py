@@ -0,0 +1,157 @@
+"""asyncio counterpart of ``ploy_virtualbox.vbox.VBoxManage``.
+
+Requires Python 3.7 or newer.
+"""
+from ploy.common import shjoin
+from ploy_virtualbox.vbox import CallRecord
+from ploy_virtualbox.vbox import make_cmd_args
+from ploy_virtualbox.vbox import parse_dhcpservers
+from ploy_virtualbox.vbox import parse_guestproperties
+from ploy_virtualbox.vbox import parse_hostonlyifs
+from ploy_virtualbox.vbox import parse_vminfo
+from ploy_virtualbox.vbox import parse_vms
+from ploy_virtualbox.vbox import parse_vms_long
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+log = logging.getLogger('ploy_virtualbox.aiovbox')
+
+
+class AsyncVBoxManage:
+    """Runs ``VBoxManage`` with ``asyncio`` subprocesses.
+
+    At most ``concurrency`` commands run at the same time. With ``ssh_args``
+    the commands run on a remote host via ``ssh``, ``host`` is only used to
+    identify it in the call records. All calls share one connection through
+    the OpenSSH ``ControlMaster`` feature, which is kept open for
+    ``control_persist`` seconds after the last call.
+    """
+
+    def __init__(self, executable="VBoxManage", ssh_args=None, host=None,
+                 concurrency=4, control_persist=60):
+        self.prefix_args = (executable,)
+        self.ssh_args = ssh_args
+        self.host = host
+        self.concurrency = concurrency
+        self.control_persist = control_persist
+        self.call_hooks = []
+        self._semaphore = None
+        self._control_dir = None
+
+    @classmethod
+    def from_master(cls, master, **kw):
+        """Create a client for the host of a ``vb-master``.
+
+        For remote masters the ssh arguments are taken from the instance of
+        the master, so the host key is verified like for other connections
+        made by ploy.
+        """
+        instance = getattr(master, 'instance', None)
+        if instance is not None and 'ssh_args' not in kw:
+            ssh_info = instance.init_ssh_key()
+            client = ssh_info.pop('client')
+            client.get_transport().sock.close()
+            client.close()
+            kw['ssh_args'] = instance.ssh_args_from_info(ssh_info)
+            kw.setdefault('host', instance.uid)
+        kw.setdefault('concurrency', master.master_config.get('async-concurrency', 4))
+        return cls(**kw)
+
+    @property
+    def semaphore(self):
+        # created on first use, so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _control_args(self):
+        if self._control_dir is None:
+            self._control_dir = tempfile.mkdtemp(prefix='ploy-vbox-')
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % os.path.join(self._control_dir, '%C'),
+            '-o', 'ControlPersist=%s' % self.control_persist]
+
+    def _args(self, cmd_args):
+        args = list(self.prefix_args) + list(cmd_args)
+        if self.ssh_args is None:
+            return args
+        return ['ssh'] + self._control_args() + list(self.ssh_args) + ['--', shjoin(args)]
+
+    async def _run(self, args):
+        async with self.semaphore:
+            started = time.time()
+            (rc, out, err) = (None, b'', b'')
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *self._args(args),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+                (out, err) = await proc.communicate()
+                rc = proc.returncode
+            finally:
+                record = CallRecord(
+                    self.prefix_args + tuple(args), rc, started,
+                    time.time() - started, out, err, host=self.host)
+                for hook in self.call_hooks:
+                    hook(record)
+        return (rc, out, err)
+
+    async def __call__(self, *args, **kw):
+        """Run ``VBoxManage`` with ``args`` and return the output lines.
+
+        Raises ``subprocess.CalledProcessError`` if the exit code isn't
+        ``rc`` or the error output isn't ``err``, if those are given.
+        """
+        rc = kw.pop('rc', 0)
+        err = kw.pop('err', None)
+        cmd_args = make_cmd_args(args, kw)
+        (_rc, _out, _err) = await self._run(cmd_args)
+        if (rc is not None and rc != _rc) or (err is not None and err != _err):
+            raise subprocess.CalledProcessError(
+                _rc, ' '.join(self.prefix_args + tuple(cmd_args)), _err)
+        return _out.decode('utf-8').splitlines()
+
+    async def close(self):
+        """Close the shared ssh connection."""
+        if self._control_dir is None:
+            return
+        proc = await asyncio.create_subprocess_exec(
+            'ssh', *(self._control_args() + ['-O', 'exit'] + list(self.ssh_args)),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        await proc.wait()
+        shutil.rmtree(self._control_dir, ignore_errors=True)
+        self._control_dir = None
+
+    async def guestproperty(self, name, *args, **kw):
+        lines = await self('guestproperty', name, *args, err=b'', **kw)
+        return parse_guestproperties(lines)
+
+    async def list_dhcpservers(self, *args, **kw):
+        lines = await self('list', 'dhcpservers', *args, err=b'', **kw)
+        return parse_dhcpservers(lines)
+
+    async def list_hostonlyifs(self, *args, **kw):
+        lines = await self('list', 'hostonlyifs', *args, err=b'', **kw)
+        return parse_hostonlyifs(lines)
+
+    async def list_vms(self, *args, **kw):
+        lines = await self('list', 'vms', *args, err=b'', **kw)
+        return parse_vms(lines)
+
+    async def list_vms_long(self):
+        lines = await self('list', '--long', 'vms', err=b'')
+        return parse_vms_long(lines)
+
+    async def showvminfo(self, name, *args, **kw):
+        lines = await self('showvminfo', '--machinereadable', name, *args, err=b'', **kw)
+        return parse_vminfo(lines)
@@ -0,0 +1,7 @@
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # asyncio support needs syntax which doesn't compile on older versions
+    collect_ignore.extend(['aiovbox.py', 'test_aiovbox.py'])
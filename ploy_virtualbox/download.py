@@ -0,0 +1,483 @@
+try:
+    from http.client import HTTPException
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+except ImportError:  # pragma: nocover
+    from httplib import HTTPException  # for Python 2.7
+    from urllib2 import HTTPError, Request, URLError, urlopen
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+log = logging.getLogger('ploy_virtualbox.download')
+
+
+class DownloadError(Exception):
+    pass
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size = size / 1024.0
+    else:
+        unit = 'TiB'
+    return "%.1f %s" % (size, unit)
+
+
+class Progress(object):
+    """Logs the progress and throughput of a download every ``interval`` seconds."""
+
+    def __init__(self, interval=5):
+        self.interval = interval
+
+    def start(self, url, offset, total):
+        self.started = self.last = time.time()
+        self.offset = offset
+        self.total = total
+        if offset:
+            log.info("Resuming download of %s at %s.", url, format_size(offset))
+
+    def _rate(self, received, now):
+        elapsed = max(now - self.started, 0.001)
+        return format_size((received - self.offset) / elapsed)
+
+    def update(self, received):
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        if self.total:
+            log.info(
+                "Downloaded %s of %s (%d%%) at %s/s.",
+                format_size(received), format_size(self.total),
+                received * 100 // self.total, self._rate(received, now))
+        else:
+            log.info(
+                "Downloaded %s at %s/s.",
+                format_size(received), self._rate(received, now))
+
+    def finish(self, received):
+        now = time.time()
+        log.info(
+            "Downloaded %s in %.1f seconds at %s/s.",
+            format_size(received), now - self.started,
+            self._rate(received, now))
+
+
+def hash_file(path, algorithm, chunk_size=1024 * 1024):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while 1:
+            buf = f.read(chunk_size)
+            if not len(buf):
+                break
+            digest.update(buf)
+    return digest
+
+
+def parse_checksum(value, algorithm=None):
+    """Parse ``algorithm:hexdigest`` into a tuple.
+
+    If ``algorithm`` is given, ``value`` is just the hex digest.
+    """
+    if algorithm is None:
+        if ':' not in value:
+            raise ValueError("Checksum '%s' isn't in the form 'algorithm:hexdigest'." % value)
+        algorithm, value = value.split(':', 1)
+    algorithm = algorithm.strip().lower()
+    value = value.strip().lower()
+    try:
+        digest_size = hashlib.new(algorithm).digest_size
+    except ValueError:
+        raise ValueError("Unknown checksum algorithm '%s'." % algorithm)
+    if len(value) != digest_size * 2 or value.strip('0123456789abcdef'):
+        raise ValueError("Invalid %s checksum '%s'." % (algorithm, value))
+    return (algorithm, value)
+
+
+class DigestMemo(object):
+    """Remembers digests of a file in a ``.digests`` sidecar file.
+
+    The digests are only used while size, modification time and inode of
+    the file are unchanged, so big files only have to be hashed once. For
+    files in directories which aren't ours, the ``memo_path`` can be put
+    elsewhere. If it can't be written, the file is hashed again next time.
+    """
+
+    def __init__(self, path, memo_path=None):
+        self.path = path
+        if memo_path is None:
+            memo_path = "%s.digests" % path
+        self.memo_path = memo_path
+
+    def _key(self):
+        st = os.stat(self.path)
+        return [st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino]
+
+    def read(self):
+        try:
+            with open(self.memo_path) as f:
+                memo = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if memo.get('key') != self._key():
+            return {}
+        return memo.get('digests', {})
+
+    def record(self, algorithm, hexdigest):
+        digests = self.read()
+        digests[algorithm] = hexdigest
+        tmp_path = "%s.%s" % (self.memo_path, os.getpid())
+        try:
+            directory = os.path.dirname(self.memo_path)
+            if not os.path.exists(directory):
+                os.makedirs(directory, mode=0o750)
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(key=self._key(), digests=digests), f, sort_keys=True)
+            os.rename(tmp_path, self.memo_path)
+        except (IOError, OSError) as e:
+            log.warning("Couldn't remember the %s checksum of %s: %s" % (algorithm, self.path, e))
+
+    def digest(self, algorithm, chunk_size=1024 * 1024):
+        hexdigest = self.read().get(algorithm)
+        if hexdigest is None:
+            log.info("Calculating %s checksum of %s." % (algorithm, self.path))
+            hexdigest = hash_file(self.path, algorithm, chunk_size=chunk_size).hexdigest()
+            self.record(algorithm, hexdigest)
+        return hexdigest
+
+
+class Download(object):
+    def __init__(self, url, path, algorithm='sha1', chunk_size=1024 * 1024, progress=None):
+        self.url = url
+        self.path = path
+        self.part_path = "%s.part" % path
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        if progress is None:
+            progress = Progress()
+        self.progress = progress
+        self.received = 0
+        self.digest = hashlib.new(algorithm)
+        if os.path.exists(self.part_path):
+            self.digest = hash_file(self.part_path, algorithm, chunk_size=chunk_size)
+            self.received = os.path.getsize(self.part_path)
+
+    def fetch(self):
+        request = Request(self.url)
+        if self.received:
+            request.add_header('Range', 'bytes=%d-' % self.received)
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            if e.code == 416 and self.received:
+                # the partial file already has all the data
+                return
+            raise
+        try:
+            mode = 'ab'
+            if self.received and response.getcode() != 206:
+                log.info("Server doesn't support resuming, restarting download.")
+                self.digest = hashlib.new(self.algorithm)
+                self.received = 0
+                mode = 'wb'
+            total = response.headers.get('Content-Length')
+            if total is not None:
+                total = int(total) + self.received
+            self.progress.start(self.url, self.received, total)
+            with open(self.part_path, mode) as f:
+                while 1:
+                    buf = response.read(self.chunk_size)
+                    if not len(buf):
+                        break
+                    f.write(buf)
+                    self.digest.update(buf)
+                    self.received += len(buf)
+                    self.progress.update(self.received)
+            if total is not None and self.received != total:
+                raise DownloadError(
+                    "Connection closed after %s of %s." % (
+                        format_size(self.received), format_size(total)))
+            self.progress.finish(self.received)
+        finally:
+            response.close()
+
+    def __call__(self, retries=3):
+        attempt = 0
+        while 1:
+            try:
+                self.fetch()
+                break
+            except (DownloadError, HTTPException, URLError, socket.error, IOError) as e:
+                if isinstance(e, HTTPError) or attempt >= retries:
+                    raise DownloadError("Failed to download %s: %s" % (self.url, e))
+                attempt += 1
+                log.warning("Download of %s interrupted (%s), retrying.", self.url, e)
+        os.rename(self.part_path, self.path)
+        return self.digest.hexdigest()
+
+
+def download(url, path, algorithm='sha1', retries=3, chunk_size=1024 * 1024, progress=None):
+    """Stream ``url`` to ``path`` and return the hex digest of the content.
+
+    The content is hashed with ``algorithm`` while it is written, so it
+    doesn't have to be read again for verification. The data goes to
+    ``path`` with a ``.part`` suffix, which is renamed to ``path`` once
+    complete. An existing partial file is resumed with a HTTP Range request,
+    which is also used to retry up to ``retries`` times when the connection
+    drops.
+    """
+    return Download(
+        url, path, algorithm=algorithm, chunk_size=chunk_size,
+        progress=progress)(retries=retries)
+
+
+class ChecksumError(DownloadError):
+    pass
+
+
+size_units = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+
+
+def parse_size(value):
+    """Parse sizes like ``500M`` or ``20G`` into bytes."""
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    if value and value[-1] in size_units:
+        return int(float(value[:-1]) * size_units[value[-1]])
+    return int(value)
+
+
+class DownloadCache(object):
+    """Content addressed store for downloaded media.
+
+    Files are stored as ``objects/<algorithm>/<hexdigest>`` in
+    ``directory``. The ``index.json`` file maps each URL to the digest,
+    size and time of last use of its content. When ``max_size`` is set, the
+    least recently used objects are removed after each download until the
+    store fits.
+
+    Files in ``directory`` itself are from the flat layout of older
+    versions. They are moved into the store on first use.
+    """
+
+    index_name = 'index.json'
+    # older versions only verified downloads with sha1
+    legacy_algorithm = 'sha1'
+
+    def __init__(self, directory, max_size=None, algorithm='sha256'):
+        self.directory = directory
+        self.max_size = max_size
+        self.algorithm = algorithm
+        self.lock = threading.RLock()
+        self.url_locks = {}
+        self._imported = False
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, self.index_name)
+
+    def object_path(self, digest):
+        algorithm, hexdigest = digest.split(':', 1)
+        return os.path.join(self.directory, 'objects', algorithm, hexdigest)
+
+    def partial_path(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'partial', name)
+
+    def url_lock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def _makedirs(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path, mode=0o750)
+
+    def read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning("Ignoring invalid download index '%s'." % self.index_path)
+            return {}
+
+    def write_index(self, index):
+        self._makedirs(self.directory)
+        tmp_path = "%s.%s" % (self.index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.index_path)
+
+    def _use(self, url, digest, path):
+        with self.lock:
+            index = self.read_index()
+            index[url] = dict(
+                digest=digest,
+                size=os.path.getsize(path),
+                last_used=time.time())
+            self.write_index(index)
+
+    def import_legacy(self):
+        """Move the files of the old flat layout into the store.
+
+        They are stored under their sha1 digest, so configs with the sha1
+        checksum of a file keep using it without downloading it again.
+        """
+        with self.lock:
+            if self._imported:
+                return
+            self._imported = True
+            if not os.path.isdir(self.directory):
+                return
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if name.startswith(self.index_name) or not os.path.isfile(path):
+                    continue
+                algorithm = self.legacy_algorithm
+                hexdigest = hash_file(path, algorithm).hexdigest()
+                object_path = self.object_path("%s:%s" % (algorithm, hexdigest))
+                self._makedirs(os.path.dirname(object_path))
+                log.info("Moving '%s' into the download cache." % path)
+                os.rename(path, object_path)
+                DigestMemo(object_path).record(algorithm, hexdigest)
+
+    def _forget(self, url):
+        with self.lock:
+            index = self.read_index()
+            index.pop(url, None)
+            self.write_index(index)
+
+    def _lookup(self, url, checksum):
+        index = self.read_index()
+        if checksum is not None:
+            digest = "%s:%s" % checksum
+            path = self.object_path(digest)
+            if os.path.exists(path):
+                if DigestMemo(path).digest(checksum[0]) == checksum[1]:
+                    return (digest, path)
+                log.warning("Removing corrupted %s from download cache." % path)
+                self.remove(digest)
+        entry = index.get(url)
+        if entry is None:
+            return (None, None)
+        path = self.object_path(entry['digest'])
+        if not os.path.exists(path):
+            return (None, None)
+        if checksum is None:
+            return (entry['digest'], path)
+        # the content was stored under another algorithm
+        algorithm, expected = checksum
+        if DigestMemo(path).digest(algorithm) != expected:
+            # the content at the URL changed since it was stored
+            log.info("Stored content of %s doesn't match the checksum, downloading again." % url)
+            self._forget(url)
+            return (None, None)
+        return (entry['digest'], path)
+
+    def get(self, url, checksum=None):
+        """Return the local path for the content of ``url``.
+
+        ``checksum`` is an ``(algorithm, hexdigest)`` tuple. If content with
+        that checksum is already stored, it is used regardless of the URL it
+        came from. Otherwise the URL is downloaded and verified.
+
+        Concurrent calls for the same URL wait for each other, so it is only
+        downloaded once. File system errors are raised as ``DownloadError``.
+        """
+        with self.url_lock(url):
+            try:
+                self.import_legacy()
+                return self._get(url, checksum)
+            except (IOError, OSError) as e:
+                raise DownloadError("Failed to download %s: %s" % (url, e))
+
+    def _get(self, url, checksum):
+        (digest, path) = self._lookup(url, checksum)
+        if path is not None:
+            self._use(url, digest, path)
+            return path
+        algorithm = self.algorithm
+        if checksum is not None:
+            algorithm = checksum[0]
+        partial_path = self.partial_path(url)
+        self._makedirs(os.path.dirname(partial_path))
+        log.info("Downloading %s" % url)
+        hexdigest = Download(url, partial_path, algorithm=algorithm)()
+        if checksum is not None and hexdigest != checksum[1]:
+            os.remove(partial_path)
+            raise ChecksumError('Checksum mismatch for %s!' % url)
+        digest = "%s:%s" % (algorithm, hexdigest)
+        path = self.object_path(digest)
+        self._makedirs(os.path.dirname(path))
+        os.rename(partial_path, path)
+        DigestMemo(path).record(algorithm, hexdigest)
+        log.info('Downloaded successfully to %s' % path)
+        self._use(url, digest, path)
+        if self.max_size is not None:
+            self.prune(self.max_size, keep=(digest,))
+        return path
+
+    def entries(self):
+        """Return stored objects as dicts with ``digest``, ``size``,
+        ``last_used`` and ``urls`` keys, least recently used first."""
+        self.import_legacy()
+        objects = {}
+        for url, entry in self.read_index().items():
+            obj = objects.setdefault(entry['digest'], dict(
+                digest=entry['digest'], size=entry['size'],
+                last_used=entry['last_used'], urls=[]))
+            obj['last_used'] = max(obj['last_used'], entry['last_used'])
+            obj['urls'].append(url)
+        objects_dir = os.path.join(self.directory, 'objects')
+        if os.path.exists(objects_dir):
+            for algorithm in os.listdir(objects_dir):
+                for hexdigest in os.listdir(os.path.join(objects_dir, algorithm)):
+                    if hexdigest.endswith('.digests'):
+                        continue
+                    digest = "%s:%s" % (algorithm, hexdigest)
+                    path = self.object_path(digest)
+                    if digest not in objects:
+                        objects[digest] = dict(
+                            digest=digest, size=os.path.getsize(path),
+                            last_used=0, urls=[])
+        return sorted(
+            (x for x in objects.values() if os.path.exists(self.object_path(x['digest']))),
+            key=lambda x: (x['last_used'], x['digest']))
+
+    def remove(self, digest):
+        with self.lock:
+            path = self.object_path(digest)
+            for name in (path, DigestMemo(path).memo_path):
+                if os.path.exists(name):
+                    os.remove(name)
+            index = self.read_index()
+            for url in list(index):
+                if index[url]['digest'] == digest:
+                    del index[url]
+            self.write_index(index)
+
+    def prune(self, max_size=0, keep=()):
+        """Remove least recently used objects until the store is no larger
+        than ``max_size`` bytes. Returns the removed entries."""
+        removed = []
+        with self.lock:
+            entries = self.entries()
+            total = sum(x['size'] for x in entries)
+            for entry in entries:
+                if total <= max_size:
+                    break
+                if entry['digest'] in keep:
+                    continue
+                log.info("Removing %s from download cache." % ', '.join(entry['urls'] or [entry['digest']]))
+                self.remove(entry['digest'])
+                total -= entry['size']
+                removed.append(entry)
+        return removed
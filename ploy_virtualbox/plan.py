@@ -0,0 +1,65 @@
+"""Planning and applying of ``VBoxManage`` calls.
+
+Configuring a VM is split in two steps. Planning compares the config with
+the current state and returns the ``Action`` objects needed to get from one
+to the other, without changing anything. The plan can then be shown as a
+dry run or applied.
+"""
+from ploy.common import shjoin
+from ploy.common import yesno
+from ploy_virtualbox.vbox import make_cmd_args
+import logging
+import subprocess
+import sys
+
+
+log = logging.getLogger('ploy_virtualbox.plan')
+
+
+class Action(object):
+    """One ``VBoxManage`` call of a plan.
+
+    The ``error`` is logged if the call fails, the ``message`` after it
+    succeeded. A ``question`` has to be confirmed before the plan is
+    applied. With ``check_err`` the call fails if it writes to stderr.
+    """
+
+    def __init__(self, args, kw=None, error=None, message=None, question=None, check_err=True):
+        self.args = tuple(args)
+        self.kw = dict(kw or {})
+        self.error = error
+        self.message = message
+        self.question = question
+        self.check_err = check_err
+
+    @property
+    def cmd_args(self):
+        return make_cmd_args(self.args, self.kw)
+
+    def __str__(self):
+        return shjoin(['VBoxManage'] + self.cmd_args)
+
+    def queue(self, batch):
+        err = b'' if self.check_err else None
+        return batch.queue(*self.args, rc=0, err=err, **self.kw)
+
+
+def apply(vb, actions, batch=False):
+    """Run ``actions`` in order, as one batch if ``batch`` is true.
+
+    All questions are asked before anything is run. Exits after logging the
+    error of the first action which fails.
+    """
+    for action in actions:
+        if action.question is not None and not yesno(action.question):
+            sys.exit(1)
+    with vb.batch(batch) as queue:
+        pending = [(x, x.queue(queue)) for x in actions]
+    for action, result in pending:
+        try:
+            result.get()
+        except subprocess.CalledProcessError as e:
+            log.error("%s:\n%s\n%s" % (action.error, e, e.output))
+            sys.exit(1)
+        if action.message is not None:
+            log.info(action.message)
@@ -0,0 +1,84 @@
+from __future__ import unicode_literals
+from ploy_virtualbox.aiovbox import AsyncVBoxManage
+import asyncio
+import os
+import pytest
+import subprocess
+import time
+
+
+def test_async_vboxmanage(tempdir):
+    executable = tempdir['VBoxManage']
+    executable.fill([
+        '#!/bin/sh',
+        'case "$*" in',
+        '    "list vms") printf \'"foo" {1234}\\n"bar" {5678}\\n\';;',
+        '    "showvminfo --machinereadable foo") printf \'VMState="running"\\nnic1="nat"\\n\';;',
+        '    "guestproperty enumerate foo") printf "Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 10.0.0.2, timestamp: 1, flags: \\n";;',
+        '    *) echo "unknown" >&2; exit 1;;',
+        'esac'])
+    os.chmod(executable.path, 0o755)
+    records = []
+    vb = AsyncVBoxManage(executable=executable.path)
+    vb.call_hooks.append(records.append)
+
+    async def main():
+        return await asyncio.gather(
+            vb.list_vms(),
+            vb.showvminfo('foo'),
+            vb.guestproperty('enumerate', 'foo'))
+
+    (vms, info, gp) = asyncio.run(main())
+    assert vms == {'foo': '1234', 'bar': '5678'}
+    assert info == {'VMState': 'running', 'nic1': 'nat'}
+    assert gp['/VirtualBox/GuestInfo/Net/0/V4/IP']['value'] == '10.0.0.2'
+    assert sorted(x.subcommand for x in records) == ['guestproperty', 'list', 'showvminfo']
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        asyncio.run(vb.list_hostonlyifs())
+    assert e.value.returncode == 1
+    assert e.value.output == b'unknown\n'
+
+
+def test_async_vboxmanage_concurrency(tempdir):
+    executable = tempdir['VBoxManage']
+    executable.fill([
+        '#!/bin/sh',
+        'sleep 0.2'])
+    os.chmod(executable.path, 0o755)
+    vb = AsyncVBoxManage(executable=executable.path, concurrency=2)
+
+    async def main():
+        return await asyncio.gather(*[vb('list', 'vms') for x in range(4)])
+
+    start = time.time()
+    asyncio.run(main())
+    duration = time.time() - start
+    # four calls of 0.2 seconds with two at a time
+    assert duration >= 0.4
+
+
+def test_async_vboxmanage_ssh(tempdir, monkeypatch):
+    log_path = os.path.join(tempdir.directory, 'ssh.log')
+    ssh = tempdir['bin/ssh']
+    ssh.fill([
+        '#!/bin/sh',
+        'echo "$@" >> %s' % log_path,
+        'case "$*" in *"-O exit"*) exit 0;; esac',
+        'for last; do :; done',
+        'exec sh -c "$last"'])
+    os.chmod(ssh.path, 0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (ssh.directory, os.environ['PATH']))
+    vb = AsyncVBoxManage(executable='echo', ssh_args=['-l', 'root', 'vbhost'], host='vbhost')
+
+    async def main():
+        result = await vb('list', 'vms', "it's")
+        await vb.close()
+        return result
+
+    assert asyncio.run(main()) == ["list vms it's"]
+    with open(log_path) as f:
+        (call, close) = f.read().splitlines()
+    assert call.startswith('-o ControlMaster=auto -o ControlPath=')
+    assert call.endswith("-o ControlPersist=60 -l root vbhost -- echo list vms 'it'\"'\"'s'")
+    assert close.endswith('-O exit -l root vbhost')
+    assert vb._control_dir is None
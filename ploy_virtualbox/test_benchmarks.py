@@ -0,0 +1,472 @@
+from __future__ import print_function, unicode_literals
+import os
+import pytest
+import shlex
+import time
+
+
+# artificial latency in seconds added to each VBoxManage invocation, set it
+# to something like 0.05 to see the effect of round trips to remote masters
+LATENCY = float(os.environ.get('PLOY_VIRTUALBOX_BENCH_LATENCY', '0'))
+# the waits of the lifecycle operations are skipped by patching time.sleep
+sleep = time.sleep
+
+
+class FakeVBoxManage:
+    """Minimal stateful VBoxManage for counting and timing invocations.
+
+    Unlike ``popen_mock`` the commands don't have to be listed in order,
+    the fake keeps track of the created VMs and answers accordingly. Batched
+    commands run via ``sh -c`` are interpreted, so a batch counts as one
+    invocation like it would on a real system.
+    """
+
+    def __init__(self, usage, machine_folder, latency=LATENCY):
+        self.usage = usage
+        self.machine_folder = machine_folder
+        self.latency = latency
+        self.vms = {}
+        self.hostonlyifs = {}
+        self.dhcpservers = {}
+        self.calls = []
+
+    def __call__(self, args):
+        start = time.time()
+        if self.latency:
+            sleep(self.latency)
+        if args[:2] == ['sh', '-c']:
+            result = self.run_script(args[2])
+        else:
+            result = self.run(args[1:])
+        self.calls.append((args, time.time() - start))
+        return result
+
+    def run_script(self, script):
+        out = []
+        err = []
+        rc = 0
+        for line in script.splitlines():
+            if line == 'rc=$?':
+                continue
+            elif line.startswith('printf '):
+                parts = shlex.split(line.replace(' >&2', ''))
+                text = parts[1].replace('%%', '%').replace('\\n', '\n')
+                if line.endswith('>&2'):
+                    err.append(text.encode('ascii'))
+                else:
+                    out.append((text % rc).encode('ascii'))
+            elif line.startswith('['):
+                if rc:
+                    break
+            else:
+                (rc, cmd_out, cmd_err) = self.run(shlex.split(line)[1:])
+                out.append(cmd_out)
+                err.append(cmd_err)
+        return (0, b''.join(out), b''.join(err))
+
+    def info_lines(self, vm):
+        return '\n'.join(
+            '%s="%s"' % (k, v)
+            for k, v in sorted(vm.items())).encode('ascii')
+
+    def long_lines(self):
+        attachments = dict(
+            nat="NAT", hostonly="Host-only Interface 'vboxnet0'",
+            bridged="Bridged Interface 'en0'")
+        lines = []
+        for name in sorted(self.vms):
+            vm = self.vms[name]
+            lines.extend([
+                "Name:            %s" % name,
+                "Groups:          /",
+                "UUID:            %s" % vm['UUID'],
+                "State:           %s (since 2024-01-01T00:00:00.000000000)" % (
+                    'powered off' if vm['VMState'] == 'poweroff' else vm['VMState'])])
+            for nic in range(1, 9):
+                nictype = vm.get('nic%d' % nic)
+                if nictype is None:
+                    lines.append("NIC %d:           disabled" % nic)
+                else:
+                    lines.append("NIC %d:           MAC: 080027000000, Attachment: %s, Cable connected: on" % (
+                        nic, attachments[nictype]))
+            lines.append("")
+        return '\n'.join(lines).encode('ascii')
+
+    def run(self, args):
+        if not args:
+            return (0, self.usage, b'')
+        cmd = args[0]
+        name = args[1] if len(args) > 1 else None
+        if name in ('--machinereadable', 'enumerate'):
+            name = args[2]
+        vm = self.vms.get(name)
+        if cmd == '--version':
+            return (0, b'6.1.50r161033\n', b'')
+        elif args[:2] == ['list', 'vms']:
+            return (0, '\n'.join(
+                '"%s" {%s}' % (x, self.vms[x]['UUID'])
+                for x in sorted(self.vms)).encode('ascii'), b'')
+        elif args[:3] == ['list', '--long', 'vms']:
+            return (0, self.long_lines(), b'')
+        elif args[:2] == ['list', 'systemproperties']:
+            return (0, (
+                'Default machine folder:          %s' % self.machine_folder).encode('ascii'), b'')
+        elif args[:2] == ['list', 'hostonlyifs']:
+            return (0, ''.join(
+                'Name:            %s\nIPAddress:       %s\n\n' % (x, self.hostonlyifs[x])
+                for x in sorted(self.hostonlyifs)).encode('ascii'), b'')
+        elif args[:2] == ['list', 'dhcpservers']:
+            return (0, ''.join(
+                'NetworkName:    %s\nIP:             %s\nNetworkMask:    255.255.255.0\n\n' % (x, self.dhcpservers[x])
+                for x in sorted(self.dhcpservers)).encode('ascii'), b'')
+        elif cmd == 'list':
+            return (0, b'', b'')
+        elif args[:2] == ['hostonlyif', 'create']:
+            self.hostonlyifs['vboxnet%d' % len(self.hostonlyifs)] = ''
+            return (0, b'', b'')
+        elif args[:2] == ['hostonlyif', 'ipconfig']:
+            self.hostonlyifs[args[2]] = args[args.index('--ip') + 1]
+            return (0, b'', b'')
+        elif cmd in ('clonemedium', 'modifymedium', 'showmediuminfo'):
+            return (0, b'', b'')
+        elif cmd == 'dhcpserver':
+            self.dhcpservers[args[args.index('--netname') + 1]] = args[args.index('--ip') + 1]
+            return (0, b'', b'')
+        elif cmd == 'createvm':
+            name = args[args.index('--name') + 1]
+            self.vms[name] = dict(
+                name=name, UUID='%08d' % len(self.vms), VMState='poweroff')
+            return (0, b'', b'')
+        elif vm is None:
+            return (1, b'', b'VBoxManage: error: Could not find a registered machine named %s' % name.encode('ascii'))
+        elif cmd == 'showvminfo':
+            return (0, self.info_lines(vm), b'')
+        elif cmd == 'modifyvm':
+            for key, value in zip(args[2::2], args[3::2]):
+                vm[key[2:]] = value
+        elif cmd == 'storagectl':
+            index = len([x for x in vm if x.startswith('storagecontrollername')])
+            vm['storagecontrollername%d' % index] = args[args.index('--name') + 1]
+        elif cmd == 'storageattach':
+            vm['%s-%s-0' % (
+                args[args.index('--storagectl') + 1],
+                args[args.index('--port') + 1])] = args[args.index('--medium') + 1]
+        elif cmd == 'startvm':
+            vm['VMState'] = 'running'
+        elif cmd == 'controlvm':
+            vm['VMState'] = 'poweroff'
+        elif cmd == 'unregistervm':
+            del self.vms[name]
+        elif cmd == 'guestproperty':
+            return (0, b'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 192.168.56.3, timestamp: 1, flags: ', b'')
+        return (0, b'', b'')
+
+    def count(self, cmd=None):
+        if cmd is None:
+            return len(self.calls)
+        return len([x for x in self.calls if x[0][1:2] == [cmd]])
+
+    def report(self, name):
+        total = sum(x[1] for x in self.calls)
+        print("%s: %d invocations, %.1f ms" % (name, len(self.calls), total * 1000))
+        for args, duration in self.calls:
+            if args[:2] == ['sh', '-c']:
+                args = ['sh', '-c', '(batch of %d commands)' % args[2].count('rc=$?')]
+            print("    %6.1f ms %s" % (duration * 1000, ' '.join(args)[:100]))
+        self.calls = []
+
+
+@pytest.fixture(params=['local', 'remote'])
+def bench(request, tempdir, monkeypatch):
+    from ploy import Controller
+    import ploy.plain
+    import pkg_resources
+    import ploy_virtualbox
+    fake = FakeVBoxManage(
+        pkg_resources.resource_string('ploy_virtualbox', 'vboxmanage6.txt'),
+        tempdir.directory)
+
+    class Popen:
+        def __init__(self, cmd_args, **kw):
+            self.cmd_args = list(cmd_args)
+
+        def communicate(self, input=None):
+            (self.returncode, out, err) = fake(self.cmd_args)
+            return (out, err)
+
+    monkeypatch.setattr('subprocess.Popen', Popen)
+    monkeypatch.setattr(
+        'ploy.common.InstanceExecutor._run',
+        lambda self, args, stdin: fake(list(args)))
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    config = [
+        '[global]',
+        'cache_dir = %s' % os.path.join(tempdir.directory, 'cache'),
+        '[plain-instance:host]',
+        'host = localhost']
+    if request.param == 'remote':
+        config.extend([
+            '[vb-master:default]',
+            'instance = host',
+            # there is no ssh connection to keep alive
+            'ssh-keepalive = 0'])
+    ployconf = tempdir['etc/ploy.conf']
+    fake.configure = lambda lines: ployconf.fill(config + lines, allow_conf=True)
+    fake.ctrl = Controller(configpath=ployconf.directory)
+    fake.ctrl.plugins = {
+        'plain': ploy.plain.plugin,
+        'virtualbox': ploy_virtualbox.plugin}
+    fake.remote = request.param == 'remote'
+    return fake
+
+
+def lifecycle(bench, name):
+    bench.ctrl(['./bin/ploy', 'start', name])
+    counts = dict(start=bench.count())
+    bench.report('start')
+    bench.ctrl(['./bin/ploy', 'status', name])
+    counts['status'] = bench.count()
+    bench.report('status')
+    bench.ctrl(['./bin/ploy', 'stop', name])
+    counts['stop'] = bench.count()
+    bench.report('stop')
+    bench.ctrl(['./bin/ploy', 'start', name])
+    counts['restart'] = bench.count()
+    bench.report('restart')
+    bench.ctrl(['./bin/ploy', 'terminate', name])
+    counts['terminate'] = bench.count()
+    bench.report('terminate')
+    return counts
+
+
+def test_lifecycle_minimal(bench, yesno_mock):
+    bench.configure(['[vb-instance:foo]'])
+    yesno_mock.expected = [
+        ("Are you sure you want to terminate 'vb-instance:foo'?", True)]
+    counts = lifecycle(bench, 'foo')
+    assert bench.vms == {}
+    if bench.remote:
+        # the remote master additionally asks for the VBoxManage version
+        # to look up the cached command table
+        assert counts == dict(start=8, status=1, stop=3, restart=3, terminate=5)
+    else:
+        assert counts == dict(start=7, status=1, stop=3, restart=3, terminate=5)
+
+
+def test_lifecycle_many_storages(bench, tempdir, yesno_mock):
+    storages = [
+        '    --medium %s' % os.path.join(tempdir.directory, 'disk%d.vdi' % x)
+        for x in range(16)]
+    bench.configure([
+        '[vb-instance:foo]',
+        'storage ='] + storages)
+    yesno_mock.expected = [
+        ("Are you sure you want to terminate 'vb-instance:foo'?", True)]
+    counts = lifecycle(bench, 'foo')
+    # on restart the media are already attached, so nothing is changed
+    if bench.remote:
+        # storagectl and storageattach are batched into one invocation
+        assert counts == dict(start=9, status=1, stop=3, restart=3, terminate=5)
+    else:
+        assert counts == dict(start=24, status=1, stop=3, restart=3, terminate=5)
+
+
+def test_lifecycle_many_nics(bench, yesno_mock):
+    nics = ['vm-nic%d = nat' % x for x in range(1, 9)]
+    bench.configure(['[vb-instance:foo]'] + nics)
+    yesno_mock.expected = [
+        ("Are you sure you want to terminate 'vb-instance:foo'?", True)]
+    counts = lifecycle(bench, 'foo')
+    # on restart the nics are already set, so modifyvm is skipped
+    if bench.remote:
+        assert counts == dict(start=9, status=1, stop=3, restart=3, terminate=5)
+    else:
+        assert counts == dict(start=8, status=1, stop=3, restart=3, terminate=5)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    duration = time.time() - start
+    print("%s: %.1f ms" % (func.__name__, duration * 1000))
+    return result
+
+
+def test_parse_list_result():
+    from ploy_virtualbox.vbox import parse_list_result
+    lines = ['"key%d"="value %d"' % (x, x) for x in range(20000)]
+    result = timed(parse_list_result, '=', lines)
+    assert len(result) == 20000
+    assert result['key123'] == 'value 123'
+
+
+def test_parse_vminfo():
+    from ploy_virtualbox.vbox import parse_vminfo
+    lines = ['name="foo"', 'VMState="running"']
+    for x in range(500):
+        lines.extend([
+            'storagecontrollername%d="ctl%d"' % (x, x),
+            'storagecontrollertype%d="IntelAhci"' % x,
+            'storagecontrollerportcount%d="30"' % x,
+            '"ctl%d-0-0"="/vms/foo/disk%d.vdi"' % (x, x)])
+    info = timed(parse_vminfo, lines)
+    assert info.state == 'running'
+    start = time.time()
+    for x in range(100):
+        storagectls = info.group('storagecontroller', namekey='name')
+    print("100 lookups of storage controllers: %.1f ms" % ((time.time() - start) * 1000))
+    assert storagectls['ctl123'] == dict(name='ctl123', type='IntelAhci', portcount='30')
+
+
+def test_list_vms():
+    from ploy_virtualbox.vbox import VBoxManage
+    lines = ['"vm%d" {%08d}' % (x, x) for x in range(5000)]
+    vb = VBoxManage()
+    vb.executor = lambda *args, **kw: lines
+    result = timed(vb.list_vms)
+    assert len(result) == 5000
+    assert result['vm123'] == '00000123'
+
+
+def test_guestproperty():
+    from ploy_virtualbox.vbox import VBoxManage
+    lines = [
+        'Name: /VirtualBox/GuestInfo/Prop/%d, value: %d, timestamp: 1, flags: TRANSIENT, RDONLYGUEST' % (x, x)
+        for x in range(20000)]
+    vb = VBoxManage()
+    vb.executor = lambda *args, **kw: lines
+    result = timed(vb.guestproperty, 'foo', 'enumerate')
+    assert len(result) == 20000
+    assert result['/VirtualBox/GuestInfo/Prop/123']['flags'] == ['TRANSIENT', 'RDONLYGUEST']
+
+
+def test_parse_commands():
+    from ploy_virtualbox.vbox import parse_commands
+    import pkg_resources
+    usage = pkg_resources.resource_string(
+        'ploy_virtualbox', 'vboxmanage6.txt').decode('ascii').splitlines()
+    commands = timed(parse_commands, usage * 20)
+    assert 'clonevm' in commands
+    assert 'showvminfo' in commands
+
+
+def test_fleet_status(bench):
+    names = ['vm%02d' % x for x in range(20)]
+    bench.configure(['[vb-instance:%s]' % x for x in names])
+    for index, name in enumerate(names):
+        bench.vms[name] = dict(
+            name=name, UUID='%08d' % index,
+            VMState='running' if index % 2 else 'poweroff',
+            nic1='nat', nic2='hostonly')
+    bench.ctrl(['./bin/ploy', 'vb-fleet', 'status'])
+    # one listing for all VMs and the guest properties of running VMs
+    assert bench.count('list') == 1
+    assert bench.count('guestproperty') == 10
+    assert bench.count() == 11
+    bench.report('fleet status')
+
+
+def test_fleet_start_shared_network(bench):
+    names = ['vm%02d' % x for x in range(10)]
+    config = [
+        '[vb-hostonlyif:vboxnet0]',
+        'ip = 192.168.56.1',
+        '[vb-dhcpserver:vboxnet0]',
+        'ip = 192.168.56.2',
+        'netmask = 255.255.255.0',
+        'lowerip = 192.168.56.100',
+        'upperip = 192.168.56.254']
+    for name in names:
+        config.extend([
+            '[vb-instance:%s]' % name,
+            'vm-nic1 = hostonly',
+            'vm-hostonlyadapter1 = vboxnet0'])
+    bench.configure(config)
+    bench.ctrl(['./bin/ploy', 'vb-fleet', 'start'])
+    assert bench.hostonlyifs == {'vboxnet0': '192.168.56.1'}
+    # the network is listed and set up once for all instances
+    assert len([x for x in bench.calls if x[0][1:3] == ['list', 'hostonlyifs']]) == 1
+    assert len([x for x in bench.calls if x[0][1:3] == ['list', 'dhcpservers']]) == 1
+    assert bench.count('hostonlyif') == 2
+    assert bench.count('dhcpserver') == 1
+    bench.report('fleet start with shared network')
+
+
+def test_fleet_start_modifies_network_up_front(bench, monkeypatch):
+    import threading
+    names = ['vm%02d' % x for x in range(4)]
+    config = [
+        '[vb-hostonlyif:vboxnet0]',
+        'ip = 192.168.56.1',
+        '[vb-dhcpserver:vboxnet0]',
+        'ip = 192.168.56.2',
+        'netmask = 255.255.255.0',
+        'lowerip = 192.168.56.100',
+        'upperip = 192.168.56.254']
+    for name in names:
+        config.extend([
+            '[vb-instance:%s]' % name,
+            'vm-nic1 = hostonly',
+            'vm-hostonlyadapter1 = vboxnet0'])
+    bench.configure(config)
+    bench.hostonlyifs['vboxnet0'] = '192.168.56.1'
+    bench.dhcpservers['HostInterfaceNetworking-vboxnet0'] = '192.168.56.3'
+    questions = []
+
+    def yesno(question):
+        questions.append((question, threading.current_thread()))
+        return True
+
+    monkeypatch.setattr('ploy_virtualbox.plan.yesno', yesno)
+    bench.ctrl(['./bin/ploy', 'vb-fleet', 'start', '-j', '4'])
+    # the question is asked once, before the worker threads are started
+    assert questions == [(
+        "Should the dhcpserver 'vboxnet0' be modified to match the config?",
+        threading.current_thread())]
+    assert bench.dhcpservers == {'HostInterfaceNetworking-vboxnet0': '192.168.56.2'}
+    assert len(bench.vms) == 4
+
+
+def test_fleet_start_template(bench, tempdir):
+    if bench.remote:
+        pytest.skip("templates are only supported for local masters")
+    names = ['vm%02d' % x for x in range(10)]
+    tempdir['base.vdi'].fill('base image')
+    config = [
+        '[vb-template:base]',
+        'medium = %s' % os.path.join(tempdir.directory, 'base.vdi'),
+        'directory = %s' % os.path.join(tempdir.directory, 'templates')]
+    for name in names:
+        config.extend([
+            '[vb-instance:%s]' % name,
+            'storage = --medium vb-template:base'])
+    bench.configure(config)
+    bench.ctrl(['./bin/ploy', 'vb-fleet', 'start'])
+    # the template is baked once and attached to all instances, VirtualBox
+    # gives each of them a differencing disk
+    assert bench.count('clonemedium') == 1
+    assert bench.count('modifymedium') == 1
+    assert len(bench.vms) == 10
+    assert len(set(x['sata-0-0'] for x in bench.vms.values())) == 1
+    bench.report('fleet start with template')
+
+
+def test_fleet_terminate(bench, monkeypatch, yesno_mock):
+    names = ['vm%02d' % x for x in range(20)]
+    bench.configure(['[vb-instance:%s]' % x for x in names])
+    for index, name in enumerate(names):
+        bench.vms[name] = dict(
+            name=name, UUID='%08d' % index,
+            VMState='running' if index % 2 else 'poweroff')
+    monkeypatch.setattr('ploy_virtualbox.yesno', yesno_mock)
+    yesno_mock.expected = [
+        ("Are you sure you want to terminate 20 instances?", True)]
+    bench.ctrl(['./bin/ploy', 'vb-fleet', 'terminate'])
+    assert bench.vms == {}
+    # the running VMs are powered off together and waited for with one
+    # listing instead of polling showvminfo per VM
+    assert bench.count('controlvm') == 10
+    assert bench.count('unregistervm') == 20
+    assert len([x for x in bench.calls if x[0][1:3] == ['list', '--long']]) == 2
+    assert bench.count('showvminfo') == 20
+    bench.report('fleet terminate')
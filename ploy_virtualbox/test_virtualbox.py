@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 import logging
 import os
+import subprocess
 import pytest
 
 
@@ -34,6 +35,66 @@ def popen_mock(monkeypatch):
     yield Popen
 
 
+@pytest.yield_fixture
+def http_server():
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:  # pragma: nocover
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import threading
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            server = self.server
+            data = server.files[self.path]
+            server.requests.append((self.path, self.headers.get('Range')))
+            start = 0
+            if self.headers.get('Range') and server.ranges:
+                start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(data) - start))
+            self.end_headers()
+            data = data[start:]
+            if server.drop_after:
+                # simulate a dropped connection
+                data = data[:server.drop_after]
+                server.drop_after = None
+            self.wfile.write(data)
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.files = {}
+    server.requests = []
+    server.ranges = True
+    server.drop_after = None
+    server.url = 'http://127.0.0.1:%s' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def ployconf(confmaker, tempdir):
+    ployconf = confmaker('etc/ploy.conf')
+    fill = ployconf.fill
+
+    def _fill(content):
+        # keep the caches out of the home directory
+        fill([
+            '[global]',
+            'cache_dir = %s' % os.path.join(tempdir.directory, 'cache')] + list(content))
+
+    ployconf.fill = _fill
+    return ployconf
+
+
 @pytest.yield_fixture
 def ctrl(ployconf):
     from ploy import Controller
@@ -90,6 +151,49 @@ class VMInfo:
         return self
 
 
+long_list_attachments = dict(
+    nat="NAT",
+    hostonly="Host-only Interface 'vboxnet0'",
+    bridged="Bridged Interface 'en0'")
+
+
+def vms_long(*vms):
+    """Build ``list --long vms`` output from ``(name, state, nics)`` tuples."""
+    lines = []
+    for index, (name, state, nics) in enumerate(vms):
+        lines.extend([
+            "Name:                        %s" % name,
+            "Groups:                      /",
+            "Guest OS:                    Other/Unknown",
+            "UUID:                        00000000-0000-0000-0000-%012d" % index,
+            "Config file:                 /vms/%s/%s.vbox" % (name, name),
+            "Memory size                  %dMB" % (128 * (index + 1)),
+            "Number of CPUs:              %d" % (index + 1),
+            "State:                       %s (since 2024-01-01T00:00:00.000000000)" % state])
+        for nic in range(1, 5):
+            if nic <= len(nics):
+                lines.append(
+                    "NIC %d:                       MAC: 08002700000%d, Attachment: %s, Cable connected: on, Trace: off (file: none), Type: 82540EM, Reported speed: 0 Mbps, Boot priority: 0, Promisc Policy: deny, Bandwidth group: none" % (
+                        nic, nic, long_list_attachments[nics[nic - 1]]))
+            else:
+                lines.append("NIC %d:                       disabled" % nic)
+        lines.extend([
+            "NIC 1 Settings:  MTU: 0, Socket (send: 64, receive: 64), TCP Window (send:64, receive: 64)",
+            "",
+            "Shared folders:",
+            "",
+            "Name: 'share', Host path: '/tmp' (machine mapping), writable",
+            "",
+            "USB Device Filters:",
+            "",
+            "Index:                       0",
+            "Active:                      yes",
+            "Name:                        filter",
+            "VendorId:                    1234",
+            ""])
+    return '\n'.join(lines).encode('ascii')
+
+
 def test_start(ctrl, popen_mock, tempdir, vbm_infos, caplog):
     import uuid
     uid = str(uuid.uuid4()).encode('ascii')
@@ -101,8 +205,6 @@ def test_start(ctrl, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
     assert popen_mock.expect == []
@@ -119,6 +221,7 @@ def test_start_status(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
         '[vb-instance:foo]',
         'vm-nic1 = hostonly'])
     vminfo = VMInfo()
+    vminfo._info['nic1'] = "'hostonly'"
     popen_mock.expect = [
         (['VBoxManage', 'list', 'vms'], 0, b'', b''),
         (['VBoxManage'], 0, vbm_infos['usage'], b''),
@@ -126,14 +229,10 @@ def test_start_status(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'modifyvm', 'foo', '--nic1', 'hostonly'], 0, b'', b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.nic('hostonly'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
+        # nic1 is already set, so modifyvm isn't needed
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
-        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
-        (['VBoxManage', 'guestproperty', 'enumerate', 'foo'], 0, b'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 192.168.56.3, timestamp: 1, flags: ', b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b'')]
+        (['VBoxManage', 'list', '--long', 'vms'], 0, vms_long(('foo', 'running', ['hostonly'])), b''),
+        (['VBoxManage', 'guestproperty', 'enumerate', 'foo'], 0, b'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 192.168.56.3, timestamp: 1, flags: ', b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
     ctrl(['./bin/ploy', 'status', 'foo'])
     assert popen_mock.expect == []
@@ -156,12 +255,9 @@ def test_start_stop(ctrl, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'controlvm', 'foo', 'poweroff'], 0, b'', b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
     ctrl(['./bin/ploy', 'stop', 'foo'])
@@ -186,12 +282,9 @@ def test_start_stop_stop(ctrl, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'controlvm', 'foo', 'poweroff'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b'')]
@@ -221,15 +314,11 @@ def test_start_stop_status(ctrl, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'controlvm', 'foo', 'poweroff'], 0, b'', b''),
-        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b'')]
+        (['VBoxManage', 'list', '--long', 'vms'], 0, vms_long(('foo', 'powered off', [])), b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
     ctrl(['./bin/ploy', 'stop', 'foo'])
     ctrl(['./bin/ploy', 'status', 'foo'])
@@ -256,16 +345,11 @@ def test_start_stop_acpi(ctrl, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'controlvm', 'foo', 'acpipowerbutton'], 0, b'', b''),
-        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('stopping'), b''),
-        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
     ctrl(['./bin/ploy', 'stop', 'foo'])
@@ -279,9 +363,12 @@ def test_start_stop_acpi(ctrl, popen_mock, tempdir, vbm_infos, caplog):
         "Instance stopped"]
 
 
-def test_start_stop_acpi_force(ctrl, popen_mock, tempdir, vbm_infos, monkeypatch, caplog):
+def test_start_stop_acpi_force(ctrl, ployconf, popen_mock, tempdir, vbm_infos, monkeypatch, caplog):
     import uuid
     uid = str(uuid.uuid4()).encode('ascii')
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'stop-timeout = 2'])
     vminfo = VMInfo()
     vminfo._info['acpi'] = '"on"'
     popen_mock.expect = [
@@ -291,21 +378,24 @@ def test_start_stop_acpi_force(ctrl, popen_mock, tempdir, vbm_infos, monkeypatch
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'controlvm', 'foo', 'acpipowerbutton'], 0, b'', b''),
-        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b'')]
-    for i in range(59):
-        popen_mock.expect.extend([
-            (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
-            (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b'')])
+        (['VBoxManage', 'controlvm', 'foo', 'acpipowerbutton'], 0, b'', b'')]
+    # polls after 0, 0.125, 0.375, 0.875, 1.875 and 2 seconds
+    for i in range(6):
+        popen_mock.expect.append(
+            (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''))
     popen_mock.expect.append((['VBoxManage', 'controlvm', 'foo', 'poweroff'], 0, b'', b''))
-    monkeypatch.setattr('time.sleep', lambda d: None)
+    clock = [0]
+    sleeps = []
+
+    def sleep(delay):
+        sleeps.append(delay)
+        clock[0] += delay
+
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    monkeypatch.setattr('time.sleep', sleep)
     ctrl(['./bin/ploy', 'start', 'foo'])
     ctrl(['./bin/ploy', 'stop', 'foo'])
     assert popen_mock.expect == []
@@ -317,6 +407,7 @@ def test_start_stop_acpi_force(ctrl, popen_mock, tempdir, vbm_infos, monkeypatch
         "Trying to stop instance with ACPI:",
         "Stopping instance by sending 'poweroff'.",
         "Instance stopped"]
+    assert sleeps == [0.125, 0.25, 0.5, 1.0, 0.125]
 
 
 def test_start_terminate(ctrl, popen_mock, tempdir, vbm_infos, yesno_mock, caplog):
@@ -330,13 +421,10 @@ def test_start_terminate(ctrl, popen_mock, tempdir, vbm_infos, yesno_mock, caplo
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
         (['VBoxManage', 'controlvm', 'foo', 'poweroff'], 0, b'', b''),
-        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
         (['VBoxManage', 'unregistervm', 'foo', '--delete'], 0, b'', b'')]
     yesno_mock.expected = [
@@ -365,12 +453,9 @@ def test_start_stop_terminate(ctrl, popen_mock, tempdir, vbm_infos, yesno_mock,
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'controlvm', 'foo', 'poweroff'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
@@ -409,11 +494,8 @@ def test_start_with_hdd(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'storagectl', 'foo', '--name', 'sata', '--add', 'sata'], 0, b'', b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.storagectl(name='sata'), b''),
         (['VBoxManage', 'createhd', '--filename', boot_vdi, '--format', 'VDI', '--size', '102400'], 0, b'', b''),
+        (['VBoxManage', 'storagectl', 'foo', '--name', 'sata', '--add', 'sata'], 0, b'', b''),
         (['VBoxManage', 'storageattach', 'foo', '--medium', boot_vdi, '--port', '0', '--storagectl', 'sata', '--type', 'hdd'], 0, b'', b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
@@ -425,6 +507,308 @@ def test_start_with_hdd(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
         "Instance started"]
 
 
+def test_start_existing_modifies_changed_options(ctrl, ployconf, popen_mock, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'vm-cpus = 2',
+        'vm-memory = 512',
+        'vm-natpf1 = ssh,tcp,,47023,,22',
+        'vm-natpf2 = http,tcp,,8080,,80',
+        'vm-nic1 = nat'])
+    vminfo = VMInfo()
+    vminfo._info.update({
+        'cpus': '1',
+        'memory': '512',
+        'nic1': '"nat"',
+        'Forwarding(0)': '"ssh,tcp,,47022,,22"',
+        'Forwarding(1)': '"http,tcp,,8080,,80"'})
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage', 'modifyvm', 'foo', '--cpus', '2', '--natpf1', 'delete', 'ssh', '--natpf1', 'ssh,tcp,,47023,,22'], 0, b'', b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Starting instance 'vb-instance:foo'",
+        "Instance started"]
+
+
+def test_start_existing_normalizes_options(ctrl, ployconf, popen_mock, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'vm-ostype = Debian_64',
+        'vm-uart1 = 0x3F8 4'])
+    vminfo = VMInfo()
+    vminfo._info.update({
+        'ostype': '"Debian (64-bit)"',
+        'uart1': '"0x03f8,4"'})
+    ostypes = (
+        b'ID:          Debian\n'
+        b'Description: Debian (32-bit)\n'
+        b'Family ID:   Linux\n'
+        b'\n'
+        b'ID:          Debian_64\n'
+        b'Description: Debian (64-bit)\n'
+        b'Family ID:   Linux\n')
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage', 'list', 'ostypes'], 0, ostypes, b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    # there is no modifyvm call
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Starting instance 'vb-instance:foo'",
+        "Instance started"]
+
+
+def test_plan_cmd(ctrl, ployconf, popen_mock, tempdir, vbm_infos, capsys):
+    ployconf.fill([
+        '[vb-disk:boot]',
+        'size = 102400',
+        '[vb-instance:foo]',
+        'headless = true',
+        'vm-memory = 512',
+        'storage = --medium vb-disk:boot'])
+    boot_vdi = os.path.join(tempdir.directory, 'foo', 'boot.vdi')
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b'')]
+    ctrl(['./bin/ploy', 'vb-plan', 'foo'])
+    assert popen_mock.expect == []
+    # nothing is created, the disk is only planned
+    assert not os.path.exists(boot_vdi)
+    assert capsys.readouterr()[0].splitlines() == [
+        "VBoxManage createvm --name foo --basefolder %s --ostype Other --register" % tempdir.directory,
+        "VBoxManage createhd --filename %s --format VDI --size 102400" % boot_vdi,
+        "VBoxManage modifyvm foo --memory 512",
+        "VBoxManage storagectl foo --name sata --add sata",
+        "VBoxManage storageattach foo --medium %s --port 0 --storagectl sata --type hdd" % boot_vdi,
+        "VBoxManage startvm foo --type headless"]
+
+
+def test_plan_cmd_configured(ctrl, ployconf, popen_mock, tempdir, capsys):
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    ployconf.fill([
+        '[vb-disk:boot]',
+        'size = 102400',
+        '[vb-instance:foo]',
+        'basefolder = %s' % tempdir.directory,
+        'vm-memory = 512',
+        'storage = --medium vb-disk:boot'])
+    boot_vdi = os.path.join(tempdir.directory, 'foo', 'boot.vdi')
+    tempdir['foo/boot.vdi'].fill('')
+    vminfo = VMInfo().storagectl(name='sata')
+    vminfo._info['VMState'] = "'poweroff'"
+    vminfo._info['memory'] = '512'
+    vminfo._info['"sata-0-0"'] = '"%s"' % boot_vdi
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo, b'')]
+    ctrl(['./bin/ploy', 'vb-plan', 'foo'])
+    assert popen_mock.expect == []
+    # everything already matches, so only starting is left
+    assert capsys.readouterr()[0].splitlines() == [
+        "VBoxManage startvm foo"]
+
+
+def test_start_with_template(ctrl, ployconf, popen_mock, monkeypatch, tempdir, vbm_infos, caplog):
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    base = os.path.join(tempdir.directory, 'base.vdi')
+    tempdir['base.vdi'].fill('base image')
+    ployconf.fill([
+        '[vb-template:base]',
+        'medium = %s' % base,
+        'directory = %s' % os.path.join(tempdir.directory, 'templates'),
+        'provision = virt-customize -a $PLOY_TEMPLATE_MEDIUM',
+        '[vb-instance:foo]',
+        'storage = --medium vb-template:base'])
+    ctrl.configfile = ployconf.path
+    instance = ctrl.instances['foo']
+    template = instance.master.templates['base'].path(instance)
+    caplog.clear()
+    provisioned = []
+    monkeypatch.setattr(
+        'subprocess.call',
+        lambda cmd, shell, env: provisioned.append((cmd, env['PLOY_TEMPLATE_MEDIUM'])) or 0)
+    vminfo = VMInfo()
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b''),
+        (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage', 'clonemedium', 'disk', base, template, '--format', 'VDI'], 0, b'', b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', template], 0, b'UUID:           1234\nType:           normal (base)\n', b''),
+        (['VBoxManage', 'modifymedium', 'disk', template, '--type', 'multiattach'], 0, b'', b''),
+        (['VBoxManage', 'storagectl', 'foo', '--name', 'sata', '--add', 'sata'], 0, b'', b''),
+        (['VBoxManage', 'storageattach', 'foo', '--medium', template, '--port', '0', '--storagectl', 'sata', '--type', 'hdd'], 0, b'', b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    assert provisioned == [('virt-customize -a $PLOY_TEMPLATE_MEDIUM', template)]
+    assert os.path.exists("%s.json" % template)
+    # the checksum of the base image is remembered in the cache directory
+    assert not os.path.exists("%s.digests" % base)
+    assert os.listdir(os.path.join(tempdir.directory, 'cache', 'digests'))
+    assert caplog_messages(caplog) == [
+        "Creating instance 'foo'",
+        "Baking template 'base' to '%s'." % template,
+        "Provisioning template 'base': virt-customize -a $PLOY_TEMPLATE_MEDIUM",
+        "Adding default 'sata' controller.",
+        "Starting instance 'vb-instance:foo'",
+        "Instance started"]
+
+
+@pytest.mark.parametrize("master", [
+    ['[vb-master:remote]', 'instance = host'],
+    ['[vb-master:a]', '[vb-pool:remote]', 'masters = a']])
+def test_template_requires_local_master(ctrl, ployconf, tempdir, caplog, master):
+    tempdir['base.vdi'].fill('base image')
+    ployconf.fill([
+        '[plain-instance:host]',
+        'host = localhost',
+        '[vb-template:base]',
+        'medium = %s' % os.path.join(tempdir.directory, 'base.vdi'),
+        '[vb-instance:foo]',
+        'master = remote',
+        'storage = --medium vb-template:base'] + master)
+    ctrl.configfile = ployconf.path
+    instance = ctrl.instances['foo']
+    with pytest.raises(SystemExit):
+        instance.master.templates['base'].path(instance)
+    assert caplog_messages(caplog) == [
+        "The vb-template 'base' used by 'vb-instance:foo' is only supported for local masters, not for 'remote'."]
+
+
+def test_plan_template_child_attached(ctrl, ployconf, popen_mock, tempdir, capsys):
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    tempdir['base.vdi'].fill('base image')
+    ployconf.fill([
+        '[vb-template:base]',
+        'medium = %s' % os.path.join(tempdir.directory, 'base.vdi'),
+        'directory = %s' % os.path.join(tempdir.directory, 'templates'),
+        '[vb-instance:foo]',
+        'basefolder = %s' % tempdir.directory,
+        'storage = --medium vb-template:base'])
+    ctrl.configfile = ployconf.path
+    instance = ctrl.instances['foo']
+    template = instance.master.templates['base'].path(instance)
+    tempdir['templates/%s.json' % os.path.basename(template)].fill('{}')
+    snapshots = os.path.join(tempdir.directory, 'foo', 'Snapshots')
+    child = os.path.join(snapshots, '{5678}.vdi')
+    vminfo = VMInfo().storagectl(name='sata')
+    vminfo._info['VMState'] = "'poweroff'"
+    vminfo._info['SnapFldr'] = '"%s"' % snapshots
+    vminfo._info['"sata-0-0"'] = '"%s"' % child
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo, b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', template], 0, b'UUID:           1234\n', b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', child], 0, b'UUID:           5678\nParent UUID:    1234\n', b'')]
+    ctrl(['./bin/ploy', 'vb-plan', 'foo'])
+    assert popen_mock.expect == []
+    # the differencing disk of the template is kept
+    assert capsys.readouterr()[0].splitlines() == [
+        "VBoxManage startvm foo"]
+
+
+def test_plan_template_not_baked(ctrl, ployconf, popen_mock, tempdir, capsys):
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    base = os.path.join(tempdir.directory, 'base.vdi')
+    tempdir['base.vdi'].fill('base image')
+    ployconf.fill([
+        '[vb-template:base]',
+        'medium = %s' % base,
+        'directory = %s' % os.path.join(tempdir.directory, 'templates'),
+        '[vb-instance:foo]',
+        'basefolder = %s' % tempdir.directory,
+        'storage = --medium vb-template:base'])
+    ctrl.configfile = ployconf.path
+    instance = ctrl.instances['foo']
+    template = instance.master.templates['base'].path(instance)
+    snapshots = os.path.join(tempdir.directory, 'foo', 'Snapshots')
+    child = os.path.join(snapshots, '{5678}.vdi')
+    vminfo = VMInfo().storagectl(name='sata')
+    vminfo._info['VMState'] = "'poweroff'"
+    vminfo._info['SnapFldr'] = '"%s"' % snapshots
+    vminfo._info['"sata-0-0"'] = '"%s"' % child
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo, b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', template], 1, b'', b'Could not find file')]
+    ctrl(['./bin/ploy', 'vb-plan', 'foo'])
+    assert popen_mock.expect == []
+    # the new template replaces the differencing disk of the old one
+    assert capsys.readouterr()[0].splitlines() == [
+        "VBoxManage clonemedium disk %s %s --format VDI" % (base, template),
+        "VBoxManage modifymedium disk %s --type multiattach" % template,
+        "VBoxManage storageattach foo --medium %s --port 0 --storagectl sata --type hdd" % template,
+        "VBoxManage startvm foo"]
+
+
+def test_start_resolves_media_concurrently(ctrl, ployconf, popen_mock, monkeypatch, tempdir, vbm_infos):
+    import threading
+    import uuid
+    if ployconf.path.endswith('.yml'):
+        pytest.skip("multi line storage isn't supported in YAML")
+    uid = str(uuid.uuid4()).encode('ascii')
+    ployconf.fill([
+        '[vb-disk:boot]',
+        'size = 102400',
+        '[vb-disk:data]',
+        'size = 204800',
+        '[vb-instance:foo]',
+        'storage =',
+        '    --medium vb-disk:boot',
+        '    --medium vb-disk:data --port 1',
+        '    --medium vb-disk:boot --port 2 --type dvddrive'])
+    vminfo = VMInfo()
+    boot_vdi = os.path.join(tempdir.directory, 'foo', 'boot.vdi')
+    data_vdi = os.path.join(tempdir.directory, 'foo', 'data.vdi')
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b''),
+        (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage', 'storagectl', 'foo', '--name', 'sata', '--add', 'sata'], 0, b'', b''),
+        (['VBoxManage', 'storageattach', 'foo', '--medium', boot_vdi, '--port', '0', '--storagectl', 'sata', '--type', 'hdd'], 0, b'', b''),
+        (['VBoxManage', 'storageattach', 'foo', '--medium', data_vdi, '--port', '1', '--storagectl', 'sata', '--type', 'hdd'], 0, b'', b''),
+        (['VBoxManage', 'storageattach', 'foo', '--medium', boot_vdi, '--port', '2', '--storagectl', 'sata', '--type', 'dvddrive'], 0, b'', b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    created = []
+    both_running = threading.Event()
+    communicate = popen_mock.communicate
+
+    def createhd(self, input=None):
+        if self.cmd_args[1:2] != ['createhd']:
+            return communicate(self, input)
+        created.append(self.cmd_args[3])
+        if len(created) == 2:
+            both_running.set()
+        # each call only returns once the other one was started
+        assert both_running.wait(5)
+        self.returncode = 0
+        return (b'', b'')
+
+    monkeypatch.setattr(popen_mock, 'communicate', createhd)
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    # the disk used twice is only created once
+    assert sorted(created) == [boot_vdi, data_vdi]
+
+
 def test_start_with_dvd(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
     import uuid
     uid = str(uuid.uuid4()).encode('ascii')
@@ -442,10 +826,7 @@ def test_start_with_dvd(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
         (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
         (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
         (['VBoxManage', 'storagectl', 'foo', '--name', 'sata', '--add', 'sata'], 0, b'', b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.storagectl(name='sata'), b''),
         (['VBoxManage', 'storageattach', 'foo', '--medium', medium, '--port', '0', '--storagectl', 'sata', '--type', 'dvddrive'], 0, b'', b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
@@ -459,7 +840,7 @@ def test_start_with_dvd(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
 
 def test_status(ctrl, popen_mock, caplog):
     popen_mock.expect = [
-        (['VBoxManage', 'list', 'vms'], 0, b'', b'')]
+        (['VBoxManage', 'list', '--long', 'vms'], 0, b'', b'')]
     ctrl(['./bin/ploy', 'status', 'foo'])
     assert popen_mock.expect == []
     assert caplog_messages(caplog) == [
@@ -486,78 +867,1215 @@ def test_terminate(ctrl, popen_mock, yesno_mock, caplog):
         "Instance 'foo' unavailable"]
 
 
-def test_dhcpserver(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
-    import uuid
-    uid = str(uuid.uuid4()).encode('ascii')
-    hoifuid = str(uuid.uuid4()).encode('ascii')
+def test_suspend(ctrl, ployconf, popen_mock, vbm_infos, caplog):
     ployconf.fill([
-        '[vb-dhcpserver:vboxnet0]',
-        'ip = 192.168.56.2',
-        'netmask = 255.255.255.0',
-        'lowerip = 192.168.56.100',
-        'upperip = 192.168.56.254',
-        '[vb-hostonlyif:vboxnet0]',
-        'ip = 192.168.56.1',
-        '[vb-instance:foo]',
-        'vm-nic1 = hostonly',
-        'vm-hostonlyadapter1 = vboxnet0'])
+        '[vb-instance:foo]'])
+    ctrl.configfile = ployconf.path
     vminfo = VMInfo()
-    hostonlyif = b"\n".join([
-        b"Name:            vboxnet0",
-        b"GUID:            %s" % hoifuid,
-        b"DHCP:            Disabled",
-        b"IPAddress:       192.168.56.1",
-        b"NetworkMask:     255.255.255.0",
-        b"IPV6Address:     ",
-        b"IPV6NetworkMaskPrefixLength: 0",
-        b"HardwareAddress: 0a:00:27:00:00:00",
-        b"MediumType:      Ethernet",
-        b"Wireless:        No",
-        b"Status:          Down",
-        b"VBoxNetworkName: HostInterfaceNetworking-vboxnet0",
-        b"",
-        b""])
-    dhcpservers = b"\n".join([
-        b"NetworkName:    HostInterfaceNetworking-vboxnet0",
-        b"Dhcpd IP:       192.168.56.2",
-        b"LowerIPAddress: 192.168.56.100",
-        b"UpperIPAddress: 192.168.56.254",
-        b"NetworkMask:    255.255.255.0",
-        b"Enabled:        Yes",
-        b"Global Configuration:",
-        b"    minLeaseTime:     default",
-        b"    defaultLeaseTime: default",
-        b"    maxLeaseTime:     default",
-        b"    Forced options:   None",
-        b"    Suppressed opts.: None",
-        b"        1/legacy: 255.255.255.0",
-        b"Groups:               None",
-        b"Individual Configs:   None",
-        b"",
-        b""])
     popen_mock.expect = [
-        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
         (['VBoxManage'], 0, vbm_infos['usage'], b''),
-        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b''),
-        (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
-        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'controlvm', 'foo', 'savestate'], 0, b'', b'')]
+    ctrl.instances['foo'].suspend()
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Saving state of instance 'foo'",
+        "Instance suspended"]
+
+
+def test_snapshot_cmd(ctrl, popen_mock, vbm_infos, caplog):
+    vminfo = VMInfo()
+    vminfo._info.update({
+        'SnapshotName': '"base"',
+        'SnapshotName-1': '"warm"',
+        'CurrentSnapshotName': '"warm"'})
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'snapshot', 'foo', 'take', 'ready', '--live'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b'')]
+    ctrl(['./bin/ploy', 'vb-snapshot', 'take', 'foo', 'ready', '--live'])
+    ctrl(['./bin/ploy', 'vb-snapshot', 'list', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Taking snapshot 'ready' of instance 'foo'",
+        "base",
+        "warm (current)"]
+
+
+def test_snapshot_restore_running(ctrl, ployconf, popen_mock, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]'])
+    ctrl.configfile = ployconf.path
+    vminfo = VMInfo()
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('running'), b'')]
+    with pytest.raises(SystemExit):
+        ctrl.instances['foo'].snapshot('restore', 'warm')
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Instance 'foo' has to be stopped to restore a snapshot."]
+
+
+def test_start_restore_snapshot(ctrl, ployconf, popen_mock, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'restore-snapshot = warm',
+        'vm-memory = 512'])
+    vminfo = VMInfo()
+    vminfo._info.update({'SnapshotName': '"warm"'})
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
-        (['VBoxManage', 'list', 'hostonlyifs'], 0, b'', b''),
-        (['VBoxManage', 'hostonlyif', 'create'], 0, b'', b''),
-        (['VBoxManage', 'list', 'hostonlyifs'], 0, hostonlyif, b''),
-        (['VBoxManage', 'hostonlyif', 'ipconfig', 'vboxnet0', '--ip', '192.168.56.1'], 0, hostonlyif, b''),
-        (['VBoxManage', 'list', 'dhcpservers'], 0, b'', b''),
-        (['VBoxManage', 'dhcpserver', 'add', '--enable', '--ip', '192.168.56.2', '--lowerip', '192.168.56.100', '--netmask', '255.255.255.0', '--netname', 'HostInterfaceNetworking-vboxnet0', '--upperip', '192.168.56.254'], 0, b'', b''),
-        (['VBoxManage', 'list', 'dhcpservers'], 0, dhcpservers, b''),
-        (['VBoxManage', 'modifyvm', 'foo', '--hostonlyadapter1', 'vboxnet0', '--nic1', 'hostonly'], 0, b'', b''),
-        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.nic('hostonly'), b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
         (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo(), b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'snapshot', 'foo', 'restore', 'warm'], 0, b'', b''),
+        # the live snapshot leaves the VM in saved state, so it is resumed
+        # without changing the settings
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('saved'), b''),
         (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
     ctrl(['./bin/ploy', 'start', 'foo'])
     assert popen_mock.expect == []
     assert caplog_messages(caplog) == [
-        "Creating instance 'foo'",
-        "Created host only interface 'vboxnet0'.",
-        "Added dhcpserver 'vboxnet0'.",
-        "Starting instance 'vb-instance:foo'",
-        "Instance started"]
+        "Restoring snapshot 'warm' of instance 'foo'"]
+
+
+def test_start_restore_snapshot_missing(ctrl, ployconf, popen_mock, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'restore-snapshot = warm'])
+    vminfo = VMInfo()
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Snapshot 'warm' not found, starting normally.",
+        "Starting instance 'vb-instance:foo'",
+        "Instance started"]
+
+
+def test_start_wait_for_ip(ctrl, ployconf, popen_mock, monkeypatch, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'wait-for = ip',
+        'wait-timeout = 60'])
+    monkeypatch.setattr('time.time', lambda: 1000.0)
+    vminfo = VMInfo()
+    pattern = '/VirtualBox/GuestInfo/Net/*/V4/IP'
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b''),
+        (['VBoxManage', 'guestproperty', 'enumerate', 'foo'], 0, b'Name: /VirtualBox/HostInfo/GUI/LanguageID, value: C, timestamp: 1, flags: RDONLYGUEST', b''),
+        (['VBoxManage', 'guestproperty', 'wait', 'foo', pattern, '--timeout', '60000', '--fail-on-timeout'], 0, b'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 10.0.2.15, flags: TRANSIENT', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Starting instance 'vb-instance:foo'",
+        "Waiting for guest property '/VirtualBox/GuestInfo/Net/*/V4/IP'",
+        "Guest property '/VirtualBox/GuestInfo/Net/0/V4/IP' is '10.0.2.15'",
+        "Instance started"]
+
+
+def test_wait_for_guestproperty_timeout(popen_mock, monkeypatch):
+    from ploy_virtualbox.vbox import VBoxManage
+
+    class FakeTime:
+        clock = iter([0.0, 10.0, 20.0, 40.0])
+
+        def time(self):
+            return next(self.clock)
+
+    monkeypatch.setattr('ploy_virtualbox.vbox.time', FakeTime())
+    popen_mock.expect = [
+        (['VBoxManage', 'guestproperty', 'enumerate', 'foo'], 0, b'', b''),
+        # the property was set and deleted again
+        (['VBoxManage', 'guestproperty', 'wait', 'foo', '/Ready', '--timeout', '20000', '--fail-on-timeout'], 0, b'Name: /Ready, value: , flags: ', b''),
+        (['VBoxManage', 'guestproperty', 'wait', 'foo', '/Ready', '--timeout', '10000', '--fail-on-timeout'], 2, b'Time out or interruption while waiting for a notification.', b'')]
+    vb = VBoxManage()
+    assert vb.wait_for_guestproperty('foo', '/Ready', timeout=30) is None
+    assert popen_mock.expect == []
+
+
+def test_disk_cmd_compact(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-disk:boot]',
+        'size = 102400',
+        '[vb-disk:data]',
+        'size = 102400',
+        '[vb-disk:missing]',
+        'size = 102400',
+        '[vb-instance:foo]',
+        'basefolder = %s' % tempdir.directory,
+        'storage =',
+        '    --medium vb-disk:boot',
+        '    --medium vb-disk:data',
+        '    --medium vb-disk:missing'])
+    if ployconf.path.endswith('.yml'):
+        pytest.skip("multi line storage isn't supported in YAML")
+    boot_vdi = os.path.join(tempdir.directory, 'foo', 'boot.vdi')
+    data_vdi = os.path.join(tempdir.directory, 'foo', 'data.vdi')
+    tempdir['foo/boot.vdi'].fill('boot')
+    tempdir['foo/data.vdi'].fill('data')
+
+    def mediuminfo(size):
+        return b"\n".join([
+            b"UUID:           1234",
+            b"Storage format: VDI",
+            b"Capacity:       102400 MBytes",
+            b"Size on disk:   %d MBytes" % size])
+
+    popen_mock.expect = [
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', boot_vdi], 0, mediuminfo(3072), b''),
+        (['VBoxManage', 'modifymedium', 'disk', boot_vdi, '--compact'], 0, b'', b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', boot_vdi], 0, mediuminfo(1024), b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', data_vdi], 0, mediuminfo(2048), b''),
+        (['VBoxManage', 'modifymedium', 'disk', data_vdi, '--compact'], 0, b'', b''),
+        (['VBoxManage', 'showmediuminfo', 'disk', data_vdi], 0, mediuminfo(2048), b'')]
+    ctrl(['./bin/ploy', 'vb-disk', 'compact', '-j', '1'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Disk 'missing' of 'vb-instance:foo' doesn't exist.",
+        "Compacted disk 'boot' of 'vb-instance:foo' from 3.0 GiB to 1.0 GiB.",
+        "Compacted disk 'data' of 'vb-instance:foo' from 2.0 GiB to 2.0 GiB.",
+        "Reclaimed 2.0 GiB."]
+
+
+def test_disk_cmd_info(ctrl, ployconf, popen_mock, tempdir, vbm_infos, capsys):
+    ployconf.fill([
+        '[vb-disk:boot]',
+        'size = 102400',
+        '[vb-instance:foo]',
+        'basefolder = %s' % tempdir.directory,
+        'storage = --medium vb-disk:boot'])
+    boot_vdi = os.path.join(tempdir.directory, 'foo', 'boot.vdi')
+    tempdir['foo/boot.vdi'].fill('boot')
+    popen_mock.expect = [
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        # the names used by VirtualBox 4 and 5
+        (['VBoxManage', 'showmediuminfo', 'disk', boot_vdi], 0, b"Logical size:   102400 MBytes\nCurrent size on disk: 512 MBytes", b'')]
+    ctrl(['./bin/ploy', 'vb-disk', 'info', 'foo'])
+    assert popen_mock.expect == []
+    assert capsys.readouterr()[0].split() == [
+        'vb-instance:foo', 'boot', 'VDI', '100.0', 'GiB', '512.0', 'MiB', boot_vdi]
+
+
+def test_disk_cmd_convert(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-disk:boot]',
+        'size = 102400',
+        'format = VMDK',
+        '[vb-instance:foo]',
+        'basefolder = %s' % tempdir.directory,
+        'storage = --medium vb-disk:boot'])
+    boot_vdi = os.path.join(tempdir.directory, 'foo', 'boot.vdi')
+    boot_vmdk = os.path.join(tempdir.directory, 'foo', 'boot.vmdk')
+    tempdir['foo/boot.vdi'].fill('boot')
+    popen_mock.expect = [
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'clonemedium', 'disk', boot_vdi, boot_vmdk, '--format', 'VMDK'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'vb-disk', 'convert'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Converted disk 'boot' of 'vb-instance:foo' from '%s' to '%s', the old file is kept." % (boot_vdi, boot_vmdk)]
+
+
+def test_terminate_keeps_disks(ctrl, ployconf, popen_mock, yesno_mock, caplog):
+    if ployconf.path.endswith('.yml'):
+        pytest.skip("multi line storage isn't supported in YAML")
+    ployconf.fill([
+        '[vb-disk:data]',
+        'size = 1024',
+        'delete = false',
+        '[vb-disk:scratch]',
+        'size = 1024',
+        '[vb-instance:foo]',
+        'storage =',
+        '    --medium vb-disk:data',
+        '    --medium vb-disk:scratch',
+        '    --medium vb-disk:data --port 5'])
+    vminfo = VMInfo()
+    vminfo._info['VMState'] = "'poweroff'"
+    vminfo.storagectl(name='sata')
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo, b''),
+        # the controllers are looked up once for all detaches
+        (['VBoxManage', 'storageattach', 'foo', '--medium', 'none', '--port', '0', '--storagectl', 'sata', '--type', 'hdd'], 0, b'', b''),
+        (['VBoxManage', 'storageattach', 'foo', '--medium', 'none', '--port', '5', '--storagectl', 'sata', '--type', 'hdd'], 0, b'', b''),
+        (['VBoxManage', 'unregistervm', 'foo', '--delete'], 0, b'', b'')]
+    yesno_mock.expected = [
+        ("Are you sure you want to terminate 'vb-instance:foo'?", True)]
+    ctrl(['./bin/ploy', 'terminate', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Terminating instance 'foo'",
+        "Instance terminated"]
+
+
+def test_dhcpserver(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    hoifuid = str(uuid.uuid4()).encode('ascii')
+    ployconf.fill([
+        '[vb-dhcpserver:vboxnet0]',
+        'ip = 192.168.56.2',
+        'netmask = 255.255.255.0',
+        'lowerip = 192.168.56.100',
+        'upperip = 192.168.56.254',
+        '[vb-hostonlyif:vboxnet0]',
+        'ip = 192.168.56.1',
+        '[vb-instance:foo]',
+        'vm-nic1 = hostonly',
+        'vm-hostonlyadapter1 = vboxnet0'])
+    vminfo = VMInfo()
+    hostonlyif = b"\n".join([
+        b"Name:            vboxnet0",
+        b"GUID:            %s" % hoifuid,
+        b"DHCP:            Disabled",
+        b"IPAddress:       192.168.56.1",
+        b"NetworkMask:     255.255.255.0",
+        b"IPV6Address:     ",
+        b"IPV6NetworkMaskPrefixLength: 0",
+        b"HardwareAddress: 0a:00:27:00:00:00",
+        b"MediumType:      Ethernet",
+        b"Wireless:        No",
+        b"Status:          Down",
+        b"VBoxNetworkName: HostInterfaceNetworking-vboxnet0",
+        b"",
+        b""])
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b''),
+        (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        # the state is listed once, before anything is changed
+        (['VBoxManage', 'list', 'hostonlyifs'], 0, b'', b''),
+        (['VBoxManage', 'list', 'dhcpservers'], 0, b'', b''),
+        (['VBoxManage', 'hostonlyif', 'create'], 0, b'', b''),
+        (['VBoxManage', 'hostonlyif', 'ipconfig', 'vboxnet0', '--ip', '192.168.56.1'], 0, hostonlyif, b''),
+        (['VBoxManage', 'dhcpserver', 'add', '--enable', '--ip', '192.168.56.2', '--lowerip', '192.168.56.100', '--netmask', '255.255.255.0', '--netname', 'HostInterfaceNetworking-vboxnet0', '--upperip', '192.168.56.254'], 0, b'', b''),
+        (['VBoxManage', 'modifyvm', 'foo', '--hostonlyadapter1', 'vboxnet0', '--nic1', 'hostonly'], 0, b'', b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Creating instance 'foo'",
+        "Created host only interface 'vboxnet0'.",
+        "Added dhcpserver 'vboxnet0'.",
+        "Starting instance 'vb-instance:foo'",
+        "Instance started"]
+
+
+def test_showvminfo_cache(popen_mock, vbm_infos):
+    from ploy_virtualbox.vbox import VBoxManage
+    vb = VBoxManage()
+    popen_mock.expect = [
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, b'VMState="poweroff"', b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'modifyvm', 'foo', '--memory', '512'], 0, b'', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, b'VMState="poweroff"\nmemory=512', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, b'VMState="running"\nmemory=512', b'')]
+    assert vb.showvminfo('foo') == {'VMState': 'poweroff'}
+    assert vb.showvminfo('foo') == {'VMState': 'poweroff'}
+    vb.modifyvm('foo', '--memory', '512')
+    assert vb.showvminfo('foo') == {'VMState': 'poweroff', 'memory': '512'}
+    assert vb.showvminfo('foo') == {'VMState': 'poweroff', 'memory': '512'}
+    assert vb.showvminfo('foo', refresh=True) == {'VMState': 'running', 'memory': '512'}
+    assert popen_mock.expect == []
+
+
+def test_fleet_status(ctrl, ployconf, popen_mock, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        '[vb-instance:bar]'])
+    popen_mock.expect = [
+        (['VBoxManage', 'list', '--long', 'vms'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'vb-fleet', 'status', '-j', '2'])
+    assert popen_mock.expect == []
+    messages = caplog_messages(caplog)
+    assert messages[:2] == [
+        "Instance 'bar' unavailable",
+        "Instance 'foo' unavailable"]
+    assert messages[2].startswith("status of 'virtualbox-bar' succeeded")
+    assert messages[3].startswith("status of 'virtualbox-foo' succeeded")
+    assert messages[4:] == [
+        "status finished for 2 instances, 0 failed."]
+    # another run lists the current state again
+    caplog.clear()
+    popen_mock.expect = [
+        (['VBoxManage', 'list', '--long', 'vms'], 0, vms_long(
+            ('foo', 'powered off', ['nat'])), b'')]
+    ctrl(['./bin/ploy', 'vb-fleet', 'status', '-j', '2'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog)[:2] == [
+        "Instance 'bar' unavailable",
+        "Instance state: stopped"]
+
+
+def test_fleet_log_order(ctrl, ployconf, popen_mock, caplog, monkeypatch):
+    from ploy_virtualbox import Instance
+    import time
+    ployconf.fill([
+        '[vb-instance:foo]',
+        '[vb-instance:bar]',
+        '[vb-instance:baz]'])
+    delays = dict(bar=0.2, baz=0.1, foo=0)
+
+    def status(self, vms=None):
+        log = logging.getLogger('ploy_virtualbox')
+        log.info("%s begin", self.id)
+        time.sleep(delays[self.id])
+        if self.id == 'baz':
+            log.error("%s failed", self.id)
+            raise SystemExit(1)
+        logging.getLogger('ploy_virtualbox.plan').info("%s planned", self.id)
+        log.info("%s end", self.id)
+
+    monkeypatch.setattr(Instance, 'status', status)
+    popen_mock.expect = [
+        (['VBoxManage', 'list', '--long', 'vms'], 0, b'', b'')]
+    ctrl.configfile = ployconf.path
+    master = ctrl.masters['virtualbox']
+    summary = master.fleet('status', ['bar', 'baz', 'foo'], workers=3)
+    assert [(x[0], type(x[1])) for x in summary] == [
+        ('bar', type(None)), ('baz', SystemExit), ('foo', type(None))]
+    assert caplog_messages(caplog) == [
+        "bar begin", "bar planned", "bar end", "baz begin", "baz failed",
+        "foo begin", "foo planned", "foo end"]
+
+
+def test_fleet_start_confirms_unverified_media_once(ctrl, ployconf, popen_mock, vbm_infos, monkeypatch, yesno_mock):
+    from ploy_virtualbox import Instance
+    import threading
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'storage = --type dvddrive --medium http://example.com/foo.iso',
+        '[vb-instance:bar]',
+        'storage = --type dvddrive --medium http://example.com/bar.iso'])
+    threads = []
+
+    def start(self, overrides):
+        self._resolve_media(self._get_storages(self.get_config(overrides)))
+
+    def yesno(question):
+        threads.append(threading.current_thread())
+        return yesno_mock(question)
+
+    monkeypatch.setattr(Instance, 'start', start)
+    monkeypatch.setattr(Instance, '_download', lambda self, url, checksum: url.path)
+    monkeypatch.setattr('ploy_virtualbox.yesno', yesno)
+    yesno_mock.expected = [
+        ('No checksum provided! Are you sure you want to boot from an unverified image?', True)]
+    popen_mock.expect = [
+        (['VBoxManage'], 0, vbm_infos['usage'], b'')]
+    ctrl.configfile = ployconf.path
+    master = ctrl.masters['virtualbox']
+    summary = master.fleet('start', workers=2)
+    assert [x[1] for x in summary] == [None, None]
+    assert yesno_mock.expected == []
+    # the prompt isn't used by the worker threads
+    assert threads == [threading.current_thread()]
+
+
+def test_batch(tempdir):
+    from ploy_virtualbox.vbox import VBoxManage
+    import subprocess
+    executable = tempdir['VBoxManage']
+    executable.fill([
+        '#!/bin/sh',
+        'if [ "$1" = "fail" ]; then echo "failed" >&2; exit 3; fi',
+        'printf "%s" "$*"'])
+    os.chmod(executable.path, 0o755)
+    vb = VBoxManage(executable=executable.path)
+    with vb.batch() as batch:
+        first = batch.modifyvm('foo', '--name', "it's")
+        second = batch.storagectl('foo', name='sata')
+        third = batch.fail()
+        fourth = batch.startvm('foo')
+    assert first.get() == ["modifyvm foo --name it's"]
+    assert second.get() == ["storagectl foo --name sata"]
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        third.get()
+    assert e.value.returncode == 3
+    assert e.value.output == b'failed\n'
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        fourth.get()
+    assert e.value.returncode == -1
+
+
+def test_commands_cache(popen_mock, tempdir, vbm_infos):
+    from ploy_virtualbox.vbox import VBoxManage
+    import json
+    executable = tempdir['VBoxManage']
+    executable.fill('#!/bin/sh')
+    os.chmod(executable.path, 0o755)
+    cache_dir = os.path.join(tempdir.directory, 'cache')
+    popen_mock.expect = [
+        ([executable.path], 0, vbm_infos['usage'], b'')]
+    vb = VBoxManage(executable=executable.path, cache_dir=cache_dir)
+    commands = vb.commands
+    assert 'showvminfo' in commands
+    assert popen_mock.expect == []
+    assert os.path.exists(os.path.join(cache_dir, 'vboxmanage-commands.json'))
+    # a new instance uses the cache
+    vb = VBoxManage(executable=executable.path, cache_dir=cache_dir)
+    assert vb.commands == commands
+    # a changed executable invalidates the cache
+    os.utime(executable.path, (0, 0))
+    popen_mock.expect = [
+        ([executable.path], 0, vbm_infos['usage'], b'')]
+    vb = VBoxManage(executable=executable.path, cache_dir=cache_dir)
+    assert vb.commands == commands
+    assert popen_mock.expect == []
+    # only the current table is kept
+    with open(os.path.join(cache_dir, 'vboxmanage-commands.json')) as f:
+        assert list(json.load(f)) == [os.path.realpath(executable.path)]
+    # explicit invalidation
+    vb.invalidate_commands_cache()
+    assert not os.path.exists(os.path.join(cache_dir, 'vboxmanage-commands.json'))
+    popen_mock.expect = [
+        ([executable.path], 0, vbm_infos['usage'], b'')]
+    assert vb.commands == commands
+    assert popen_mock.expect == []
+
+
+def test_download(http_server, tempdir):
+    from ploy_virtualbox.download import download
+    import hashlib
+    data = os.urandom(300000)
+    http_server.files['/image.iso'] = data
+    path = os.path.join(tempdir.directory, 'image.iso')
+    digest = download(http_server.url + '/image.iso', path, chunk_size=65536)
+    assert digest == hashlib.sha1(data).hexdigest()
+    assert not os.path.exists(path + '.part')
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert http_server.requests == [('/image.iso', None)]
+
+
+def test_download_resume(http_server, tempdir, caplog):
+    from ploy_virtualbox.download import download
+    import hashlib
+    data = os.urandom(300000)
+    http_server.files['/image.iso'] = data
+    http_server.drop_after = 100000
+    path = os.path.join(tempdir.directory, 'image.iso')
+    # a previously interrupted download
+    with open(path + '.part', 'wb') as f:
+        f.write(data[:50000])
+    digest = download(http_server.url + '/image.iso', path, chunk_size=65536)
+    assert digest == hashlib.sha1(data).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert http_server.requests == [
+        ('/image.iso', 'bytes=50000-'),
+        ('/image.iso', 'bytes=150000-')]
+    assert "Resuming download of %s/image.iso at 146.5 KiB." % http_server.url in caplog_messages(caplog)
+
+
+def test_download_no_ranges(http_server, tempdir):
+    from ploy_virtualbox.download import download
+    import hashlib
+    data = os.urandom(300000)
+    http_server.files['/image.iso'] = data
+    http_server.ranges = False
+    path = os.path.join(tempdir.directory, 'image.iso')
+    with open(path + '.part', 'wb') as f:
+        f.write(b'x' * 50000)
+    digest = download(http_server.url + '/image.iso', path)
+    assert digest == hashlib.sha1(data).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_start_with_remote_medium(ctrl, ployconf, http_server, popen_mock, tempdir, vbm_infos, caplog):
+    import hashlib
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    data = os.urandom(1000)
+    http_server.files['/files/mfsbsd.iso'] = data
+    download_dir = os.path.join(tempdir.directory, 'downloads')
+    ployconf.fill([
+        '[global]',
+        'download_dir = %s' % download_dir,
+        '[vb-instance:foo]',
+        'storage = --type dvddrive --medium %s/files/mfsbsd.iso --medium_sha1 %s' % (
+            http_server.url, hashlib.sha1(data).hexdigest())])
+    vminfo = VMInfo()
+    medium = os.path.join(download_dir, 'objects', 'sha1', hashlib.sha1(data).hexdigest())
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b''),
+        (['VBoxManage', 'createvm', '--name', 'foo', '--basefolder', tempdir.directory, '--ostype', 'Other', '--register'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage', 'storagectl', 'foo', '--name', 'sata', '--add', 'sata'], 0, b'', b''),
+        (['VBoxManage', 'storageattach', 'foo', '--medium', medium, '--port', '0', '--storagectl', 'sata', '--type', 'dvddrive'], 0, b'', b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    with open(medium, 'rb') as f:
+        assert f.read() == data
+    messages = caplog_messages(caplog)
+    assert messages[:2] == [
+        "Creating instance 'foo'",
+        "Downloading %s/files/mfsbsd.iso" % http_server.url]
+    assert messages[-4:] == [
+        "Downloaded successfully to %s" % medium,
+        "Adding default 'sata' controller.",
+        "Starting instance 'vb-instance:foo'",
+        "Instance started"]
+
+
+def test_download_cache(http_server, tempdir, monkeypatch):
+    from ploy_virtualbox.download import DownloadCache
+    import hashlib
+    clock = [1000]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    first = os.urandom(1000)
+    second = os.urandom(2000)
+    http_server.files['/a/image.iso'] = first
+    http_server.files['/b/image.iso'] = second
+    http_server.files['/mirror/image.iso'] = second
+    cache = DownloadCache(os.path.join(tempdir.directory, 'downloads'))
+    # same filename at different URLs doesn't collide
+    path_a = cache.get(http_server.url + '/a/image.iso')
+    clock[0] += 1
+    path_b = cache.get(
+        http_server.url + '/b/image.iso',
+        ('sha1', hashlib.sha1(second).hexdigest()))
+    assert path_a != path_b
+    assert path_a.endswith(hashlib.sha256(first).hexdigest())
+    assert path_b.endswith(hashlib.sha1(second).hexdigest())
+    # known content is found by checksum regardless of the URL
+    clock[0] += 1
+    assert cache.get(
+        http_server.url + '/mirror/image.iso',
+        ('sha1', hashlib.sha1(second).hexdigest())) == path_b
+    # known URLs are verified against a checksum of another algorithm
+    clock[0] += 1
+    assert cache.get(
+        http_server.url + '/a/image.iso',
+        ('sha1', hashlib.sha1(first).hexdigest())) == path_a
+    assert len(http_server.requests) == 2
+    entries = cache.entries()
+    assert [x['size'] for x in entries] == [2000, 1000]
+    assert sorted(entries[0]['urls']) == [
+        http_server.url + '/b/image.iso',
+        http_server.url + '/mirror/image.iso']
+    # least recently used content is removed first
+    removed = cache.prune(1500)
+    assert [x['size'] for x in removed] == [2000]
+    assert not os.path.exists(path_b)
+    assert os.path.exists(path_a)
+    assert sorted(cache.read_index()) == [http_server.url + '/a/image.iso']
+
+
+def test_download_cache_max_size(http_server, tempdir):
+    from ploy_virtualbox.download import DownloadCache, ChecksumError
+    http_server.files['/a.iso'] = os.urandom(1000)
+    http_server.files['/b.iso'] = os.urandom(1000)
+    cache = DownloadCache(os.path.join(tempdir.directory, 'downloads'), max_size=1500)
+    path_a = cache.get(http_server.url + '/a.iso')
+    path_b = cache.get(http_server.url + '/b.iso')
+    assert not os.path.exists(path_a)
+    assert os.path.exists(path_b)
+    with pytest.raises(ChecksumError):
+        cache.get(http_server.url + '/a.iso', ('sha1', '0' * 40))
+    assert [x['digest'] for x in cache.entries()] == [cache.read_index()[http_server.url + '/b.iso']['digest']]
+
+
+def test_downloads_cmd(ctrl, ployconf, http_server, tempdir, capsys):
+    from ploy_virtualbox.download import DownloadCache
+    download_dir = os.path.join(tempdir.directory, 'downloads')
+    ployconf.fill([
+        '[global]',
+        'download_dir = %s' % download_dir,
+        '[vb-instance:foo]'])
+    http_server.files['/a.iso'] = os.urandom(1000)
+    DownloadCache(download_dir).get(http_server.url + '/a.iso')
+    ctrl(['./bin/ploy', 'vb-downloads', 'list'])
+    out = capsys.readouterr()[0].splitlines()
+    assert out[1:] == [
+        "    %s/a.iso" % http_server.url,
+        "Total: 1000.0 B"]
+    ctrl(['./bin/ploy', 'vb-downloads', 'prune'])
+    assert DownloadCache(download_dir).entries() == []
+
+
+def test_parse_checksum():
+    from ploy_virtualbox.download import parse_checksum
+    import hashlib
+    digest = hashlib.sha256(b'foo').hexdigest()
+    assert parse_checksum('sha256:%s' % digest.upper()) == ('sha256', digest)
+    assert parse_checksum(digest, 'SHA256') == ('sha256', digest)
+    with pytest.raises(ValueError):
+        parse_checksum(digest)
+    with pytest.raises(ValueError):
+        parse_checksum('foo:%s' % digest)
+    with pytest.raises(ValueError):
+        parse_checksum('sha1:%s' % digest)
+
+
+@pytest.mark.parametrize("option, algorithm", [
+    ('medium_sha1', 'sha1'),
+    ('medium_sha256', 'sha256'),
+    ('medium_blake2b', 'blake2b'),
+    ('medium_checksum', 'sha256')])
+def test_medium_checksum(ctrl, ployconf, option, algorithm):
+    import hashlib
+    digest = hashlib.new(algorithm, b'foo').hexdigest()
+    value = digest
+    if option == 'medium_checksum':
+        value = '%s:%s' % (algorithm, digest)
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'storage = --type dvddrive --medium http://example.com/foo.iso --%s %s' % (option, value)])
+    ctrl.configfile = ployconf.path
+    instance = ctrl.instances['foo']
+    (storage,) = instance._get_storages(instance.config)
+    (url, checksum) = storage['medium']
+    assert url.geturl() == 'http://example.com/foo.iso'
+    assert checksum == (algorithm, digest)
+    assert set(storage) == set(['medium', 'type'])
+
+
+def test_medium_checksum_conflict(ctrl, ployconf, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'storage = --medium http://example.com/foo.iso --medium_sha1 %s --medium_sha256 %s' % ('0' * 40, '0' * 64)])
+    ctrl.configfile = ployconf.path
+    instance = ctrl.instances['foo']
+    with pytest.raises(SystemExit):
+        instance._get_storages(instance.config)
+    assert caplog_messages(caplog) == [
+        "Only one of --medium_sha1, --medium_sha256 allowed for a medium in [vb-instance:foo]."]
+
+
+def test_digest_memo(tempdir, monkeypatch):
+    from ploy_virtualbox import download
+    import hashlib
+    data = os.urandom(1000)
+    tempdir['image.iso'].fill_binary(data)
+    path = tempdir['image.iso'].path
+    hash_file = download.hash_file
+    calls = []
+
+    def counting_hash_file(*args, **kw):
+        calls.append(args)
+        return hash_file(*args, **kw)
+
+    monkeypatch.setattr(download, 'hash_file', counting_hash_file)
+    assert download.DigestMemo(path).digest('sha256') == hashlib.sha256(data).hexdigest()
+    assert download.DigestMemo(path).digest('sha256') == hashlib.sha256(data).hexdigest()
+    assert len(calls) == 1
+    assert download.DigestMemo(path).digest('blake2b') == hashlib.blake2b(data).hexdigest()
+    assert len(calls) == 2
+    # changed content is hashed again
+    tempdir['image.iso'].fill_binary(data[:500])
+    assert download.DigestMemo(path).digest('sha256') == hashlib.sha256(data[:500]).hexdigest()
+    assert len(calls) == 3
+
+
+def test_digest_memo_unwritable(tempdir, caplog):
+    from ploy_virtualbox import download
+    import hashlib
+    data = os.urandom(1000)
+    tempdir['image.iso'].fill_binary(data)
+    tempdir['memo'].fill('not a directory')
+    memo_path = os.path.join(tempdir['memo'].path, 'image.iso')
+    memo = download.DigestMemo(tempdir['image.iso'].path, memo_path)
+    assert memo.digest('sha256') == hashlib.sha256(data).hexdigest()
+    assert caplog_messages(caplog, level=logging.WARNING)[0].startswith(
+        "Couldn't remember the sha256 checksum of %s: " % tempdir['image.iso'].path)
+
+
+def test_download_cache_verifies_with_memo(http_server, tempdir, monkeypatch):
+    from ploy_virtualbox import download
+    import hashlib
+    data = os.urandom(1000)
+    http_server.files['/a.iso'] = data
+    checksum = ('sha256', hashlib.sha256(data).hexdigest())
+    cache = download.DownloadCache(os.path.join(tempdir.directory, 'downloads'))
+    path = cache.get(http_server.url + '/a.iso', checksum)
+
+    def fail(*args, **kw):  # pragma: nocover
+        raise AssertionError("unexpected hashing")
+
+    monkeypatch.setattr(download, 'hash_file', fail)
+    assert cache.get(http_server.url + '/a.iso', checksum) == path
+    assert [x['size'] for x in cache.entries()] == [1000]
+    monkeypatch.undo()
+    # a corrupted object is detected and downloaded again
+    with open(path, 'ab') as f:
+        f.write(b'garbage')
+    assert cache.get(http_server.url + '/a.iso', checksum) == path
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert len(http_server.requests) == 2
+
+
+def test_download_cache_changed_content(http_server, tempdir):
+    from ploy_virtualbox.download import DownloadCache
+    import hashlib
+    first = os.urandom(1000)
+    second = os.urandom(1000)
+    http_server.files['/a.iso'] = first
+    cache = DownloadCache(os.path.join(tempdir.directory, 'downloads'))
+    path_first = cache.get(http_server.url + '/a.iso')
+    # the content changed and the configured checksum was updated
+    http_server.files['/a.iso'] = second
+    path_second = cache.get(
+        http_server.url + '/a.iso',
+        ('sha1', hashlib.sha1(second).hexdigest()))
+    assert path_second != path_first
+    with open(path_second, 'rb') as f:
+        assert f.read() == second
+    assert len(http_server.requests) == 2
+    assert cache.read_index()[http_server.url + '/a.iso']['digest'] == (
+        'sha1:%s' % hashlib.sha1(second).hexdigest())
+
+
+def test_download_cache_imports_old_layout(http_server, tempdir, caplog):
+    from ploy_virtualbox.download import DownloadCache
+    import hashlib
+    data = os.urandom(1000)
+    http_server.files['/files/old.iso'] = data
+    tempdir['downloads/old.iso'].fill_binary(data)
+    cache = DownloadCache(os.path.join(tempdir.directory, 'downloads'))
+    sha1 = hashlib.sha1(data).hexdigest()
+    # old downloads are listed and can be pruned
+    assert [(x['digest'], x['urls']) for x in cache.entries()] == [
+        ('sha1:%s' % sha1, [])]
+    assert not os.path.exists(tempdir['downloads/old.iso'].path)
+    assert caplog_messages(caplog) == [
+        "Moving '%s' into the download cache." % tempdir['downloads/old.iso'].path]
+    # and are used for configs with the sha1 checksum
+    path = cache.get(http_server.url + '/files/old.iso', ('sha1', sha1))
+    assert path == cache.object_path('sha1:%s' % sha1)
+    assert http_server.requests == []
+
+
+def test_download_cache_concurrent(http_server, tempdir):
+    from ploy_virtualbox.download import DownloadCache
+    from multiprocessing.pool import ThreadPool
+    http_server.files['/a.iso'] = os.urandom(100000)
+    cache = DownloadCache(os.path.join(tempdir.directory, 'downloads'))
+    pool = ThreadPool(4)
+    try:
+        paths = pool.map(cache.get, [http_server.url + '/a.iso'] * 4)
+    finally:
+        pool.close()
+    assert len(set(paths)) == 1
+    assert len(http_server.requests) == 1
+
+
+def test_download_cache_os_error(http_server, tempdir):
+    from ploy_virtualbox.download import DownloadCache, DownloadError
+    http_server.files['/a.iso'] = os.urandom(1000)
+    tempdir['downloads'].fill('not a directory')
+    cache = DownloadCache(os.path.join(tempdir.directory, 'downloads'))
+    with pytest.raises(DownloadError) as e:
+        cache.get(http_server.url + '/a.iso')
+    assert str(e.value).startswith("Failed to download %s/a.iso: " % http_server.url)
+
+
+def test_start_linked_clone(ctrl, ployconf, popen_mock, tempdir, vbm_infos, caplog):
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'clone-from = base'])
+    baseinfo = VMInfo()
+    baseinfo._info['CurrentSnapshotName'] = '"golden"'
+    vminfo = VMInfo()
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"base" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'base'], 0, baseinfo.state('poweroff'), b''),
+        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'clonevm', 'base', '--snapshot', 'golden', '--options', 'link', '--name', 'foo', '--basefolder', tempdir.directory, '--register'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"base" {%s}\n"foo" {%s}' % (uid, uid), b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "Creating instance 'foo' as linked clone of 'base' snapshot 'golden'",
+        "Starting instance 'vb-instance:foo'",
+        "Instance started"]
+
+
+def test_start_linked_clone_snapshot(ctrl, ployconf, popen_mock, tempdir, vbm_infos):
+    import uuid
+    uid = str(uuid.uuid4()).encode('ascii')
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'clone-from = base',
+        'clone-snapshot = ci'])
+    vminfo = VMInfo()
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage', 'list', 'systemproperties'], 0, vbm_infos['systemproperties'], b''),
+        (['VBoxManage'], 0, vbm_infos['usage'], b''),
+        (['VBoxManage', 'clonevm', 'base', '--snapshot', 'ci', '--options', 'link', '--name', 'foo', '--basefolder', tempdir.directory, '--register'], 0, b'', b''),
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {%s}' % uid, b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, vminfo.state('poweroff'), b''),
+        (['VBoxManage', 'startvm', 'foo'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+
+
+def test_start_linked_clone_no_snapshot(ctrl, ployconf, popen_mock, vbm_infos, caplog):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        'clone-from = base'])
+    baseinfo = VMInfo()
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'base'], 0, baseinfo.state('poweroff'), b'')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'start', 'foo'])
+    assert popen_mock.expect == []
+    assert caplog_messages(caplog) == [
+        "The base VM 'base' for 'foo' has no snapshot to create a linked clone from. "
+        "Take one with 'VBoxManage snapshot base take NAME' or set 'clone-snapshot'."]
+
+
+def test_call_hooks(popen_mock, tempdir):
+    from ploy_virtualbox.vbox import CallTimings, VBoxManage
+    records = []
+    timings = CallTimings()
+    vb = VBoxManage()
+    vb.call_hooks.extend([records.append, timings])
+    vb.commands = ['startvm']
+    popen_mock.expect = [
+        (['VBoxManage', 'list', 'vms'], 0, b'"foo" {1234}', b''),
+        (['VBoxManage', 'showvminfo', '--machinereadable', 'foo'], 0, b'VMState="running"', b''),
+        (['VBoxManage', 'startvm', 'foo'], 1, b'', b'error')]
+    vb.list_vms()
+    vb.showvminfo('foo')
+    with pytest.raises(subprocess.CalledProcessError):
+        vb.startvm('foo')
+    assert popen_mock.expect == []
+    assert [(x.subcommand, x.args, x.rc, x.out_bytes, x.err_bytes, x.vm, x.host) for x in records] == [
+        ('list', ['list', 'vms'], 0, 12, 0, None, None),
+        ('showvminfo', ['showvminfo', '--machinereadable', 'foo'], 0, 17, 0, 'foo', None),
+        ('startvm', ['startvm', 'foo'], 1, 0, 5, 'foo', None)]
+    assert sorted(timings.timings) == ['list', 'showvminfo', 'startvm']
+    assert timings.timings['startvm']['failed'] == 1
+    table = timings.format_table()
+    assert table[0].split() == ['subcommand', 'calls', 'failed', 'total', 'avg', 'max', 'output']
+    assert table[-1].split()[:3] == ['total', '3', '1']
+
+
+@pytest.mark.parametrize("args, vm", [
+    (['list', 'vms'], None),
+    (['startvm', 'foo', '--type', 'headless'], 'foo'),
+    (['createvm', '--name', 'foo', '--ostype', 'Other', '--register'], 'foo'),
+    (['clonevm', 'base', '--snapshot', 'golden', '--options', 'link', '--name', 'foo', '--register'], 'foo'),
+    (['guestproperty', 'enumerate', 'foo'], 'foo'),
+    (['guestproperty', 'wait', 'foo', '/VirtualBox/*', '--timeout', '1000'], 'foo'),
+    (['snapshot', 'foo', 'take', 'warm', '--live'], 'foo'),
+    (['storageattach', 'foo', '--storagectl', 'sata', '--port', '0'], 'foo'),
+    (['showmediuminfo', 'disk', '/vms/foo.vdi'], None),
+    (['modifymedium', 'disk', '/vms/foo.vdi', '--compact'], None),
+    (['clonemedium', 'disk', '/vms/foo.vdi', '/vms/bar.vdi'], None),
+    (['closemedium', 'disk', '/vms/foo.vdi', '--delete'], None)])
+def test_call_record_vm(args, vm):
+    from ploy_virtualbox.vbox import CallRecord
+    record = CallRecord(['VBoxManage'] + args, 0, 0, 0, b'', b'')
+    assert record.vm == vm
+
+
+def test_call_hooks_remote_batch(mock, monkeypatch):
+    from ploy_virtualbox.vbox import VBoxManage
+    records = []
+    instance = mock.Mock()
+    instance.uid = 'host'
+    monkeypatch.setattr(
+        'ploy.common.InstanceExecutor._run',
+        lambda self, args, stdin: (0, b'', b''))
+    vb = VBoxManage(instance=instance)
+    vb.call_hooks.append(records.append)
+    vb.commands = ['modifyvm', 'storagectl']
+    with vb.batch() as batch:
+        batch.modifyvm('foo', '--memory', '512')
+        batch.storagectl('foo', '--name', 'sata', '--add', 'sata')
+    (record,) = records
+    assert record.subcommand == 'batch'
+    assert record.args == [
+        ['modifyvm', 'foo', '--memory', '512'],
+        ['storagectl', 'foo', '--name', 'sata', '--add', 'sata']]
+    assert record.host == 'host'
+    assert record.vm is None
+
+
+def test_shared_connection(mock, monkeypatch):
+    from ploy_virtualbox.vbox import VBoxManage
+    import threading
+
+    class Instance:
+        uid = 'host'
+        connects = 0
+        _conn = None
+
+        @property
+        def conn(self):
+            if self._conn is None:
+                self.connects += 1
+                self._conn = mock.Mock()
+            return self._conn
+
+        def close_conn(self):
+            self._conn = None
+
+    instance = Instance()
+    monkeypatch.setattr(
+        'ploy.common.InstanceExecutor._run',
+        lambda self, args, stdin: (0, b'', b''))
+    closed = threading.Event()
+    vb = VBoxManage(instance=instance, keepalive=15, idle_timeout=0.2)
+    close = vb.connection.close
+
+    def close_and_notify():
+        close()
+        closed.set()
+
+    vb.connection.close = close_and_notify
+    vb.list('vms')
+    vb.list('vms')
+    # the connection is shared and kept alive
+    assert instance.connects == 1
+    instance._conn.get_transport().set_keepalive.assert_called_with(15)
+    # a dead transport is replaced
+    instance._conn.get_transport().is_active.return_value = False
+    vb.list('vms')
+    assert instance.connects == 2
+    # the connection is closed when idle
+    assert closed.wait(5)
+    assert instance._conn is None
+    vb.list('vms')
+    assert instance.connects == 3
+
+
+def test_call_log_option(ctrl, ployconf, popen_mock, tempdir):
+    import json
+    path = os.path.join(tempdir.directory, 'calls.jsonl')
+    ployconf.fill([
+        '[vb-master:default]',
+        'call-log = %s' % path,
+        '[vb-instance:foo]'])
+    popen_mock.expect = [
+        (['VBoxManage', 'list', '--long', 'vms'], 0, b'', b'')]
+    ctrl(['./bin/ploy', 'status', 'foo'])
+    assert popen_mock.expect == []
+    with open(path) as f:
+        (record,) = [json.loads(x) for x in f]
+    assert record['subcommand'] == 'list'
+    assert record['args'] == ['list', '--long', 'vms']
+    assert record['rc'] == 0
+
+
+def test_parse_vminfo():
+    from ploy_virtualbox.vbox import parse_vminfo
+    info = parse_vminfo([
+        'name="foo"',
+        'VMState="poweroff"',
+        'memory=512',
+        'cpus=2',
+        'nic1="nat"',
+        'nic2="hostonly"',
+        'nic3="none"',
+        'hostonlyadapter2="vboxnet0"',
+        'Forwarding(0)="ssh,tcp,,2222,,22"',
+        'Forwarding(1)="http,tcp,,8080,,80"',
+        'storagecontrollername0="SATA"',
+        'storagecontrollertype0="IntelAhci"',
+        'storagecontrollername1="IDE"',
+        'storagecontrollertype1="PIIX4"',
+        '"SATA-0-0"="/vms/foo/boot.vdi"',
+        'SnapshotName="base"',
+        'SnapshotName-1="warm"',
+        'SnapshotName-1-1="hot"'])
+    assert info['SATA-0-0'] == '/vms/foo/boot.vdi'
+    assert info.state == 'poweroff'
+    assert info.memory == 512
+    assert info.cpus == 2
+    assert info.nics == {1: 'nat', 2: 'hostonly'}
+    assert info.forwardings == ['ssh,tcp,,2222,,22', 'http,tcp,,8080,,80']
+    assert info.snapshots == ['base', 'warm', 'hot']
+    assert info.group('storagecontroller', namekey='name') == {
+        'SATA': {'name': 'SATA', 'type': 'IntelAhci'},
+        'IDE': {'name': 'IDE', 'type': 'PIIX4'}}
+    assert sorted(info.group('nic')) == ['1', '2', '3']
+    assert info.group('hostonlyadapter') == {'2': {'': 'vboxnet0'}}
+
+
+def test_parse_vms_long():
+    from ploy_virtualbox.vbox import parse_vms_long
+    lines = vms_long(
+        ('foo', 'running', ['nat', 'hostonly']),
+        ('bar', 'powered off', ['bridged']),
+        ('baz', 'saved', [])).decode('ascii').splitlines()
+    lines.extend([
+        "Name:                        <inaccessible!>",
+        "UUID:                        00000000-0000-0000-0000-000000000099",
+        "Config file:                 /vms/gone/gone.vbox",
+        "Access error details:",
+        "  Runtime error opening '/vms/gone/gone.vbox' for reading"])
+    vms = parse_vms_long(lines)
+    assert sorted(vms) == ['<inaccessible!>', 'bar', 'baz', 'foo']
+    assert vms['foo']['state'] == 'running'
+    assert vms['foo']['nics'] == {'1': 'nat', '2': 'hostonly'}
+    assert vms['foo']['uuid'] == '00000000-0000-0000-0000-000000000000'
+    assert vms['foo']['info']['Config file'] == '/vms/foo/foo.vbox'
+    assert (vms['foo']['memory'], vms['foo']['cpus']) == (128, 1)
+    assert (vms['bar']['memory'], vms['bar']['cpus']) == (256, 2)
+    assert vms['bar']['state'] == 'poweroff'
+    assert vms['bar']['nics'] == {'1': 'bridged'}
+    assert vms['baz']['state'] == 'saved'
+    assert vms['baz']['nics'] == {}
+    assert vms['<inaccessible!>']['state'] == 'inaccessible'
+
+
+def test_parse_vms_long_virtualbox7():
+    from ploy_virtualbox.vbox import parse_vms_long
+    import pkg_resources
+    # the name is followed by ``Encryption:`` since VirtualBox 7
+    lines = pkg_resources.resource_string(
+        'ploy_virtualbox', 'vboxmanage7-vms-long.txt').decode('ascii').splitlines()
+    vms = parse_vms_long(lines)
+    assert sorted(vms) == ['bar', 'foo']
+    assert vms['foo']['uuid'] == '8d2b0c6a-3f41-4c6e-9a0b-1c2d3e4f5a6b'
+    assert vms['foo']['state'] == 'running'
+    assert vms['foo']['nics'] == {'1': 'nat', '2': 'hostonly'}
+    assert (vms['foo']['memory'], vms['foo']['cpus']) == (1024, 2)
+    assert vms['foo']['info']['Encryption'] == 'disabled'
+    assert vms['foo']['info']['Guest OS'] == 'Debian (64-bit)'
+    assert vms['bar']['state'] == 'poweroff'
+    assert vms['bar']['nics'] == {'1': 'bridged'}
+    assert (vms['bar']['memory'], vms['bar']['cpus']) == (512, 1)
+
+
+def test_bulk_status(ctrl, ployconf, popen_mock):
+    ployconf.fill([
+        '[vb-instance:foo]',
+        '[vb-instance:bar]',
+        '[vb-instance:baz]',
+        '[vb-instance:qux]'])
+    ctrl.configfile = ployconf.path
+    popen_mock.expect = [
+        (['VBoxManage', 'list', '--long', 'vms'], 0, vms_long(
+            ('foo', 'running', ['nat', 'hostonly', 'bridged']),
+            ('bar', 'running', ['nat']),
+            ('baz', 'powered off', ['hostonly'])), b''),
+        (['VBoxManage', 'guestproperty', 'enumerate', 'foo'], 0, (
+            b'Name: /VirtualBox/GuestInfo/Net/1/V4/IP, value: 192.168.56.3, timestamp: 1, flags: \n'
+            b'Name: /VirtualBox/GuestInfo/Net/2/V4/IP, value: 10.0.0.3, timestamp: 1, flags: '), b'')]
+    master = ctrl.masters['virtualbox']
+    assert master.bulk_status() == {
+        'bar': ('running', []),
+        'baz': ('stopped', []),
+        'foo': ('running', [('hostonly', '192.168.56.3'), ('bridged', '10.0.0.3')]),
+        'qux': ('unavailable', [])}
+    assert popen_mock.expect == []
+    # each call lists the current state once
+    popen_mock.expect = [
+        (['VBoxManage', 'list', '--long', 'vms'], 0, vms_long(
+            ('bar', 'powered off', ['nat'])), b'')]
+    assert master.bulk_status(['bar', 'baz']) == {
+        'bar': ('stopped', []),
+        'baz': ('unavailable', [])}
+    assert popen_mock.expect == []
+
+
+def hostinfo(memory, cpus):
+    return (
+        "Host Information:\n\n"
+        "Host time: 2024-01-01T00:00:00.000000000Z\n"
+        "Processor count: %d\n"
+        "Processor core count: %d\n"
+        "Memory size: %d MByte\n"
+        "Memory available: %d MByte\n" % (cpus, cpus, memory, memory)).encode('ascii')
+
+
+def test_pool_placement(ctrl, ployconf, popen_mock):
+    from ploy_virtualbox import PoolMaster, VirtualBoxError
+    import json
+    ployconf.fill([
+        '[vb-master:a]',
+        '[vb-master:b]',
+        '[vb-pool:lab]',
+        'masters = a b',
+        '[vb-instance:foo]',
+        'master = lab',
+        'vm-memory = 1024',
+        '[vb-instance:bar]',
+        'master = lab',
+        'vm-memory = 1024',
+        '[vb-instance:old]',
+        'master = lab'])
+    ctrl.configfile = ployconf.path
+    pool = ctrl.masters['lab']
+    assert [x.id for x in pool.vb_members] == ['a', 'b']
+    popen_mock.expect = [
+        # a runs one VM with 128 MB, b runs two with 384 MB together
+        (['VBoxManage', 'list', '--long', 'vms'], 0, vms_long(
+            ('x1', 'running', [])), b''),
+        (['VBoxManage', 'list', '--long', 'vms'], 0, vms_long(
+            ('old', 'powered off', []), ('x2', 'running', [])), b''),
+        (['VBoxManage', 'list', 'hostinfo'], 0, hostinfo(2048, 4), b''),
+        (['VBoxManage', 'list', 'hostinfo'], 0, hostinfo(2048, 4), b'')]
+    foo = ctrl.instances['foo']
+    assert foo.vb_master is ctrl.masters['a']
+    assert popen_mock.expect == []
+    # foo is pending on a, so bar goes to b which has 1792 MB left
+    bar = ctrl.instances['bar']
+    assert bar.vb_master is ctrl.masters['b']
+    assert foo.vb_master is ctrl.masters['a']
+    # an existing VM stays where it is
+    assert ctrl.instances['old'].vb_master is ctrl.masters['b']
+    state_path = os.path.join(ployconf.directory, 'vb-pool-lab.json')
+    with open(state_path) as f:
+        assert json.load(f) == {'old': 'b'}
+    pool.remember_placement(foo)
+    pool.remember_placement(bar)
+    with open(state_path) as f:
+        assert json.load(f) == {'bar': 'b', 'foo': 'a', 'old': 'b'}
+    pool.forget_placement(bar)
+    with open(state_path) as f:
+        assert json.load(f) == {'foo': 'a', 'old': 'b'}
+    # a new pool reads the placements without asking the hosts
+    pool = PoolMaster(ctrl, 'lab', ctrl.config['vb-pool']['lab'])
+    assert pool.placement(foo) is ctrl.masters['a']
+    with pytest.raises(VirtualBoxError):
+        pool.vb
+
+
+def test_pool_invalid_member(ctrl, ployconf, caplog):
+    ployconf.fill([
+        '[vb-master:a]',
+        '[vb-pool:lab]',
+        'masters = a missing'])
+    ctrl.configfile = ployconf.path
+    with pytest.raises(SystemExit):
+        ctrl.masters['lab'].vb_members
+    assert caplog_messages(caplog) == [
+        "The master 'missing' of pool 'lab' isn't a vb-master."]
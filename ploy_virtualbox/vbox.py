@@ -1,20 +1,30 @@
 from lazy import lazy
+from ploy.common import BaseExecutor
 from ploy.common import InstanceExecutor
 from ploy.common import LocalExecutor
+from ploy.common import shjoin
+try:
+    from shutil import which
+except ImportError:  # pragma: nocover
+    from distutils.spawn import find_executable as which  # for Python 2.7
+import fnmatch
+import json
 import logging
+import os
 import re
+import shlex
+import subprocess
+import threading
+import time
+import uuid
 
 
 log = logging.getLogger('ploy_virtualbox.vbox')
 
 
 def dequote(txt):
-    quote = "\"'"
     out = txt.strip()
-    if not out:
-        return ""
-    ch = out[0]
-    if (ch in quote) and (ch == out[-1]):
+    if out and out[0] in "\"'" and out[0] == out[-1]:
         out = out[1:-1]
     return out
 
@@ -34,16 +44,683 @@ def parse_list_result(sep, lines):
     return result
 
 
+medium_size_units = dict(
+    bytes=1, kbytes=1024, mbytes=1024 ** 2, gbytes=1024 ** 3, tbytes=1024 ** 4)
+
+
+def parse_medium_size(value):
+    """Parse sizes like ``102400 MBytes`` from ``showmediuminfo`` into bytes."""
+    if not value:
+        return None
+    parts = value.split()
+    unit = parts[1].lower() if len(parts) > 1 else 'bytes'
+    return int(float(parts[0]) * medium_size_units.get(unit, 1))
+
+
+# keys like nic1, storagecontrollername0, Forwarding(0) or SnapshotName-1
+indexed_key_re = re.compile(r'^([^\d(]+)\(?(\d+)\)?$')
+snapshot_key_re = re.compile(r'^SnapshotName(-[\d-]+)?$')
+
+
+class VMInfo(dict):
+    """The settings of a VM from ``showvminfo --machinereadable``.
+
+    Keys ending in a number are indexed by the part before the number while
+    parsing, so groups like the settings of all NICs or storage controllers
+    are looked up without scanning every key. The result is shared by the
+    callers of ``VBoxManage.showvminfo`` and must not be modified.
+    """
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        # maps the stem of indexed keys to a dict of index to key
+        self.stems = {}
+        self._groups = {}
+        for key in self:
+            self._index(key)
+
+    def _index(self, key):
+        m = indexed_key_re.match(key)
+        if m is not None:
+            self.stems.setdefault(m.group(1), {})[m.group(2)] = key
+
+    def group(self, prefix, namekey=None):
+        """Return the indexed keys starting with ``prefix`` by index.
+
+        The values are dicts mapping the rest of the stem to the value, for
+        ``storagecontroller`` that is ``{'0': {'name': 'SATA', ...}}``.
+        Groups with a ``name`` are also available by that name. With
+        ``namekey`` only the entries by name are returned.
+        """
+        if (prefix, namekey) not in self._groups:
+            result = {}
+            for stem, keys in self.stems.items():
+                if not stem.startswith(prefix):
+                    continue
+                name = stem[len(prefix):]
+                for index, key in keys.items():
+                    value = self[key]
+                    d = result.setdefault(index, {})
+                    d[name] = value
+                    if name == 'name':
+                        result[value] = d
+            if namekey:
+                for key in list(result):
+                    if key != result[key].get(namekey):
+                        del result[key]
+            self._groups[(prefix, namekey)] = result
+        return dict(self._groups[(prefix, namekey)])
+
+    @lazy
+    def state(self):
+        return self.get('VMState')
+
+    @lazy
+    def memory(self):
+        return int(self.get('memory', 0))
+
+    @lazy
+    def cpus(self):
+        return int(self.get('cpus', 1))
+
+    @lazy
+    def nics(self):
+        """Mapping of NIC number to attachment type of the enabled NICs."""
+        return dict(
+            (int(index), self[key])
+            for index, key in self.stems.get('nic', {}).items()
+            if self[key] != 'none')
+
+    @lazy
+    def forwardings(self):
+        """The NAT port forwarding rules like ``ssh,tcp,,2222,,22``."""
+        keys = self.stems.get('Forwarding', {})
+        return [self[keys[x]] for x in sorted(keys, key=int)]
+
+    @lazy
+    def snapshots(self):
+        """The names of all snapshots in the snapshot tree."""
+        # nested snapshots have keys like SnapshotName-1-2
+        return [
+            self[x] for x in sorted(self)
+            if snapshot_key_re.match(x)]
+
+
+def parse_vminfo(lines):
+    info = VMInfo()
+    stems = info.stems
+    match = indexed_key_re.match
+    for line in lines:
+        key, value = line.split('=', 1)
+        key = dequote(key)
+        info[key] = dequote(value)
+        m = match(key)
+        if m is not None:
+            stems.setdefault(m.group(1), {})[m.group(2)] = key
+    return info
+
+
+list_vms_re = re.compile(r"^\s*(['\"])(.*?)\1\s+{(.*?)}\s*$")
+guestproperty_re = re.compile('Name: (.*), value: (.*), timestamp: (.*), flags: (.*)')
+# the output of guestproperty wait has no timestamp in older versions
+guestproperty_wait_re = re.compile(r'Name: (.*?), value: (.*?)(?:, timestamp: \d+)?, flags: (.*)')
+
+
+def parse_vms(lines):
+    return dict((x[1], x[2]) for x in iter_matches(list_vms_re, lines))
+
+
+def parse_guestproperties(lines):
+    result = dict()
+    matches = iter_matches(guestproperty_re, lines)
+    for name, value, timestamp, flags in matches:
+        flags = [x.strip() for x in flags.split(',')]
+        result[name] = dict(value=value, timestamp=timestamp, flags=flags)
+    return result
+
+
+def parse_blocks(lines):
+    """Parse blank line separated blocks of ``key: value`` lines."""
+    block = []
+    for line in lines:
+        if not line:
+            yield parse_list_result(':', block)
+            block = []
+        else:
+            block.append(line)
+
+
+def parse_dhcpservers(lines):
+    result = {}
+    for info in parse_blocks(lines):
+        if 'Dhcpd IP' in info and 'IP' not in info:
+            info['IP'] = info['Dhcpd IP']
+        result[info['NetworkName']] = info
+    return result
+
+
+def parse_hostonlyifs(lines):
+    return dict((info['Name'], info) for info in parse_blocks(lines))
+
+
+def parse_ostypes(lines):
+    """Map the IDs from ``list ostypes`` to their descriptions."""
+    return dict(
+        (info['ID'], info.get('Description', ''))
+        for info in parse_blocks(list(lines) + ['']) if 'ID' in info)
+
+
+def parse_uart(value):
+    """Parse an ``I/O base,IRQ`` uart setting like ``0x3F8,4`` into numbers.
+
+    Returns ``None`` for other values like ``off``.
+    """
+    try:
+        (iobase, irq) = value.split(',')
+        return (int(iobase, 16), int(irq))
+    except ValueError:
+        return None
+
+
+def parse_commands(lines):
+    lines = [x for x in lines if x.strip()]
+    lines_iter = iter(lines)
+    for line in lines_iter:
+        if line.startswith('Commands:'):
+            break
+    result = set()
+    count = 0
+    for line in lines_iter:
+        if line.endswith(':'):
+            continue
+        if line[:4].strip():
+            count = 0
+        if not count:
+            cmd = line.strip()
+            if cmd.startswith('VBoxManage'):
+                cmd = cmd[len('VBoxManage'):].strip()
+            cmd = cmd.split(None, 1)[0]
+            result.add(cmd)
+        count += 1
+    return sorted(result)
+
+
+# states of the human readable ``list --long vms`` output mapped to the
+# ``VMState`` values of ``showvminfo --machinereadable``
+long_list_states = {
+    'powered off': 'poweroff',
+    'guru meditation': 'gurumeditation',
+    'live snapshotting': 'livesnapshotting',
+    'deleting snapshot': 'deletingsnapshot',
+    'deleting snapshot live': 'deletingsnapshotlive',
+    'restoring snapshot': 'restoringsnapshot'}
+
+
+long_list_nic_types = (
+    ('NAT Network', 'natnetwork'),
+    ('NAT', 'nat'),
+    ('Host-only', 'hostonly'),
+    ('Bridged', 'bridged'),
+    ('Internal', 'intnet'),
+    ('Generic', 'generic'),
+    ('none', 'none'))
+
+
+long_list_nic_re = re.compile(r'^NIC (\d+):\s+(.*)$')
+long_list_memory_re = re.compile(r'^Memory size:?\s+(\d+)\s*MB')
+long_list_cpus_re = re.compile(r'^Number of CPUs:\s+(\d+)')
+long_list_state_re = re.compile(r'^(.*?)\s*(\(since .*\))?$')
+
+
+def parse_vms_long(lines):
+    """Parse the output of ``VBoxManage list --long vms``.
+
+    Returns a dict mapping VM names to dicts with ``uuid``, ``state`` as
+    ``VMState`` value, ``memory`` in MB, ``cpus`` and ``nics`` mapping NIC
+    numbers to attachment types like in ``showvminfo --machinereadable``.
+    All other fields are kept under their label in ``info``.
+    """
+    result = {}
+
+    def add(vm, line):
+        # the colon after ``Memory size`` is missing in newer versions
+        m = long_list_memory_re.match(line)
+        if m:
+            vm['memory'] = int(m.group(1))
+            return
+        m = long_list_cpus_re.match(line)
+        if m:
+            vm['cpus'] = int(m.group(1))
+            return
+        if ':' not in line:
+            return
+        m = long_list_nic_re.match(line)
+        if m:
+            (index, value) = m.groups()
+            if value.strip() == 'disabled':
+                return
+            attachment = value.split('Attachment:', 1)[-1].strip()
+            for prefix, nictype in long_list_nic_types:
+                if attachment.startswith(prefix):
+                    vm['nics'][index] = nictype
+                    break
+            return
+        (key, value) = line.split(':', 1)
+        vm['info'].setdefault(key.strip(), value.strip())
+
+    vm = None
+    # shared folders and USB filters also have unindented ``Name:`` lines,
+    # only the name of a VM is followed by an unindented ``UUID:`` line
+    # before the next name, with fields like ``Groups:`` or, since
+    # VirtualBox 7, ``Encryption:`` in between
+    pending = None
+    for line in lines:
+        if line.startswith('Name:'):
+            if pending is not None and vm is not None:
+                for pending_line in pending[1]:
+                    add(vm, pending_line)
+            pending = (line.split(':', 1)[1].strip(), [])
+        elif line.startswith('UUID:') and pending is not None:
+            (name, pending_lines) = pending
+            pending = None
+            vm = result[name] = dict(name=name, info={}, nics={}, memory=0, cpus=1)
+            for pending_line in pending_lines + [line]:
+                add(vm, pending_line)
+        elif pending is not None:
+            pending[1].append(line)
+        elif vm is not None:
+            add(vm, line)
+    if pending is not None and vm is not None:
+        for pending_line in pending[1]:
+            add(vm, pending_line)
+    for vm in result.values():
+        info = vm['info']
+        vm['uuid'] = info.get('UUID')
+        state = long_list_state_re.match(info.get('State', '')).group(1).lower()
+        if 'Access error details' in info:
+            state = 'inaccessible'
+        vm['state'] = long_list_states.get(state, state.replace(' ', ''))
+    return result
+
+
+def make_cmd_args(args, kw):
+    cmd_args = []
+    cmd_args.extend(args)
+    for k, v in sorted(kw.items()):
+        cmd_args.append("--%s" % k)
+        cmd_args.append(v)
+    return cmd_args
+
+
+class ResultExecutor(BaseExecutor):
+    """Executor which returns an already known result.
+
+    Used to apply the usual ``rc``, ``out`` and ``err`` handling to the
+    results of commands which ran as part of a batch.
+    """
+
+    def __init__(self, result, **kw):
+        BaseExecutor.__init__(self, **kw)
+        self.result = result
+
+    def _run(self, args, stdin):
+        return self.result
+
+
+class CallRecord(object):
+    """A finished ``VBoxManage`` invocation as passed to the call hooks.
+
+    ``rc`` is ``None`` if the executor raised an exception. For batches
+    ``subcommand`` is ``batch`` and ``args`` holds the arguments of the
+    batched commands. ``host`` is the uid of the instance of remote masters.
+    ``vm`` is ``None`` for batches and commands which don't work on a VM.
+    """
+
+    # subcommands which don't take a VM, like the ones for media
+    non_vm_commands = frozenset((
+        'checkmediumpwd', 'clonehd', 'clonemedium', 'closemedium',
+        'convertfromraw', 'createhd', 'createmedium', 'dhcpserver',
+        'encryptmedium', 'extpack', 'hostonlyif', 'list', 'mediumproperty',
+        'modifyhd', 'modifymedium', 'natnetwork', 'registervm',
+        'setproperty', 'showhdinfo', 'showmediuminfo'))
+    # subcommands with a verb before the VM
+    verb_commands = frozenset(('guestproperty', 'sharedfolder', 'unattended'))
+    # subcommands which create the VM given by --name
+    create_commands = frozenset(('clonevm', 'createvm'))
+
+    def __init__(self, args, rc, started, duration, out, err, host=None):
+        args = list(args)
+        if args[:2] == ['sh', '-c']:
+            self.subcommand = 'batch'
+            self.args = [
+                shlex.split(x)[1:]
+                for x in args[2].splitlines()
+                if not x.startswith(('rc=', 'printf ', '['))]
+        else:
+            self.args = args[1:]
+            self.subcommand = self.args[0] if self.args else ''
+        self.rc = rc
+        self.started = started
+        self.duration = duration
+        self.out_bytes = len(out)
+        self.err_bytes = len(err)
+        self.host = host
+
+    @property
+    def vm(self):
+        if self.subcommand in self.non_vm_commands or self.subcommand == 'batch':
+            return None
+        args = self.args[1:]
+        if self.subcommand in self.create_commands:
+            for option, value in zip(args, args[1:]):
+                if option == '--name':
+                    return value
+            return None
+        if self.subcommand in self.verb_commands:
+            args = args[1:]
+        for arg in args:
+            if not arg.startswith('-'):
+                return arg
+
+    def as_dict(self):
+        return dict(
+            subcommand=self.subcommand, args=self.args, rc=self.rc,
+            started=self.started, duration=self.duration,
+            out_bytes=self.out_bytes, err_bytes=self.err_bytes,
+            vm=self.vm, host=self.host)
+
+
+class CallLog(object):
+    """Call hook which appends each call as a JSON line to ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record.as_dict(), sort_keys=True)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class CallTimings(object):
+    """Call hook which aggregates the timings per subcommand."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def __call__(self, record):
+        with self.lock:
+            timing = self.timings.setdefault(
+                record.subcommand, dict(calls=0, failed=0, total=0.0, max=0.0, out_bytes=0))
+            timing['calls'] += 1
+            if record.rc != 0:
+                timing['failed'] += 1
+            timing['total'] += record.duration
+            timing['max'] = max(timing['max'], record.duration)
+            timing['out_bytes'] += record.out_bytes
+
+    def format_table(self):
+        lines = ["%-16s %6s %6s %9s %9s %9s %9s" % (
+            'subcommand', 'calls', 'failed', 'total', 'avg', 'max', 'output')]
+        items = sorted(
+            self.timings.items(), key=lambda x: (-x[1]['total'], x[0]))
+        for subcommand, timing in items:
+            lines.append("%-16s %6d %6d %8.3fs %7.1fms %7.1fms %9d" % (
+                subcommand or '(usage)', timing['calls'], timing['failed'],
+                timing['total'], timing['total'] * 1000 / timing['calls'],
+                timing['max'] * 1000, timing['out_bytes']))
+        lines.append("%-16s %6d %6d %8.3fs" % (
+            'total', sum(x['calls'] for x in self.timings.values()),
+            sum(x['failed'] for x in self.timings.values()),
+            sum(x['total'] for x in self.timings.values())))
+        return lines
+
+    def report(self):
+        if not self.timings:
+            return
+        log.info("VBoxManage call timings:\n%s" % '\n'.join(self.format_table()))
+
+
+class BatchResult(object):
+    def __init__(self, cmd_args, rc, out, err):
+        self.cmd_args = cmd_args
+        self.rc = rc
+        self.out = out
+        self.err = err
+        self.raw = None
+        self.exception = None
+
+    def get(self):
+        """Return the output of the command like an immediate call would.
+
+        Raises ``subprocess.CalledProcessError`` if the command failed or
+        wasn't run because a previous command of the batch failed.
+        """
+        if self.exception is not None:
+            raise self.exception
+        return self.raw
+
+
+class Batch(object):
+    """Collects VBoxManage commands to run them in one shell invocation.
+
+    Each queued command returns a ``BatchResult`` which is filled in by
+    ``run``. The commands run in order and the first failing command
+    stops the batch. When ``enabled`` is false, the commands run
+    immediately instead, so callers can use the same code in both cases.
+    """
+
+    def __init__(self, vb, enabled=True):
+        self.vb = vb
+        self.enabled = enabled
+        self.queued = []
+        self.failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.run()
+
+    def __getattr__(self, name):
+        return lambda *args, **kw: self.queue(name, *args, rc=0, err=b'', **kw)
+
+    def queue(self, *args, **kw):
+        rc = kw.pop('rc', None)
+        out = kw.pop('out', None)
+        err = kw.pop('err', None)
+        result = BatchResult(make_cmd_args(args, kw), rc, out, err)
+        if not self.enabled:
+            if self.failed:
+                result.exception = self._not_run(result)
+            else:
+                try:
+                    result.raw = self.vb(*result.cmd_args, rc=rc, out=out, err=err)
+                except subprocess.CalledProcessError as e:
+                    result.exception = e
+                    self.failed = True
+            return result
+        self.queued.append(result)
+        return result
+
+    def _not_run(self, result):
+        return subprocess.CalledProcessError(
+            -1, ' '.join(self.vb.prefix_args + tuple(result.cmd_args)),
+            b'Not run, because a previous command failed.')
+
+    def run(self):
+        queued = self.queued
+        self.queued = []
+        if not queued:
+            return
+        marker = 'ploy-vbox-batch-%s' % uuid.uuid4().hex
+        script = []
+        for index, result in enumerate(queued):
+            script.append(shjoin(self.vb.prefix_args + tuple(result.cmd_args)))
+            script.append('rc=$?')
+            script.append("printf '%s %d %%d\\n' $rc" % (marker, index))
+            script.append("printf '%s %d\\n' >&2" % (marker, index))
+            script.append('[ $rc -eq 0 ] || exit 0')
+        (rc, out, err) = self.vb.shell_executor('sh', '-c', '\n'.join(script))
+        outs = re.split(
+            ('%s (\\d+) (\\d+)\n' % marker).encode('ascii'), out)
+        errs = re.split(
+            ('%s \\d+\n' % marker).encode('ascii'), err)
+        rcs = {}
+        for index in range(len(outs) // 3):
+            (cmd_out, cmd_index, cmd_rc) = outs[index * 3:index * 3 + 3]
+            rcs[int(cmd_index)] = (int(cmd_rc), cmd_out, errs[index])
+        for index, result in enumerate(queued):
+            if len(result.cmd_args) > 1 and result.cmd_args[0] in self.vb.mutating_commands:
+                self.vb.invalidate_vminfo(result.cmd_args[1])
+            if index not in rcs:
+                if rc and not self.failed:
+                    result.exception = subprocess.CalledProcessError(
+                        rc, 'sh -c ...', err)
+                else:
+                    result.exception = self._not_run(result)
+                self.failed = True
+                continue
+            executor = ResultExecutor(
+                rcs[index], prefix_args=self.vb.prefix_args, splitlines=True)
+            try:
+                result.raw = executor(
+                    *result.cmd_args, rc=result.rc, out=result.out, err=result.err)
+            except subprocess.CalledProcessError as e:
+                result.exception = e
+                self.failed = True
+
+
+class SharedConnection(object):
+    """Keeps the ssh connection to the host of a remote master usable.
+
+    ploy already runs the commands for an instance as channels of one ssh
+    transport. This sends keepalive packets every ``keepalive`` seconds, so
+    the connection survives long waits behind NAT or firewalls, replaces
+    a transport which died and closes the connection once it wasn't used
+    for ``idle_timeout`` seconds.
+    """
+
+    def __init__(self, instance, keepalive=None, idle_timeout=None):
+        self.instance = instance
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self._timer = None
+
+    def acquire(self):
+        with self.lock:
+            self.active += 1
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            conn = getattr(self.instance, '_conn', None)
+            if conn is not None:
+                transport = conn.get_transport()
+                if transport is not None and not transport.is_active():
+                    log.info("Reconnecting to '%s'.", self.instance.uid)
+                    self.instance.close_conn()
+            if self.keepalive:
+                self.instance.conn.get_transport().set_keepalive(self.keepalive)
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            if self.active or self.idle_timeout is None:
+                return
+            self._timer = threading.Timer(self.idle_timeout, self.close)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def close(self):
+        with self.lock:
+            if self.active:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.instance.close_conn()
+
+
 class VBoxManage:
-    def __init__(self, executable="VBoxManage", instance=None):
+    # subcommands which change the settings or state of the VM given as
+    # first argument, the cached ``showvminfo`` result is dropped for those
+    mutating_commands = frozenset((
+        'controlvm', 'modifyvm', 'snapshot', 'startvm', 'storageattach',
+        'storagectl', 'unregistervm'))
+
+    commands_cache_name = 'vboxmanage-commands.json'
+
+    def __init__(self, executable="VBoxManage", instance=None, cache_dir=None,
+                 keepalive=None, idle_timeout=None):
+        self._vminfo_cache = {}
+        self._vms_long_cache = None
+        self.prefix_args = (executable,)
+        self.instance = instance
+        self.cache_dir = cache_dir
+        # callables which get a ``CallRecord`` for each finished call
+        self.call_hooks = []
         if instance is None:
             self.executor = LocalExecutor(
                 prefix_args=[executable], splitlines=True)
+            self.shell_executor = LocalExecutor()
         else:
             self.executor = InstanceExecutor(
                 instance=instance, prefix_args=[executable], splitlines=True)
+            self.shell_executor = InstanceExecutor(instance=instance)
+        self.connection = None
+        if instance is not None and (keepalive or idle_timeout is not None):
+            self.connection = SharedConnection(
+                instance, keepalive=keepalive, idle_timeout=idle_timeout)
+            self._share_connection(self.executor)
+            self._share_connection(self.shell_executor)
+        self._instrument(self.executor)
+        self._instrument(self.shell_executor)
+
+    def _share_connection(self, executor):
+        run = executor._run
+
+        def _run(args, stdin):
+            self.connection.acquire()
+            try:
+                return run(args, stdin)
+            finally:
+                self.connection.release()
+
+        executor._run = _run
+
+    def _instrument(self, executor):
+        run = executor._run
+
+        def _run(args, stdin):
+            if not self.call_hooks:
+                return run(args, stdin)
+            started = time.time()
+            (rc, out, err) = (None, b'', b'')
+            try:
+                (rc, out, err) = run(args, stdin)
+            finally:
+                host = None
+                if self.instance is not None:
+                    host = self.instance.uid
+                record = CallRecord(
+                    args, rc, started, time.time() - started, out, err,
+                    host=host)
+                for hook in self.call_hooks:
+                    hook(record)
+            return (rc, out, err)
 
-    list_vms_re = re.compile(r"^\s*(['\"])(.*?)\1\s+{(.*?)}\s*$")
+        executor._run = _run
+
+    def batch(self, enabled=True):
+        return Batch(self, enabled=enabled)
+
+    list_vms_re = list_vms_re
 
     def createhd(self, *args, **kw):
         return self('createhd', *args, rc=0, **kw)
@@ -57,16 +734,11 @@ class VBoxManage:
     def controlvm_poweroff(self, name, *args, **kw):
         return self('controlvm', name, 'poweroff', *args, rc=0, **kw)
 
-    guestproperty_re = re.compile('Name: (.*), value: (.*), timestamp: (.*), flags: (.*)')
+    guestproperty_re = guestproperty_re
 
     def guestproperty(self, name, *args, **kw):
         lines = self('guestproperty', name, *args, rc=0, err=b'', **kw)
-        result = dict()
-        matches = iter_matches(self.guestproperty_re, lines)
-        for name, value, timestamp, flags in matches:
-            flags = [x.strip() for x in flags.split(',')]
-            result[name] = dict(value=value, timestamp=timestamp, flags=flags)
-        return result
+        return parse_guestproperties(lines)
 
     def hostonlyif(self, cmd, *args, **kw):
         key = 'hostonlyif_%s' % cmd
@@ -82,69 +754,195 @@ class VBoxManage:
 
     def list_dhcpservers(self, *args, **kw):
         lines = self('list', 'dhcpservers', *args, rc=0, err=b'', **kw)
-        block = []
-        result = {}
-        for line in lines:
-            if not line:
-                info = parse_list_result(':', block)
-                if 'Dhcpd IP' in info and 'IP' not in info:
-                    info['IP'] = info['Dhcpd IP']
-                result[info['NetworkName']] = info
-                block = []
-            else:
-                block.append(line)
-        return result
+        return parse_dhcpservers(lines)
 
     def list_hostonlyifs(self, *args, **kw):
         lines = self('list', 'hostonlyifs', *args, rc=0, err=b'', **kw)
-        block = []
-        result = {}
-        for line in lines:
-            if not line:
-                info = parse_list_result(':', block)
-                result[info['Name']] = info
-                block = []
-            else:
-                block.append(line)
-        return result
+        return parse_hostonlyifs(lines)
+
+    def list_hostinfo(self, *args, **kw):
+        lines = self('list', 'hostinfo', *args, rc=0, err=b'', **kw)
+        return parse_list_result(':', [x for x in lines if ':' in x])
 
     def list_systemproperties(self, *args, **kw):
         lines = self('list', 'systemproperties', *args, rc=0, err=b'', **kw)
         return parse_list_result(':', lines)
 
+    @lazy
+    def ostypes(self):
+        """The guest OS type IDs mapped to their descriptions."""
+        return parse_ostypes(self('list', 'ostypes', rc=0, err=b''))
+
     def list_vms(self, *args, **kw):
         lines = self('list', 'vms', *args, rc=0, err=b'', **kw)
-        return dict((x[1], x[2]) for x in iter_matches(self.list_vms_re, lines))
+        return parse_vms(lines)
 
-    def showvminfo(self, *args, **kw):
-        lines = self('showvminfo', '--machinereadable', *args, rc=0, err=b'', **kw)
-        return parse_list_result('=', lines)
+    def list_vms_long(self, refresh=False):
+        """Return the parsed ``list --long vms`` output for all VMs.
+
+        The result is cached until a command changes a VM, so the state of
+        many VMs can be looked up with one invocation.
+        """
+        if refresh or self._vms_long_cache is None:
+            lines = self('list', '--long', 'vms', rc=0, err=b'')
+            self._vms_long_cache = parse_vms_long(lines)
+        return self._vms_long_cache
+
+    def showvminfo(self, name, *args, **kw):
+        refresh = kw.pop('refresh', False)
+        if args or kw:
+            lines = self('showvminfo', '--machinereadable', name, *args, rc=0, err=b'', **kw)
+            return parse_vminfo(lines)
+        if refresh or name not in self._vminfo_cache:
+            lines = self('showvminfo', '--machinereadable', name, rc=0, err=b'')
+            self._vminfo_cache[name] = parse_vminfo(lines)
+        return self._vminfo_cache[name]
+
+    def invalidate_vminfo(self, name=None):
+        self._vms_long_cache = None
+        if name is None:
+            self._vminfo_cache.clear()
+        else:
+            self._vminfo_cache.pop(name, None)
+
+    def showmediuminfo(self, *args, **kw):
+        lines = self('showmediuminfo', *args, rc=0, err=b'', **kw)
+        return parse_list_result(':', [x for x in lines if ':' in x])
 
     def unregistervm(self, name, *args, **kw):
         return self('unregistervm', name, *args, rc=0, **kw)
 
+    wait_interval = 0.125
+    wait_max_interval = 2.0
+
+    def wait_for_state(self, name, states, timeout=None):
+        """Wait until the ``VMState`` of the VM is one of ``states``.
+
+        VBoxManage has no blocking wait for machine state changes, so this
+        polls ``showvminfo`` with an exponential backoff starting at
+        ``wait_interval``. Returns the reached state, or ``None`` when
+        ``timeout`` seconds passed first.
+        """
+        interval = self.wait_interval
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            state = self.showvminfo(name, refresh=True).get('VMState')
+            if state in states:
+                return state
+            if deadline is None:
+                delay = interval
+            else:
+                delay = min(interval, deadline - time.time())
+                if delay <= 0:
+                    return None
+            time.sleep(delay)
+            interval = min(interval * 2, self.wait_max_interval)
+
+    def wait_for_guestproperty(self, name, pattern, timeout=None):
+        """Wait until the guest sets a property matching ``pattern``.
+
+        ``guestproperty wait`` only returns on changes, so the properties
+        which are already set are checked first. Returns a ``(name, value)``
+        tuple, or ``None`` when ``timeout`` seconds passed first.
+        """
+        for key, prop in sorted(self.guestproperty('enumerate', name).items()):
+            if fnmatch.fnmatchcase(key, pattern) and prop['value']:
+                return (key, prop['value'])
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            args = ['guestproperty', 'wait', name, pattern]
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                args.extend(['--timeout', str(int(remaining * 1000)), '--fail-on-timeout'])
+            (rc, lines, err) = self(*args)
+            # exits with 2 on timeout
+            if rc not in (0, 2):
+                raise subprocess.CalledProcessError(
+                    rc, ' '.join(['VBoxManage'] + args), err)
+            for key, value, flags in iter_matches(guestproperty_wait_re, lines):
+                # a deleted property is reported with an empty value
+                if value:
+                    return (key, value)
+
+    @lazy
+    def commands_cache_key(self):
+        """Identifies the VBoxManage installation for the command table cache.
+
+        Returns a ``(location, stamp)`` tuple. Locally this is the path and
+        modification time of the executable, which doesn't need another
+        process. For remote masters it's the instance and the output of
+        ``VBoxManage --version``.
+        """
+        if self.instance is None:
+            path = which(self.prefix_args[0])
+            if path is None:
+                return None
+            path = os.path.realpath(path)
+            return (path, str(os.stat(path).st_mtime))
+        version = self('--version', rc=0, err=b'')
+        return (
+            "%s:%s" % (self.instance.uid, self.prefix_args[0]),
+            ''.join(version).strip())
+
+    @property
+    def commands_cache_path(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, self.commands_cache_name)
+
+    def _read_commands_cache(self):
+        path = self.commands_cache_path
+        if path is None or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning("Ignoring invalid cache file '%s'." % path)
+            return {}
+
+    def _write_commands_cache(self, cache):
+        path = self.commands_cache_path
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, mode=0o750)
+        tmp_path = "%s.%s" % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+
     @lazy
     def commands(self):
-        lines = [x for x in self(rc=0, err=b'') if x.strip()]
-        lines_iter = iter(lines)
-        for line in lines_iter:
-            if line.startswith('Commands:'):
-                break
-        result = set()
-        count = 0
-        for line in lines_iter:
-            if line.endswith(':'):
-                continue
-            if line[:4].strip():
-                count = 0
-            if not count:
-                cmd = line.strip()
-                if cmd.startswith('VBoxManage'):
-                    cmd = cmd[len('VBoxManage'):].strip()
-                cmd = cmd.split(None, 1)[0]
-                result.add(cmd)
-            count += 1
-        return sorted(result)
+        key = None
+        if self.cache_dir is not None:
+            key = self.commands_cache_key
+        if key is not None:
+            (location, stamp) = key
+            entry = self._read_commands_cache().get(location)
+            if isinstance(entry, dict) and entry.get('stamp') == stamp:
+                return entry['commands']
+        commands = parse_commands(self(rc=0, err=b''))
+        if key is not None:
+            # only the current table of each installation is kept
+            cache = dict(
+                (k, v) for k, v in self._read_commands_cache().items()
+                if isinstance(v, dict))
+            cache[location] = dict(stamp=stamp, commands=commands)
+            self._write_commands_cache(cache)
+        return commands
+
+    def invalidate_commands_cache(self):
+        """Forget the command table, it is parsed again on next use."""
+        lazy.invalidate(self, 'commands')
+        lazy.invalidate(self, 'commands_cache_key')
+        path = self.commands_cache_path
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
     def __getattr__(self, name):
         if name not in self.commands:
@@ -155,9 +953,11 @@ class VBoxManage:
         rc = kw.pop('rc', None)
         out = kw.pop('out', None)
         err = kw.pop('err', None)
-        cmd_args = []
-        cmd_args.extend(args)
-        for k, v in sorted(kw.items()):
-            cmd_args.append("--%s" % k)
-            cmd_args.append(v)
-        return self.executor(*cmd_args, rc=rc, out=out, err=err)
+        cmd_args = make_cmd_args(args, kw)
+        try:
+            return self.executor(*cmd_args, rc=rc, out=out, err=err)
+        finally:
+            if len(args) > 1 and args[0] in self.mutating_commands:
+                self.invalidate_vminfo(args[1])
+            elif args and args[0] in ('clonevm', 'createvm'):
+                self._vms_long_cache = None